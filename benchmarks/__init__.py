@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+#
+#  __init__.py
+#  benchmarks
+#
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+#  compare.py
+#  benchmarks
+#
+
+"""
+Compare two benchmark result files, reporting any regressions.
+"""
+
+from typing import Any, Dict, List, Tuple
+import argparse
+import json
+import sys
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any],
+            threshold: float = 0.1) -> List[Tuple[str, int, str, float, float]]:
+    """
+    Return (name, rows, metric, old, new) for every benchmark where the new run
+    is slower or uses more memory than the old one by more than the threshold.
+    """
+    old_results = {(r['name'], r['rows']): r for r in old['results']}
+
+    regressions = []
+    for r in new['results']:
+        baseline = old_results.get((r['name'], r['rows']))
+        if baseline is None:
+            continue
+
+        for metric in ('min_seconds', 'peak_bytes'):
+            before = baseline[metric]
+            after = r[metric]
+            if before and (after - before) / before > threshold:
+                regressions.append((r['name'], r['rows'], metric, before, after))
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown to tolerate [default: 0.1]')
+    args = parser.parse_args()
+
+    with open(args.old) as istream:
+        old = json.load(istream)
+    with open(args.new) as istream:
+        new = json.load(istream)
+
+    regressions = compare(old, new, threshold=args.threshold)
+    for name, rows, metric, before, after in regressions:
+        print('{0} ({1} rows): {2} {3:.4g} -> {4:.4g} ({5:+.1%})'.format(
+            name, rows, metric, before, after, (after - before) / before
+        ))
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+#  run.py
+#  benchmarks
+#
+
+"""
+Time and memory-profile the main csvdiff operations over synthetic data at
+several scales, writing the results as JSON for later comparison.
+"""
+
+from typing import Any, Callable, Dict, List
+import argparse
+import datetime
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import csvdiff
+from csvdiff import patch
+
+from . import synthetic
+
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+
+
+def run(scales: List[int], repeat: int = 3, **spec_args: Any) -> Dict[str, Any]:
+    "Run every benchmark at every scale, returning the collected results."
+    results = []
+    for spec in synthetic.iter_specs(scales, **spec_args):
+        results.extend(_run_scale(spec, repeat))
+
+    return {
+        'meta': _environment(),
+        'results': results,
+    }
+
+
+def _run_scale(spec: synthetic.Spec, repeat: int) -> List[Dict[str, Any]]:
+    from_records, to_records = synthetic.generate(spec)
+    index_columns = spec.index_columns
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        from_file = os.path.join(tmpdir, 'from.csv')
+        to_file = os.path.join(tmpdir, 'to.csv')
+        synthetic.write(from_records, spec.fieldnames, from_file)
+        synthetic.write(to_records, spec.fieldnames, to_file)
+
+        diff = patch.create(from_records, to_records, index_columns)
+        saved = io.StringIO()
+        patch.save(diff, saved, compact=True)
+        saved_text = saved.getvalue()
+
+        benchmarks = [
+            ('diff_files',
+             lambda: csvdiff.diff_files(from_file, to_file, index_columns)),
+            ('patch.create',
+             lambda: patch.create(from_records, to_records, index_columns)),
+            ('patch.apply',
+             lambda: patch.apply(diff, from_records)),
+            ('patch.save',
+             lambda: patch.save(diff, io.StringIO(), compact=True)),
+            ('patch.load',
+             lambda: patch.load(io.StringIO(saved_text))),
+            ('filter_significance',
+             lambda: patch.filter_significance(diff, 2)),
+        ]
+
+        return [_measure(name, f, spec, repeat) for name, f in benchmarks]
+
+
+def _measure(name: str, f: Callable[[], Any], spec: synthetic.Spec,
+             repeat: int) -> Dict[str, Any]:
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+
+    # memory is measured on a separate run, since tracing slows things down
+    gc.collect()
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'name': name,
+        'rows': spec.rows,
+        'spec': spec.as_dict(),
+        'min_seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+        'rows_per_second': spec.rows / min(timings) if min(timings) else None,
+        'peak_bytes': peak,
+    }
+
+
+def _environment() -> Dict[str, Any]:
+    return {
+        'csvdiff_version': csvdiff.__version__,
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', '-o', default='bench_output.json',
+                        help='Where to write the JSON results')
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                        help='Comma-separated row counts to benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--key-columns', type=int, default=1)
+    parser.add_argument('--key-width', type=int, default=8)
+    parser.add_argument('--value-type', choices=synthetic.VALUE_TYPES, default='mixed')
+    parser.add_argument('--change-ratio', type=float, default=0.05)
+    parser.add_argument('--add-ratio', type=float, default=0.01)
+    parser.add_argument('--remove-ratio', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(',')]
+    results = run(scales, repeat=args.repeat, columns=args.columns,
+                  key_columns=args.key_columns, key_width=args.key_width,
+                  value_type=args.value_type, change_ratio=args.change_ratio,
+                  add_ratio=args.add_ratio, remove_ratio=args.remove_ratio,
+                  seed=args.seed)
+
+    with open(args.output, 'w') as ostream:
+        json.dump(results, ostream, indent=2, sort_keys=True)
+
+    for r in results['results']:
+        print('{name:<20} {rows:>9} rows  {min_seconds:9.4f}s  '
+              '{peak_mb:9.1f} MB'.format(peak_mb=r['peak_bytes'] / 2**20, **r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+#  startup.py
+#  benchmarks
+#
+
+"""
+Measure how long it takes to import csvdiff, and to start the command-line
+tools, by timing fresh interpreters.
+"""
+
+from typing import Dict, List
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+STATEMENTS = {
+    'python': 'pass',
+    'import csvdiff': 'import csvdiff',
+    'import csvdiff.cli': 'import csvdiff.cli',
+}
+
+
+def measure(statement: str, repeat: int = 20) -> List[float]:
+    "Time a fresh interpreter running the statement, in seconds."
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', statement])
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def run(repeat: int = 20) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, statement in STATEMENTS.items():
+        timings = measure(statement, repeat=repeat)
+        results[name] = {
+            'min_seconds': min(timings),
+            'median_seconds': statistics.median(timings),
+        }
+
+    # the interpreter's own startup isn't our cost
+    baseline = results['python']['median_seconds']
+    for r in results.values():
+        r['overhead_seconds'] = r['median_seconds'] - baseline
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', '-o', help='Also write the results as JSON')
+    parser.add_argument('--max-ms', type=float,
+                        help='Fail if importing csvdiff costs more than this')
+    args = parser.parse_args()
+
+    results = run(repeat=args.repeat)
+    for name, r in results.items():
+        print('{0:<20} {1:8.1f} ms  (+{2:.1f} ms)'.format(
+            name, 1000 * r['median_seconds'], 1000 * r['overhead_seconds']
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as ostream:
+            json.dump(results, ostream, indent=2, sort_keys=True)
+
+    if args.max_ms is not None:
+        cost = 1000 * results['import csvdiff']['overhead_seconds']
+        if cost > args.max_ms:
+            print('importing csvdiff took {0:.1f} ms, over the {1} ms limit'.format(
+                cost, args.max_ms
+            ), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+#  synthetic.py
+#  benchmarks
+#
+
+"""
+Generate reproducible pairs of synthetic CSV files for benchmarking.
+"""
+
+from typing import Any, Dict, Iterator, List, Tuple
+import argparse
+import csv
+import random
+import string
+
+
+VALUE_TYPES = ('int', 'float', 'str', 'category', 'mixed')
+
+CATEGORIES = ('AU', 'GB', 'NZ', 'US', 'active', 'inactive', 'pending', 'Y', 'N')
+
+# the base in which the row number is split across composite key columns
+KEY_BASE = 16
+
+
+class Spec:
+    """
+    The shape of a synthetic dataset: how many rows and columns, how wide the
+    keys are, what kind of values fill the cells, and what fraction of rows
+    differ between the two generated files.
+    """
+    def __init__(self, rows: int = 10000, columns: int = 10, key_columns: int = 1,
+                 key_width: int = 8, value_type: str = 'mixed',
+                 change_ratio: float = 0.05, add_ratio: float = 0.01,
+                 remove_ratio: float = 0.01, seed: int = 0) -> None:
+        if value_type not in VALUE_TYPES:
+            raise ValueError('unknown value type {0}'.format(value_type))
+        if key_columns < 1 or columns <= key_columns:
+            raise ValueError('need at least one key column and one value column')
+
+        self.rows = rows
+        self.columns = columns
+        self.key_columns = key_columns
+        self.key_width = key_width
+        self.value_type = value_type
+        self.change_ratio = change_ratio
+        self.add_ratio = add_ratio
+        self.remove_ratio = remove_ratio
+        self.seed = seed
+
+    @property
+    def index_columns(self) -> List[str]:
+        return ['k{0}'.format(i) for i in range(self.key_columns)]
+
+    @property
+    def value_columns(self) -> List[str]:
+        return ['c{0}'.format(i) for i in range(self.columns - self.key_columns)]
+
+    @property
+    def fieldnames(self) -> List[str]:
+        return self.index_columns + self.value_columns
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+def generate(spec: Spec) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    "Generate a (from, to) pair of record lists matching the spec."
+    rng = random.Random(spec.seed)
+    value_types = _column_types(spec, rng)
+
+    from_records = [_make_record(spec, i, value_types, rng)
+                    for i in range(spec.rows)]
+
+    to_records = []
+    for r in from_records:
+        roll = rng.random()
+        if roll < spec.remove_ratio:
+            continue
+
+        if roll < spec.remove_ratio + spec.change_ratio:
+            r = dict(r)
+            column = rng.choice(spec.value_columns)
+            r[column] = _make_value(value_types[column], rng)
+
+        to_records.append(r)
+
+    n_added = int(spec.rows * spec.add_ratio)
+    to_records.extend(_make_record(spec, spec.rows + i, value_types, rng)
+                      for i in range(n_added))
+
+    # shuffle the new file so that row order carries no information
+    rng.shuffle(to_records)
+
+    return from_records, to_records
+
+
+def write(records: List[Dict[str, str]], fieldnames: List[str], filename: str,
+          sep: str = ',') -> None:
+    with open(filename, 'w', newline='') as ostream:
+        writer = csv.DictWriter(ostream, fieldnames, delimiter=sep)
+        writer.writeheader()
+        for r in records:
+            writer.writerow(r)
+
+
+def generate_files(spec: Spec, from_file: str, to_file: str, sep: str = ',') -> None:
+    from_records, to_records = generate(spec)
+    write(from_records, spec.fieldnames, from_file, sep=sep)
+    write(to_records, spec.fieldnames, to_file, sep=sep)
+
+
+def _column_types(spec: Spec, rng: random.Random) -> Dict[str, str]:
+    if spec.value_type != 'mixed':
+        return {c: spec.value_type for c in spec.value_columns}
+
+    return {c: rng.choice(VALUE_TYPES[:-1]) for c in spec.value_columns}
+
+
+def _make_record(spec: Spec, i: int, value_types: Dict[str, str],
+                 rng: random.Random) -> Dict[str, str]:
+    r = {c: _make_key_part(spec, i, j) for j, c in enumerate(spec.index_columns)}
+    for c in spec.value_columns:
+        r[c] = _make_value(value_types[c], rng)
+
+    return r
+
+
+def _make_key_part(spec: Spec, i: int, j: int) -> str:
+    # composite keys split the row number across the key columns, the leading
+    # ones taking its low digits in base KEY_BASE and the last one the rest,
+    # so that every column varies and every combination is still unique
+    if j < spec.key_columns - 1:
+        return str(i // KEY_BASE ** j % KEY_BASE).zfill(spec.key_width)
+
+    return str(i // KEY_BASE ** j).zfill(spec.key_width)
+
+
+def _make_value(value_type: str, rng: random.Random) -> str:
+    if value_type == 'int':
+        return str(rng.randint(-10**6, 10**6))
+
+    if value_type == 'float':
+        return '{0:.4f}'.format(rng.uniform(-1000, 1000))
+
+    if value_type == 'category':
+        return rng.choice(CATEGORIES)
+
+    return ''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(4, 24)))
+
+
+def iter_specs(scales: List[int], **kwargs: Any) -> Iterator[Spec]:
+    for rows in scales:
+        yield Spec(rows=rows, **kwargs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('from_file')
+    parser.add_argument('to_file')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--key-columns', type=int, default=1)
+    parser.add_argument('--key-width', type=int, default=8)
+    parser.add_argument('--value-type', choices=VALUE_TYPES, default='mixed')
+    parser.add_argument('--change-ratio', type=float, default=0.05)
+    parser.add_argument('--add-ratio', type=float, default=0.01)
+    parser.add_argument('--remove-ratio', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sep', default=',')
+    args = parser.parse_args()
+
+    spec = Spec(rows=args.rows, columns=args.columns, key_columns=args.key_columns,
+                key_width=args.key_width, value_type=args.value_type,
+                change_ratio=args.change_ratio, add_ratio=args.add_ratio,
+                remove_ratio=args.remove_ratio, seed=args.seed)
+    generate_files(spec, args.from_file, args.to_file, sep=args.sep)
+
+
+if __name__ == '__main__':
+    main()
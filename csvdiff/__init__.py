@@ -5,13 +5,11 @@
 #  csvdiff
 #
 
+from types import ModuleType
+from typing import List, TextIO
 import sys
-from typing.io import TextIO
-import io
 
-import click
-
-from . import records, patch, error
+from . import records, patch
 
 
 __author__ = 'Lars Yencken'
@@ -25,17 +23,198 @@ EXIT_DIFFERENT = 1
 EXIT_ERROR = 2
 
 
-def diff_files(from_file, to_file, index_columns, sep=',', ignored_columns=None):
+def diff_files(from_file, to_file, index_columns, sep=',', ignored_columns=None,
+               intern=None, engine='python', types=None):
     """
     Diff two CSV files, returning the patch which transforms one into the
     other.
+
+    To save memory on files with many repeated values, intern can be a list
+    of columns whose equal values should share one string object, or "auto"
+    to choose low-cardinality columns automatically.
+
+    To compare numeric columns as numbers, types can map columns to "int" or
+    "float", or be "auto" to infer them from the first rows. The patch then
+    holds typed values, and records the types in its "_types" section.
+
+    For large, mostly numeric files, engine='numpy' uses the columnar engine
+    instead, which needs NumPy installed.
+    """
+    if engine == 'numpy':
+        if types or intern:
+            raise ValueError("the numpy engine doesn't support types or intern")
+
+        from . import columnar
+        return columnar.diff_files(from_file, to_file, index_columns, sep=sep,
+                                   ignored_columns=ignored_columns)
+
+    if engine != 'python':
+        raise ValueError('unknown engine {0}'.format(engine))
+
+    typer = records.make_typer(types, exclude=index_columns)
+    from_indexed, to_indexed = _index_files(from_file, to_file, index_columns, sep=sep,
+                                            ignored_columns=ignored_columns, intern=intern,
+                                            typer=typer)
+    return _typed(patch.create_indexed(from_indexed, to_indexed, index_columns), typer)
+
+
+def _index_files(from_file, to_file, index_columns, sep=',', ignored_columns=None,
+                 intern=None, typer=None):
+    """
+    Load and index both files at once, so that slow reads can overlap. If a
+    column inferred to be numeric turns out not to be, both are read again
+    with it as text.
+    """
+    while True:
+        try:
+            return _index_pair(from_file, to_file, index_columns, sep=sep,
+                               ignored_columns=ignored_columns, intern=intern, typer=typer)
+
+        except records.TypeGuessError:
+            if '-' in (from_file, to_file):
+                # stdin can't be read again
+                raise
+
+
+def _index_pair(from_file, to_file, index_columns, sep=',', ignored_columns=None,
+                intern=None, typer=None):
+    import concurrent.futures
+
+    # both sides share the interned values, and the column types
+    interner = records.make_interner(intern)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        from_future = pool.submit(_index_file, from_file, index_columns, sep=sep,
+                                  ignored_columns=ignored_columns, interner=interner,
+                                  typer=typer)
+        to_future = pool.submit(_index_file, to_file, index_columns, sep=sep,
+                                ignored_columns=ignored_columns, interner=interner,
+                                typer=typer)
+        return from_future.result(), to_future.result()
+
+
+def _index_file(filename, index_columns, sep=',', ignored_columns=None, interner=None,
+                typer=None):
+    with records.open_csv(filename) as istream:
+        return patch.index_records(records.load(istream, sep=sep, interner=interner,
+                                                typer=typer),
+                                   index_columns, ignored_columns)
+
+
+def _typed(diff, typer):
+    "Record the column types in the patch, if any were typed."
+    if typer is not None and typer.types:
+        diff['_types'] = dict(typer.types)
+
+    return diff
+
+
+def diff_files_many(from_file, to_files, index_columns, sep=',', ignored_columns=None,
+                    jobs=1, intern=None, types=None):
+    """
+    Diff one baseline CSV file against many others, yielding a (to_file,
+    patch) pair for each in turn. The baseline is only loaded and indexed
+    once, and is shared with any parallel workers.
+    """
+    for result in _map_baseline(_diff_against_baseline, from_file, to_files,
+                                index_columns, sep=sep, ignored_columns=ignored_columns,
+                                jobs=jobs, intern=intern, types=types):
+        yield result
+
+
+def _load_baseline(from_file, index_columns, sep=',', ignored_columns=None, intern=None,
+                   typer=None):
+    while True:
+        try:
+            return _index_file(from_file, index_columns, sep=sep,
+                               ignored_columns=ignored_columns,
+                               interner=records.make_interner(intern), typer=typer)
+
+        except records.TypeGuessError:
+            if from_file == '-':
+                raise
+
+
+def _diff_against_baseline(from_indexed, to_file, index_columns, sep=',',
+                           ignored_columns=None, intern=None, types=None):
+    typer = records.make_typer(types, exclude=index_columns)
+    to_indexed = _index_file(to_file, index_columns, sep=sep,
+                             ignored_columns=ignored_columns,
+                             interner=records.make_interner(intern), typer=typer)
+    return to_file, _typed(patch.create_indexed(from_indexed, to_indexed, index_columns),
+                           typer)
+
+
+# the baseline shared with worker processes, which inherit it when forked
+_baseline = None
+
+
+def _map_baseline(func, from_file, to_files, index_columns, jobs=1, **kwargs):
+    """
+    Call func(from_indexed, to_file, index_columns, **kwargs) for each target
+    file, with up to jobs calls running at once, yielding the results in order.
+    """
+    global _baseline
+
+    typer = records.make_typer(kwargs.get('types'), exclude=index_columns)
+    from_indexed = _load_baseline(from_file, index_columns, sep=kwargs.get('sep', ','),
+                                  ignored_columns=kwargs.get('ignored_columns'),
+                                  intern=kwargs.get('intern'), typer=typer)
+    if typer is not None:
+        # each target starts from the baseline's types, and can still widen
+        # inferred ones
+        kwargs['types'] = typer
+
+    if jobs == 1 or len(to_files) < 2:
+        for to_file in to_files:
+            yield _call_retyped(func, from_file, from_indexed, to_file, index_columns, kwargs)
+        return
+
+    import multiprocessing
+    import multiprocessing.pool
+
+    _baseline = (func, from_file, from_indexed, index_columns, kwargs)
+    try:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # forked workers share the baseline's memory copy-on-write
+            pool = multiprocessing.get_context('fork').Pool(jobs)
+        else:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+
+        with pool:
+            for result in pool.imap(_call_with_baseline, to_files):
+                yield result
+
+    finally:
+        _baseline = None
+
+
+def _call_with_baseline(to_file):
+    func, from_file, from_indexed, index_columns, kwargs = _baseline
+    return _call_retyped(func, from_file, from_indexed, to_file, index_columns, kwargs)
+
+
+def _call_retyped(func, from_file, from_indexed, to_file, index_columns, kwargs):
     """
-    with open(from_file) as from_stream:
-        with open(to_file) as to_stream:
-            from_records = records.load(from_stream, sep=sep)
-            to_records = records.load(to_stream, sep=sep)
-            return patch.create(from_records, to_records, index_columns,
-                                ignore_columns=ignored_columns)
+    Call func for one target. If the target shows that a column inferred to
+    be numeric isn't, the baseline is read again with that column as text,
+    just for this target.
+    """
+    while True:
+        try:
+            return func(from_indexed, to_file, index_columns, **kwargs)
+
+        except records.TypeGuessError as e:
+            typer = kwargs.get('types')
+            if not isinstance(typer, records.Typer) or '-' in (from_file, to_file):
+                raise
+            column = e.column
+
+        typer = typer.copy(without=[column])
+        kwargs = dict(kwargs, types=typer)
+        from_indexed = _load_baseline(from_file, index_columns, sep=kwargs.get('sep', ','),
+                                      ignored_columns=kwargs.get('ignored_columns'),
+                                      intern=kwargs.get('intern'), typer=typer.copy())
 
 
 def diff_records(from_records, to_records, index_columns):
@@ -46,30 +225,83 @@ def diff_records(from_records, to_records, index_columns):
     return patch.create(from_records, to_records, index_columns)
 
 
+def iter_diff_records(from_records, to_records, index_columns, buffer_size=patch.BUFFER_SIZE):
+    """
+    Diff two sequences of dictionary records like diff_records(), but yield
+    each change as it's found instead of assembling a patch. Changes are
+    (kind, key, payload) tuples, where kind is "added", "removed" or
+    "changed", and the payload is the whole row, or for changed rows its
+    field changes as in a patch. The diff runs ahead of the consumer by at
+    most buffer_size changes.
+    """
+    return patch.stream(from_records, to_records, index_columns, buffer_size=buffer_size)
+
+
 def patch_file(patch_stream: TextIO, fromcsv_stream: TextIO, tocsv_stream: TextIO,
                strict: bool = True, sep: str = ','):
     """
     Apply the patch to the source CSV file, and save the result to the target
     file.
     """
-    diff = patch.load(patch_stream)
+    patch_file_many([patch_stream], fromcsv_stream, tocsv_stream, strict=strict, sep=sep)
+
+
+def patch_file_many(patch_streams: List[TextIO], fromcsv_stream: TextIO,
+                    tocsv_stream: TextIO, strict: bool = True, sep: str = ','):
+    """
+    Apply a series of patches in order to the source CSV file, reading and
+    writing the CSV only once, and save the result to the target file. The
+    columns of typed patches are parsed as the patches say, but cells the
+    patches leave alone keep their original text.
+    """
+    diffs = [patch.load(s) for s in patch_streams]
 
-    from_records = records.load(fromcsv_stream, sep=sep)
-    to_records = patch.apply(diff, from_records, strict=strict)
+    types = {}
+    for diff in diffs:
+        types.update(diff.get('_types', {}))
+
+    reader = records.load(fromcsv_stream, sep=sep)
+    from_records = list(reader)
+    typer = records.make_typer(types)
+    if typer is not None:
+        source = from_records
+        from_records = [r for _, r in typer.type_rows(
+            (lineno, dict(r)) for lineno, r in enumerate(source, 2)
+        )]
+
+    to_records = patch.apply_many(diffs, from_records, strict=strict)
+    if typer is not None:
+        _restore_text(to_records, source, from_records, diffs[-1]['_index'], typer.types)
 
     # what order should the columns be in?
     if to_records:
         # have data, use a nice ordering
         all_columns = to_records[0].keys()
-        index_columns = diff['_index']
+        index_columns = diffs[-1]['_index']
         fieldnames = _nice_fieldnames(all_columns, index_columns)
     else:
         # no data, use the original order
-        fieldnames = from_records.fieldnames
+        fieldnames = reader.fieldnames
 
     records.save(to_records, fieldnames, tocsv_stream)
 
 
+def _restore_text(to_records, source, typed, index_columns, types):
+    """
+    Write back the source text of typed cells whose values the patches left
+    the same, so that "1.50" doesn't become "1.5" in rows they never touched.
+    """
+    by_key = {tuple(r.get(c) for c in index_columns): i for i, r in enumerate(typed)}
+    for r in to_records:
+        i = by_key.get(tuple(r.get(c) for c in index_columns))
+        if i is None:
+            continue
+
+        for c in types:
+            if c in r and c in typed[i] and r[c] == typed[i][c]:
+                r[c] = source[i][c]
+
+
 def patch_records(diff, from_records, strict=True):
     """
     Apply the patch to the sequence of records, returning the transformed
@@ -84,116 +316,6 @@ def _nice_fieldnames(all_columns, index_columns):
     return index_columns + sorted(non_index_columns)
 
 
-class CSVType(click.ParamType):
-    name = 'csv'
-
-    def convert(self, value, param, ctx):
-        if isinstance(value, bytes):
-            try:
-                enc = getattr(sys.stdin, 'encoding', None)
-                if enc is not None:
-                    value = value.decode(enc)
-            except UnicodeError:
-                try:
-                    value = value.decode(sys.getfilesystemencoding())
-                except UnicodeError:
-                    value = value.decode('utf-8', 'replace')
-            return value.split(',')
-
-        return value.split(',')
-
-    def __repr__(self):
-        return 'CSV'
-
-
-@click.command()
-@click.argument('index_columns', type=CSVType())
-@click.argument('from_csv', type=click.Path(exists=True))
-@click.argument('to_csv', type=click.Path(exists=True))
-@click.option('--style',
-              type=click.Choice(['compact', 'pretty', 'summary']),
-              default='compact',
-              help=('Instead of the default compact output, pretty-print '
-                    'or give a summary instead'))
-@click.option('--output', '-o', type=click.Path(),
-              help='Output to a file instead of stdout')
-@click.option('--quiet', '-q', is_flag=True,
-              help="Don't output anything, just use exit codes")
-@click.option('--sep', default=',',
-              help='Separator to use between fields [default: comma]')
-@click.option('--ignore-columns', '-i', type=CSVType(),
-              help='a comma seperated list of columns to ignore from the comparison')
-@click.option('--significance', type=int,
-              help='Ignore numeric changes less than this number of significant figures')
-def csvdiff_cmd(index_columns, from_csv, to_csv, style=None, output=None,
-                sep=',', quiet=False, ignore_columns=None, significance=None):
-    """
-    Compare two csv files to see what rows differ between them. The files
-    are each expected to have a header row, and for each row to be uniquely
-    identified by one or more indexing columns.
-    """
-
-    if ignore_columns is not None:
-        for i in ignore_columns:
-            if i in index_columns:
-                error.abort("You can't ignore an index column")
-
-    ostream = (open(output, 'w') if output
-               else io.StringIO() if quiet
-               else sys.stdout)
-
-    try:
-        if style == 'summary':
-            _diff_and_summarize(from_csv, to_csv, index_columns, ostream,
-                                sep=sep, ignored_columns=ignore_columns,
-                                significance=significance)
-        else:
-            compact = (style == 'compact')
-            _diff_files_to_stream(from_csv, to_csv, index_columns, ostream,
-                                  compact=compact, sep=sep, ignored_columns=ignore_columns,
-                                  significance=significance)
-
-    except records.InvalidKeyError as e:
-        error.abort(e.args[0])
-
-    finally:
-        ostream.close()
-
-
-def _diff_files_to_stream(from_csv, to_csv, index_columns, ostream,
-                          compact=False, sep=',', ignored_columns=None,
-                          significance=None):
-    diff = diff_files(from_csv, to_csv, index_columns, sep=sep, ignored_columns=ignored_columns)
-
-    if significance is not None:
-        diff = patch.filter_significance(diff, significance)
-
-    patch.save(diff, ostream, compact=compact)
-    exit_code = (EXIT_SAME
-                 if patch.is_empty(diff)
-                 else EXIT_DIFFERENT)
-    sys.exit(exit_code)
-
-
-def _diff_and_summarize(from_csv, to_csv, index_columns, stream=sys.stdout,
-                        sep=',', ignored_columns=None, significance=None):
-    """
-    Print a summary of the difference between the two files.
-    """
-    from_records = list(records.load(from_csv, sep=sep))
-    to_records = records.load(to_csv, sep=sep)
-
-    diff = patch.create(from_records, to_records, index_columns, ignored_columns)
-    if significance is not None:
-        diff = patch.filter_significance(diff, significance)
-
-    _summarize_diff(diff, len(from_records), stream=stream)
-    exit_code = (EXIT_SAME
-                 if patch.is_empty(diff)
-                 else EXIT_DIFFERENT)
-    sys.exit(exit_code)
-
-
 def _summarize_diff(diff, orig_size, stream=sys.stdout):
     if orig_size == 0:
         # slightly arbitrary when the original data was empty
@@ -203,7 +325,7 @@ def _summarize_diff(diff, orig_size, stream=sys.stdout):
     n_added = len(diff['added'])
     n_changed = len(diff['changed'])
 
-    if n_removed or n_added or n_changed:
+    if not patch.is_empty(diff):
         print(u'%d rows removed (%.01f%%)' % (
             n_removed, 100 * n_removed / orig_size
         ), file=stream)
@@ -213,38 +335,25 @@ def _summarize_diff(diff, orig_size, stream=sys.stdout):
         print(u'%d rows changed (%.01f%%)' % (
             n_changed, 100 * n_changed / orig_size
         ), file=stream)
+        columns = diff.get('_columns')
+        if columns:
+            print(u'%d columns removed, %d columns added' % (
+                len(columns['removed']), len(columns['added'])
+            ), file=stream)
     else:
         print(u'files are identical', file=stream)
 
 
-@click.command()
-@click.argument('input_csv', type=click.Path(exists=True))
-@click.option('--input', '-i', type=click.Path(exists=True),
-              help='Read the JSON patch from the given file.')
-@click.option('--output', '-o', type=click.Path(),
-              help='Write the transformed CSV to the given file.')
-@click.option('--strict/--no-strict', default=True,
-              help='Whether or not to tolerate a changed source document '
-                   '(default: strict)')
-def csvpatch_cmd(input_csv, input=None, output=None, strict=True):
-    """
-    Apply the changes from a csvdiff patch to an existing CSV file.
-    """
-    patch_stream = (sys.stdin
-                    if input is None
-                    else open(input))
-    tocsv_stream = (sys.stdout
-                    if output is None
-                    else open(output, 'w'))
-    fromcsv_stream = open(input_csv)
+class _Package(ModuleType):
+    # the command-line interface is loaded on demand, since click is slow to
+    # import and most library users never need it; a module-level __getattr__
+    # would do, but needs Python 3.7
+    def __getattr__(self, name):
+        if name in ('csvdiff_cmd', 'csvpatch_cmd'):
+            from . import cli
+            return getattr(cli, name)
 
-    try:
-        patch_file(patch_stream, fromcsv_stream, tocsv_stream, strict=strict)
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
 
-    except patch.InvalidPatchError as e:
-        error.abort('reading patch, {0}'.format(e.args[0]))
 
-    finally:
-        patch_stream.close()
-        fromcsv_stream.close()
-        tocsv_stream.close()
+sys.modules[__name__].__class__ = _Package
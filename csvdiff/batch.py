@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+#  batch.py
+#  csvdiff
+#
+
+"""
+Running many diffs from a manifest in one process tree.
+
+A manifest has one JSON object per line, describing a diff to run:
+
+    {"index": ["id"], "from": "a.csv", "to": "b.csv", "output": "diff.json"}
+
+Entries may also set "style" (compact, pretty or summary), "sep",
+"ignore_columns", "significance", "intern", "types", "digest_removed" and
+"delta_columns", with the same meanings as the matching csvdiff options.
+Relative paths are relative to the manifest.
+"""
+
+from typing import Any, Dict, Iterator, List, TextIO
+import json
+import os
+import time
+
+from . import (EXIT_SAME, EXIT_DIFFERENT, EXIT_ERROR, error, patch, records, _index_files,
+               _summarize_diff, _typed)
+
+
+Entry = Dict[str, Any]
+Result = Dict[str, Any]
+
+STYLES = ('compact', 'pretty', 'summary')
+
+
+class InvalidManifestError(Exception):
+    pass
+
+
+def load_manifest(istream: TextIO, base_dir: str = '.') -> List[Entry]:
+    "Read the entries from a manifest, resolving paths against base_dir."
+    entries = []
+    for lineno, line in enumerate(istream, 1):
+        if not line.strip():
+            continue
+
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise InvalidManifestError('line {0} is not valid JSON'.format(lineno))
+
+        if not isinstance(entry, dict):
+            raise InvalidManifestError('line {0} is not a JSON object'.format(lineno))
+
+        entry['line'] = lineno
+        for k in ('from', 'to', 'output'):
+            if isinstance(entry.get(k), str):
+                entry[k] = os.path.join(base_dir, entry[k])
+
+        entries.append(entry)
+
+    return entries
+
+
+def run(entries: List[Entry], jobs: int = 1) -> Iterator[Result]:
+    """
+    Run the diff for each entry, with up to jobs running at once in worker
+    processes, yielding a result record for each in manifest order.
+    """
+    if jobs == 1 or len(entries) < 2:
+        for entry in entries:
+            yield run_entry(entry)
+        return
+
+    import multiprocessing
+
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap(run_entry, entries):
+            yield result
+
+
+def run_entry(entry: Entry) -> Result:
+    """
+    Run a single diff, never raising but recording any error in the result,
+    including errors from badly formed entries or unreadable files.
+    """
+    result = {
+        'line': entry.get('line'),
+        'from': entry.get('from'),
+        'to': entry.get('to'),
+        'output': entry.get('output'),
+        'error': None,
+    }  # type: Result
+
+    start = time.perf_counter()
+    try:
+        result['exit_code'] = _run_entry(entry)
+
+    except (_EntryError, records.InvalidKeyError, error.FatalError, OSError, ValueError,
+            TypeError) as e:
+        # ValueError also covers files which aren't valid UTF-8
+        result['exit_code'] = EXIT_ERROR
+        result['error'] = str(e.args[0] if len(e.args) == 1 else e)
+
+    result['seconds'] = time.perf_counter() - start
+    result['status'] = {EXIT_SAME: 'same', EXIT_DIFFERENT: 'different'}.get(
+        result['exit_code'], 'error'
+    )
+    return result
+
+
+class _EntryError(Exception):
+    pass
+
+
+def _run_entry(entry: Entry) -> int:
+    for k in ('index', 'from', 'to', 'output'):
+        if not entry.get(k):
+            raise _EntryError('missing "{0}"'.format(k))
+
+    for k in ('from', 'to', 'output'):
+        if not isinstance(entry[k], str):
+            raise _EntryError('"{0}" should be a filename'.format(k))
+
+    index_columns = _columns(entry, 'index')
+    ignore_columns = _columns(entry, 'ignore_columns')
+    if ignore_columns and set(ignore_columns).intersection(index_columns):
+        raise _EntryError("can't ignore an index column")
+
+    style = entry.get('style', 'compact')
+    if style not in STYLES:
+        raise _EntryError('unknown style {0}'.format(style))
+
+    sep = entry.get('sep', ',')
+    if not isinstance(sep, str) or len(sep) != 1:
+        raise _EntryError('"sep" should be a single character')
+
+    significance = entry.get('significance')
+    if significance is not None and (not isinstance(significance, int) or
+                                     isinstance(significance, bool)):
+        raise _EntryError('"significance" should be an integer')
+
+    intern = entry.get('intern')
+    if intern != 'auto':
+        intern = _columns(entry, 'intern')
+
+    types = entry.get('types')
+    if types != 'auto' and not isinstance(types, dict):
+        types = _columns(entry, 'types')
+    try:
+        typer = records.make_typer(types, exclude=index_columns)
+    except ValueError as e:
+        raise _EntryError(e.args[0])
+
+    from_indexed, to_indexed = _index_files(entry['from'], entry['to'], index_columns,
+                                            sep=sep, ignored_columns=ignore_columns,
+                                            intern=intern, typer=typer)
+    diff = _typed(patch.create_indexed(from_indexed, to_indexed, index_columns), typer)
+
+    if significance is not None:
+        diff = patch.filter_significance(diff, significance)
+
+    if entry.get('digest_removed'):
+        diff = patch.digest_removed(diff)
+
+    delta_columns = _columns(entry, 'delta_columns')
+    if delta_columns:
+        diff = patch.encode_deltas(diff, delta_columns)
+
+    with open(entry['output'], 'w') as ostream:
+        if style == 'summary':
+            _summarize_diff(diff, len(from_indexed), stream=ostream)
+        else:
+            patch.save(diff, ostream, compact=(style == 'compact'))
+
+    return EXIT_SAME if patch.is_empty(diff) else EXIT_DIFFERENT
+
+
+def _columns(entry: Entry, k: str) -> List[str]:
+    "A list of columns, which the entry may also give as a comma-separated string."
+    value = entry.get(k)
+    if value is None:
+        return []
+
+    if isinstance(value, list) and all(isinstance(c, str) for c in value):
+        return value
+
+    if isinstance(value, str):
+        return value.split(',')
+
+    raise _EntryError('"{0}" should be a list of columns'.format(k))
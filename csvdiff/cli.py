@@ -0,0 +1,1333 @@
+# -*- coding: utf-8 -*-
+#
+#  cli.py
+#  csvdiff
+#
+
+"""
+The csvdiff and csvpatch commands.
+"""
+
+import sys
+from contextlib import contextmanager
+import csv
+import io
+import json
+import os
+
+import click
+
+from . import records, patch, error, stats
+from . import (EXIT_SAME, EXIT_DIFFERENT, __version__, diff_files, patch_file_many, _index_file,
+               _index_files, _map_baseline, _diff_against_baseline, _summarize_diff)
+
+
+class CSVType(click.ParamType):
+    name = 'csv'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, bytes):
+            try:
+                enc = getattr(sys.stdin, 'encoding', None)
+                if enc is not None:
+                    value = value.decode(enc)
+            except UnicodeError:
+                try:
+                    value = value.decode(sys.getfilesystemencoding())
+                except UnicodeError:
+                    value = value.decode('utf-8', 'replace')
+            return value.split(',')
+
+        return value.split(',')
+
+    def __repr__(self):
+        return 'CSV'
+
+
+class InputPath(click.Path):
+    "An existing file, or - for stdin."
+    def convert(self, value, param, ctx):
+        # handled here, since click.Path only takes allow_dash from click 6
+        if value == '-':
+            return value
+
+        return super(InputPath, self).convert(value, param, ctx)
+
+
+class DefaultGroup(click.Group):
+    """
+    A group of subcommands which falls back to a default subcommand when the
+    first argument isn't one of them, so that the original command lines keep
+    working. The group's own help and version options are left to the group,
+    and default_if can say when arguments naming a subcommand are still meant
+    for the default one.
+    """
+    # options for the group itself rather than the default subcommand
+    GROUP_OPTIONS = ('-h', '--help', '--version')
+
+    def __init__(self, *args, **kwargs):
+        self.default_command = kwargs.pop('default_command')
+        self.default_if = kwargs.pop('default_if', None)
+        super(DefaultGroup, self).__init__(*args, **kwargs)
+
+    def parse_args(self, ctx, args):
+        if not args:
+            args = [self.default_command]
+
+        elif args[0] in self.commands:
+            if self.default_if is not None and self.default_if(args):
+                args = [self.default_command] + list(args)
+
+        elif args[0] not in self.GROUP_OPTIONS:
+            args = [self.default_command] + list(args)
+
+        return super(DefaultGroup, self).parse_args(ctx, args)
+
+    def invoke(self, ctx):
+        # the library raises errors rather than exiting, leaving the exit
+        # code to the command line
+        try:
+            return super(DefaultGroup, self).invoke(ctx)
+
+        except error.FatalError as e:
+            if error.DEBUG:
+                raise
+            error.abort(e.args[0])
+
+
+def _names_index_column(args):
+    """
+    Whether a command line starting with a subcommand's name is really an
+    original one, diffing on an index column of that name, as in "csvdiff
+    tail a.csv b.csv" for files with a "tail" column.
+    """
+    if len(args) < 3 or not os.path.isfile(args[1]):
+        return False
+
+    sep = ','
+    for i, arg in enumerate(args):
+        if arg == '--sep' and i + 1 < len(args):
+            sep = args[i + 1]
+        elif arg.startswith('--sep='):
+            sep = arg[len('--sep='):]
+
+    try:
+        with open(args[1], newline='') as istream:
+            header = next(csv.reader(istream, delimiter=sep), [])
+    except (OSError, UnicodeError, TypeError, csv.Error):
+        return False
+
+    return args[0] in header
+
+
+@click.group(cls=DefaultGroup, default_command='diff', default_if=_names_index_column,
+             context_settings={'help_option_names': ['-h', '--help']})
+@click.version_option(version=__version__)
+def csvdiff_cmd():
+    """
+    Compare CSV files, or a CSV file and a SQLite table, or run a batch of
+    comparisons, or compare large files by their hash trees or in shards.
+
+    Without a subcommand, "csvdiff INDEX FROM TO" is short for "csvdiff diff
+    INDEX FROM TO". An index column named like a subcommand is still taken
+    as one when FROM has a column of that name, but "csvdiff diff" always
+    diffs.
+    """
+
+
+@csvdiff_cmd.command('diff')
+@click.argument('index_columns', type=CSVType())
+@click.argument('from_csv', type=InputPath(exists=True))
+@click.argument('to_csvs', metavar='TO_CSV...', type=InputPath(exists=True),
+                nargs=-1, required=True)
+@click.option('--style',
+              type=click.Choice(['compact', 'pretty', 'summary']),
+              default='compact',
+              help=('Instead of the default compact output, pretty-print '
+                    'or give a summary instead'))
+@click.option('--format', 'output_format',
+              type=click.Choice(['json', 'csv', 'csv-sections']), default='json',
+              help=('Write a JSON patch, a CSV table of changes, or a CSV table per '
+                    'kind of change into --output-dir [default: json]'))
+@click.option('--output', '-o', type=click.Path(),
+              help='Output to a file instead of stdout')
+@click.option('--output-dir', type=click.Path(file_okay=False),
+              help='Write one output per target file into this directory')
+@click.option('--digest-removed', is_flag=True,
+              help=('Keep just the key and a digest of each removed row, for '
+                    'smaller patches which can still be applied'))
+@click.option('--delta-columns', type=CSVType(),
+              help=('Write changes to these text columns as edits to the old value, '
+                    'for smaller patches of large values'))
+@click.option('--key-index', is_flag=True,
+              help=('Also write OUTPUT.idx, indexing the patch by key for '
+                    '"csvpatch lookup"'))
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Diff this many target files in parallel [default: 1]')
+@click.option('--quiet', '-q', is_flag=True,
+              help="Don't output anything, just use exit codes")
+@click.option('--sep', default=',',
+              help='Separator to use between fields [default: comma]')
+@click.option('--ignore-columns', '-i', type=CSVType(),
+              help='a comma seperated list of columns to ignore from the comparison')
+@click.option('--significance', type=int,
+              help='Ignore numeric changes less than this number of significant figures')
+@click.option('--intern', type=CSVType(),
+              help=('Share repeated values in these columns to save memory, or '
+                    '"auto" to choose low-cardinality columns'))
+@click.option('--types', type=CSVType(),
+              help=('Compare these columns as numbers, given as column:int or '
+                    'column:float, or "auto" to infer them from the first rows'))
+@click.option('--engine', type=click.Choice(['python', 'numpy']), default='python',
+              help=('Diff with the columnar NumPy engine, faster on large numeric '
+                    'files [default: python]'))
+@click.option('--stats', 'show_stats', is_flag=True,
+              help='Print a per-phase timing and memory breakdown to stderr')
+@click.option('--stats-file', type=click.Path(),
+              help='Write the per-phase breakdown as JSON to the given file')
+@click.option('--progress', 'progress_format', type=click.Choice(['text', 'json']),
+              help='Report progress on stderr, for people or for machines')
+def csvdiff_diff_cmd(index_columns, from_csv, to_csvs, style=None, output_format='json',
+                     output=None, output_dir=None, digest_removed=False, delta_columns=None,
+                     key_index=False, jobs=1, sep=',', quiet=False,
+                     ignore_columns=None,
+                     significance=None, intern=None, types=None, engine='python',
+                     show_stats=False,
+                     stats_file=None, progress_format=None):
+    """
+    Compare two csv files to see what rows differ between them. The files
+    are each expected to have a header row, and for each row to be uniquely
+    identified by one or more indexing columns. Either file may be "-" to
+    read it from stdin.
+
+    Given several files to compare against, the first file is loaded once
+    and diffed against each of the others in turn, writing one output per
+    file into --output-dir.
+
+    See also "csvdiff sqlite" for comparing against a SQLite table, and
+    "csvdiff batch" for running many comparisons at once.
+    """
+    if [from_csv].count('-') + list(to_csvs).count('-') > 1:
+        error.abort('Only one file can be read from stdin')
+
+    if intern == ['auto']:
+        intern = 'auto'
+
+    if types == ['auto']:
+        types = 'auto'
+    elif types is not None:
+        try:
+            types = records.parse_types(types)
+        except ValueError as e:
+            error.abort(e.args[0])
+
+    if output_format != 'json' and style == 'summary':
+        error.abort('A summary can only be written as text')
+
+    sections = (output_format == 'csv-sections')
+    if sections and (len(to_csvs) > 1 or output_dir is None):
+        error.abort('Writing CSV sections needs one file to compare and an --output-dir')
+
+    if digest_removed and output_format != 'json':
+        error.abort('Digests of removed rows can only be written in JSON patches')
+
+    if delta_columns and output_format != 'json':
+        error.abort('Edits to changed values can only be written in JSON patches')
+
+    if key_index and (output is None or output_format != 'json' or style == 'summary'):
+        error.abort('A key index needs a JSON patch written to an --output file')
+
+    if engine == 'numpy' and (len(to_csvs) > 1 or (output_dir is not None and not sections)):
+        error.abort('The numpy engine compares just one pair of files')
+
+    if engine == 'numpy' and types is not None:
+        error.abort('The numpy engine works out column types itself')
+
+    if engine == 'numpy' and intern is not None:
+        error.abort('The numpy engine keeps columns in arrays, so has nothing to intern')
+
+    with _instrument(show_stats, stats_file, progress_format):
+        if len(to_csvs) == 1 and (output_dir is None or sections):
+            _csvdiff(index_columns, from_csv, to_csvs[0], style=style,
+                     output_format=output_format, output=output, output_dir=output_dir,
+                     sep=sep, quiet=quiet, ignore_columns=ignore_columns,
+                     significance=significance, intern=intern, types=types, engine=engine,
+                     digest_removed=digest_removed, delta_columns=delta_columns,
+                     key_index=key_index)
+        else:
+            _csvdiff_many(index_columns, from_csv, to_csvs, output_dir, output=output,
+                          style=style, output_format=output_format, sep=sep, quiet=quiet,
+                          ignore_columns=ignore_columns, significance=significance,
+                          jobs=jobs, intern=intern, types=types,
+                          digest_removed=digest_removed, delta_columns=delta_columns)
+
+
+def _csvdiff(index_columns, from_csv, to_csv, style=None, output_format='json', output=None,
+             output_dir=None, sep=',', quiet=False, ignore_columns=None, significance=None,
+             intern=None, types=None, engine='python', digest_removed=False,
+             delta_columns=None, key_index=False):
+
+    if ignore_columns is not None:
+        for i in ignore_columns:
+            if i in index_columns:
+                error.abort("You can't ignore an index column")
+
+    ostream = (open(output, 'w', newline='' if output_format != 'json' else None) if output
+               else io.StringIO() if quiet
+               else sys.stdout)
+
+    index_file = None
+    if key_index:
+        from . import lookup
+        index_file = lookup.index_path(output)
+
+    try:
+        if output_format != 'json':
+            _diff_files_to_csv(from_csv, to_csv, index_columns, ostream,
+                               sections_dir=(output_dir if output_format == 'csv-sections'
+                                             else None),
+                               sep=sep, ignored_columns=ignore_columns,
+                               significance=significance, intern=intern, types=types,
+                               engine=engine)
+        elif engine == 'numpy':
+            diff, from_table, _ = _diff_columnar(from_csv, to_csv, index_columns, sep=sep,
+                                                 ignored_columns=ignore_columns,
+                                                 significance=significance)
+            if digest_removed:
+                diff = patch.digest_removed(diff)
+            if delta_columns:
+                diff = patch.encode_deltas(diff, delta_columns)
+            _write_diff(diff, ostream, style=style, orig_size=len(from_table),
+                        index_file=index_file)
+        elif style == 'summary':
+            _diff_and_summarize(from_csv, to_csv, index_columns, ostream,
+                                sep=sep, ignored_columns=ignore_columns,
+                                significance=significance, intern=intern, types=types)
+        else:
+            compact = (style == 'compact')
+            _diff_files_to_stream(from_csv, to_csv, index_columns, ostream,
+                                  compact=compact, sep=sep, ignored_columns=ignore_columns,
+                                  significance=significance, intern=intern, types=types,
+                                  digest_removed=digest_removed, delta_columns=delta_columns,
+                                  index_file=index_file)
+
+    except records.InvalidKeyError as e:
+        error.abort(e.args[0])
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+
+def _csvdiff_many(index_columns, from_csv, to_csvs, output_dir, output=None,
+                  style='compact', output_format='json', sep=',', quiet=False,
+                  ignore_columns=None, significance=None, jobs=1, intern=None,
+                  types=None, digest_removed=False, delta_columns=None):
+    if output is not None:
+        error.abort('Use --output-dir instead of --output with several files')
+
+    if output_dir is None and not quiet:
+        error.abort('Diffing against several files needs an --output-dir')
+
+    if ignore_columns is not None:
+        for i in ignore_columns:
+            if i in index_columns:
+                error.abort("You can't ignore an index column")
+
+    names = [_output_name(to_csv, style, output_format) for to_csv in to_csvs]
+    if len(set(names)) < len(names):
+        error.abort('Each file to compare against needs a distinct name')
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    exit_code = EXIT_SAME
+    try:
+        results = _map_baseline(_diff_target_to_dir, from_csv, to_csvs, index_columns,
+                                jobs=jobs, sep=sep, ignored_columns=ignore_columns,
+                                output_dir=output_dir, style=style,
+                                output_format=output_format, significance=significance,
+                                intern=intern, types=types, digest_removed=digest_removed,
+                                delta_columns=delta_columns)
+        for is_different in results:
+            if is_different:
+                exit_code = EXIT_DIFFERENT
+
+    except records.InvalidKeyError as e:
+        error.abort(e.args[0])
+
+    sys.exit(exit_code)
+
+
+def _diff_target_to_dir(from_indexed, to_csv, index_columns, sep=',', ignored_columns=None,
+                        output_dir=None, style='compact', output_format='json',
+                        significance=None, intern=None, types=None, digest_removed=False,
+                        delta_columns=None):
+    "Diff one target against the baseline, returning whether they differ."
+    if output_format == 'csv':
+        return _diff_target_to_csv(from_indexed, to_csv, index_columns, sep=sep,
+                                   ignored_columns=ignored_columns, output_dir=output_dir,
+                                   significance=significance, intern=intern, types=types)
+
+    _, diff = _diff_against_baseline(from_indexed, to_csv, index_columns, sep=sep,
+                                     ignored_columns=ignored_columns, intern=intern,
+                                     types=types)
+
+    if significance is not None:
+        diff = patch.filter_significance(diff, significance)
+
+    if digest_removed:
+        diff = patch.digest_removed(diff)
+
+    if delta_columns:
+        diff = patch.encode_deltas(diff, delta_columns)
+
+    if output_dir is not None:
+        filename = os.path.join(output_dir, _output_name(to_csv, style))
+        with open(filename, 'w') as ostream:
+            if style == 'summary':
+                _summarize_diff(diff, len(from_indexed), stream=ostream)
+            else:
+                patch.save(diff, ostream, compact=(style == 'compact'))
+
+    return not patch.is_empty(diff)
+
+
+def _diff_target_to_csv(from_indexed, to_csv, index_columns, sep=',', ignored_columns=None,
+                        output_dir=None, significance=None, intern=None, types=None):
+    from . import export
+
+    to_indexed = _index_file(to_csv, index_columns, sep=sep, ignored_columns=ignored_columns,
+                             interner=records.make_interner(intern),
+                             typer=records.make_typer(types))
+    changes = export.iter_changes(from_indexed, to_indexed, index_columns)
+    if significance is not None:
+        changes = export.filter_significance(changes, significance)
+
+    if output_dir is None:
+        return any(True for _ in changes)
+
+    filename = os.path.join(output_dir, _output_name(to_csv, 'compact', 'csv'))
+    with open(filename, 'w', newline='') as ostream:
+        n = export.write_csv(changes, index_columns, _columns(from_indexed, to_indexed),
+                             ostream)
+
+    return n > 0
+
+
+def _output_name(to_csv, style, output_format='json'):
+    base, _ = os.path.splitext(os.path.basename(to_csv))
+    if output_format == 'csv':
+        return base + '.csv'
+
+    return base + ('.txt' if style == 'summary' else '.json')
+
+
+def _columns(from_indexed, to_indexed):
+    "The columns of either of the diffed files, as seen in their first rows."
+    return patch.align(from_indexed, to_indexed).columns
+
+
+def _diff_files_to_stream(from_csv, to_csv, index_columns, ostream,
+                          compact=False, sep=',', ignored_columns=None,
+                          significance=None, intern=None, types=None, digest_removed=False,
+                          delta_columns=None, index_file=None):
+    diff = diff_files(from_csv, to_csv, index_columns, sep=sep, ignored_columns=ignored_columns,
+                      intern=intern, types=types)
+
+    if significance is not None:
+        diff = patch.filter_significance(diff, significance)
+
+    if digest_removed:
+        diff = patch.digest_removed(diff)
+
+    if delta_columns:
+        diff = patch.encode_deltas(diff, delta_columns)
+
+    patch.save(diff, ostream, compact=compact, index_file=index_file)
+    exit_code = (EXIT_SAME
+                 if patch.is_empty(diff)
+                 else EXIT_DIFFERENT)
+    sys.exit(exit_code)
+
+
+def _diff_and_summarize(from_csv, to_csv, index_columns, stream=sys.stdout,
+                        sep=',', ignored_columns=None, significance=None, intern=None,
+                        types=None):
+    """
+    Print a summary of the difference between the two files.
+    """
+    from_indexed, to_indexed = _index_files(from_csv, to_csv, index_columns, sep=sep,
+                                            ignored_columns=ignored_columns, intern=intern,
+                                            typer=records.make_typer(types,
+                                                                     exclude=index_columns))
+
+    diff = patch.create_indexed(from_indexed, to_indexed, index_columns)
+    if significance is not None:
+        diff = patch.filter_significance(diff, significance)
+
+    _summarize_diff(diff, len(from_indexed), stream=stream)
+    exit_code = (EXIT_SAME
+                 if patch.is_empty(diff)
+                 else EXIT_DIFFERENT)
+    sys.exit(exit_code)
+
+
+def _diff_files_to_csv(from_csv, to_csv, index_columns, ostream, sections_dir=None,
+                       sep=',', ignored_columns=None, significance=None, intern=None,
+                       types=None, engine='python'):
+    "Write the changes as CSV as they are found, rather than as a patch."
+    from . import export
+
+    if engine == 'numpy':
+        diff, from_table, to_table = _diff_columnar(from_csv, to_csv, index_columns,
+                                                    sep=sep, ignored_columns=ignored_columns,
+                                                    significance=significance)
+        changes = export.iter_patch_changes(diff)
+        columns = patch.Alignment(
+            [c for c in from_table.columns if c not in (ignored_columns or [])],
+            [c for c in to_table.columns if c not in (ignored_columns or [])],
+        ).columns
+
+    else:
+        from_indexed, to_indexed = _index_files(from_csv, to_csv, index_columns, sep=sep,
+                                                ignored_columns=ignored_columns,
+                                                intern=intern,
+                                                typer=records.make_typer(
+                                                    types, exclude=index_columns))
+        changes = export.iter_changes(from_indexed, to_indexed, index_columns)
+        if significance is not None:
+            changes = export.filter_significance(changes, significance)
+        columns = _columns(from_indexed, to_indexed)
+
+    with stats.phase('write') as p:
+        if sections_dir is not None:
+            p.rows = export.write_sections(changes, index_columns, columns, sections_dir)
+        else:
+            p.rows = export.write_csv(changes, index_columns, columns, ostream)
+
+    sys.exit(EXIT_DIFFERENT if p.rows else EXIT_SAME)
+
+
+def _diff_columnar(from_csv, to_csv, index_columns, sep=',', ignored_columns=None,
+                   significance=None):
+    "Diff two files with the numpy engine, returning the patch and both tables."
+    try:
+        from . import columnar
+    except ImportError:
+        error.abort('The numpy engine needs NumPy: pip install csvdiff[numpy]')
+
+    with records.open_csv(from_csv) as istream:
+        from_table = columnar.load(istream, sep=sep)
+    with records.open_csv(to_csv) as istream:
+        to_table = columnar.load(istream, sep=sep)
+
+    diff = columnar.create(from_table, to_table, index_columns, ignored_columns,
+                           significance=significance)
+    return diff, from_table, to_table
+
+
+@csvdiff_cmd.command('sqlite')
+@click.argument('index_columns', type=CSVType())
+@click.argument('csv_file', type=click.Path(exists=True))
+@click.argument('database', type=click.Path(exists=True, dir_okay=False))
+@click.option('--table', help='Compare against this table')
+@click.option('--query', help='Compare against the results of this query')
+@click.option('--table-side', type=click.Choice(['from', 'to']), default='to',
+              help='Whether the table holds the original or the changed data '
+                   '[default: to]')
+@click.option('--batched', is_flag=True,
+              help='Stream the CSV file and look up its keys in the table in '
+                   'batches, instead of loading the whole table into memory')
+@click.option('--batch-size', type=int, default=500,
+              help='How many keys to look up at once in batched mode [default: 500]')
+@click.option('--style',
+              type=click.Choice(['compact', 'pretty', 'summary']),
+              default='compact',
+              help=('Instead of the default compact output, pretty-print '
+                    'or give a summary instead'))
+@click.option('--output', '-o', type=click.Path(),
+              help='Output to a file instead of stdout')
+@click.option('--quiet', '-q', is_flag=True,
+              help="Don't output anything, just use exit codes")
+@click.option('--sep', default=',',
+              help='Separator to use between fields [default: comma]')
+@click.option('--ignore-columns', '-i', type=CSVType(),
+              help='a comma seperated list of columns to ignore from the comparison')
+@click.option('--significance', type=int,
+              help='Ignore numeric changes less than this number of significant figures')
+def csvdiff_sqlite_cmd(index_columns, csv_file, database, table=None, query=None,
+                       table_side='to', batched=False, batch_size=500, style='compact',
+                       output=None, quiet=False, sep=',', ignore_columns=None,
+                       significance=None):
+    """
+    Compare a CSV file against a table or query in a SQLite database. By
+    default the table holds the changed data; use --table-side=from if it
+    holds the original data instead. Values from the database are compared as
+    text, with NULL as the empty string.
+
+    In --batched mode, the table should have an index on the key columns.
+    """
+    import sqlite3
+    from . import sqlite as sqlite_source
+
+    if (table is None) == (query is None):
+        error.abort('Give exactly one of --table or --query')
+
+    if ignore_columns is not None:
+        for i in ignore_columns:
+            if i in index_columns:
+                error.abort("You can't ignore an index column")
+
+    ostream = (open(output, 'w') if output
+               else io.StringIO() if quiet
+               else sys.stdout)
+
+    try:
+        with open(csv_file) as istream:
+            csv_records = _CountedRecords(records.load(istream, sep=sep))
+            if batched:
+                diff = sqlite_source.diff_table(csv_records, database, index_columns,
+                                                table=table, query=query,
+                                                table_side=table_side,
+                                                ignore_columns=ignore_columns,
+                                                batch_size=batch_size)
+            else:
+                table_records = sqlite_source.load(database, table=table, query=query)
+                if table_side == 'to':
+                    diff = patch.create(csv_records, table_records, index_columns,
+                                        ignore_columns)
+                else:
+                    diff = patch.create(table_records, csv_records, index_columns,
+                                        ignore_columns)
+
+        orig_size = (csv_records.count
+                     if table_side == 'to'
+                     else sqlite_source.count(database, table=table, query=query))
+        _write_diff(diff, ostream, style=style, orig_size=orig_size,
+                    significance=significance)
+
+    except records.InvalidKeyError as e:
+        error.abort(e.args[0])
+
+    except sqlite3.Error as e:
+        error.abort('reading database, {0}'.format(e))
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+
+class _CountedRecords:
+    "Counts records as they stream past."
+    def __init__(self, recs):
+        self.recs = recs
+        self.count = 0
+
+    def __iter__(self):
+        for r in self.recs:
+            self.count += 1
+            yield r
+
+
+def _write_diff(diff, ostream, style='compact', orig_size=0, significance=None,
+                index_file=None):
+    "Write the diff or its summary to the stream, then exit with a matching code."
+    if significance is not None:
+        diff = patch.filter_significance(diff, significance)
+
+    if style == 'summary':
+        _summarize_diff(diff, orig_size, stream=ostream)
+    else:
+        patch.save(diff, ostream, compact=(style == 'compact'), index_file=index_file)
+
+    exit_code = (EXIT_SAME
+                 if patch.is_empty(diff)
+                 else EXIT_DIFFERENT)
+    sys.exit(exit_code)
+
+
+@csvdiff_cmd.command('batch')
+@click.argument('manifest', type=InputPath(exists=True, dir_okay=False))
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Run this many diffs in parallel [default: 1]')
+@click.option('--results', '-r', type=click.Path(),
+              help='Write the result records to a file instead of stdout')
+def csvdiff_batch_cmd(manifest, jobs=1, results=None):
+    """
+    Run many diffs described by a manifest, with one JSON object per line:
+
+    \b
+    {"index": ["id"], "from": "a.csv", "to": "b.csv", "output": "diff.json"}
+
+    Entries may also give a "style", "sep", "ignore_columns" or
+    "significance". A JSON result record with the exit status and timing of
+    each diff is written per entry. Exits with 2 if any diff failed, 1 if any
+    files differ, and 0 otherwise.
+    """
+    from . import batch
+
+    if manifest == '-':
+        base_dir = '.'
+        istream = sys.stdin
+    else:
+        base_dir = os.path.dirname(manifest)
+        istream = open(manifest)
+
+    try:
+        entries = batch.load_manifest(istream, base_dir)
+
+    except batch.InvalidManifestError as e:
+        error.abort('reading manifest, {0}'.format(e.args[0]))
+
+    finally:
+        if istream is not sys.stdin:
+            istream.close()
+
+    ostream = sys.stdout if results is None else open(results, 'w')
+    exit_code = EXIT_SAME
+    try:
+        for result in batch.run(entries, jobs=jobs):
+            print(json.dumps(result, sort_keys=True), file=ostream)
+            ostream.flush()
+            exit_code = max(exit_code, result['exit_code'])
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+    sys.exit(exit_code)
+
+
+@csvdiff_cmd.command('shard')
+@click.argument('index_columns', type=CSVType())
+@click.argument('from_csv', type=click.Path(exists=True, dir_okay=False))
+@click.argument('to_csv', type=click.Path(exists=True, dir_okay=False))
+@click.option('--shards', '-n', type=int, required=True,
+              help='Split the files into this many shards')
+@click.option('--by', 'method', type=click.Choice(['hash', 'range']), default='hash',
+              help='Give rows to shards by a hash of their key, or by key ranges [default: hash]')
+@click.option('--output-dir', '-o', type=click.Path(file_okay=False), required=True,
+              help='Write the shards and their manifest into this directory')
+@click.option('--sep', default=',',
+              help='Separator to use between fields [default: comma]')
+def csvdiff_shard_cmd(index_columns, from_csv, to_csv, shards, method='hash',
+                      output_dir=None, sep=','):
+    """
+    Split two large files into shards by key, so that each shard can be
+    diffed on its own, on any machine. The shards are written into the output
+    directory along with manifest.jsonl, which "csvdiff batch" can run, one
+    entry per shard. Then "csvdiff merge" combines the shards' patches.
+    """
+    from . import shard
+
+    if shards < 1:
+        error.abort('Need at least one shard')
+
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        shard.plan(from_csv, to_csv, index_columns, shards, output_dir, method=method, sep=sep)
+
+    except records.InvalidKeyError as e:
+        error.abort(e.args[0])
+
+
+@csvdiff_cmd.command('merge')
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', type=click.Path(),
+              help='Write the merged patch to the given file.')
+@click.option('--style', type=click.Choice(['compact', 'pretty']), default='compact',
+              help='Instead of the default compact output, pretty-print')
+def csvdiff_merge_cmd(manifest, output=None, style='compact'):
+    """
+    Merge the patches for each shard in a manifest written by "csvdiff
+    shard" into the one patch which diffing the whole files would give.
+    Exits with 1 if there are any differences, and 0 otherwise.
+    """
+    from . import batch, shard
+
+    try:
+        with open(manifest) as istream:
+            entries = batch.load_manifest(istream, os.path.dirname(manifest))
+
+    except batch.InvalidManifestError as e:
+        error.abort('reading manifest, {0}'.format(e.args[0]))
+
+    for entry in entries:
+        if not os.path.exists(entry.get('output') or ''):
+            error.abort('No patch for the shard on line {0}, diff it first'.format(
+                entry['line']))
+
+    diffs = [_load_patch(entry['output']) for entry in entries]
+    try:
+        diff = shard.merge(diffs, columns=entries[0].get('columns') if entries else None)
+
+    except (ValueError, patch.InvalidPatchError) as e:
+        error.abort('merging patches, {0}'.format(e.args[0]))
+
+    _save_patch(diff, output, compact=(style == 'compact'))
+    sys.exit(EXIT_SAME if patch.is_empty(diff) else EXIT_DIFFERENT)
+
+
+@csvdiff_cmd.group('tree')
+def csvdiff_tree_cmd():
+    """
+    Compare large files using hash trees over blocks of their rows, reading
+    only the rows of blocks which differ. To compare files on two hosts, copy
+    one tree across, extract the rows it lacks, and copy those back to diff.
+    """
+
+
+@csvdiff_tree_cmd.command('build')
+@click.argument('index_columns', type=CSVType())
+@click.argument('csv_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', type=click.Path(),
+              help='Write the tree here [default: CSV_FILE.tree.json]')
+@click.option('--sep', default=',',
+              help='Separator to use between fields [default: comma]')
+@click.option('--block-bits', type=int, default=8,
+              help='Make blocks of 2**N rows on average [default: 8]')
+def csvdiff_tree_build_cmd(index_columns, csv_file, output=None, sep=',', block_bits=8):
+    """
+    Build the hash tree for a CSV file, saved alongside it by default. The
+    byte offsets of its rows go in a .offsets file next to the tree, which
+    only the host with the CSV file needs.
+    """
+    from . import merkle
+
+    try:
+        tree, offsets = merkle.build(csv_file, index_columns, sep=sep, block_bits=block_bits)
+
+    except records.InvalidKeyError as e:
+        error.abort(e.args[0])
+
+    output = output or merkle.sidecar_path(csv_file)
+    with open(output, 'w') as ostream:
+        merkle.save(tree, ostream)
+
+    with open(merkle.offsets_path(output), 'w') as ostream:
+        merkle.save_offsets(offsets, ostream)
+
+
+@csvdiff_tree_cmd.command('extract')
+@click.argument('csv_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('other_tree', type=click.Path(exists=True, dir_okay=False))
+@click.option('--tree', type=click.Path(exists=True, dir_okay=False),
+              help="The CSV file's tree [default: CSV_FILE.tree.json]")
+@click.option('--output', '-o', type=click.Path(),
+              help='Output to a file instead of stdout')
+def csvdiff_tree_extract_cmd(csv_file, other_tree, tree=None, output=None):
+    """
+    Write the rows of a CSV file which are in blocks the other tree doesn't
+    have, the only ones which can differ from the file it was built from.
+    """
+    from . import merkle
+
+    tree = tree or merkle.sidecar_path(csv_file)
+    own_tree = _load_tree(tree)
+    offsets = _load_offsets(tree)
+    other = _load_tree(other_tree)
+    try:
+        recs = list(merkle.extract(csv_file, own_tree, offsets, other))
+
+    except merkle.InvalidTreeError as e:
+        error.abort(e.args[0])
+
+    ostream = sys.stdout if output is None else open(output, 'w', newline='')
+    try:
+        records.save(recs, own_tree['columns'], ostream)
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+
+@csvdiff_tree_cmd.command('diff')
+@click.argument('from_csv', type=click.Path(exists=True, dir_okay=False))
+@click.argument('to_csv', type=click.Path(exists=True, dir_okay=False))
+@click.option('--from-tree', type=click.Path(exists=True, dir_okay=False),
+              help='The tree of the original file [default: FROM_CSV.tree.json]')
+@click.option('--to-tree', type=click.Path(exists=True, dir_okay=False),
+              help='The tree of the changed file [default: TO_CSV.tree.json]')
+@click.option('--from-extract', is_flag=True,
+              help='FROM_CSV holds just the rows extracted against the other tree')
+@click.option('--to-extract', is_flag=True,
+              help='TO_CSV holds just the rows extracted against the other tree')
+@click.option('--style',
+              type=click.Choice(['compact', 'pretty', 'summary']),
+              default='compact',
+              help=('Instead of the default compact output, pretty-print '
+                    'or give a summary instead'))
+@click.option('--output', '-o', type=click.Path(),
+              help='Output to a file instead of stdout')
+@click.option('--quiet', '-q', is_flag=True,
+              help="Don't output anything, just use exit codes")
+def csvdiff_tree_diff_cmd(from_csv, to_csv, from_tree=None, to_tree=None,
+                          from_extract=False, to_extract=False, style='compact',
+                          output=None, quiet=False):
+    """
+    Diff two CSV files by their hash trees, reading only the rows of blocks
+    whose hashes differ. The index columns are those the trees were built on.
+    """
+    from . import merkle
+
+    from_tree = from_tree or merkle.sidecar_path(from_csv)
+    to_tree = to_tree or merkle.sidecar_path(to_csv)
+    from_offsets = None if from_extract else _load_offsets(from_tree)
+    to_offsets = None if to_extract else _load_offsets(to_tree)
+    from_tree = _load_tree(from_tree)
+    to_tree = _load_tree(to_tree)
+
+    ostream = (open(output, 'w') if output
+               else io.StringIO() if quiet
+               else sys.stdout)
+    try:
+        diff = merkle.diff(from_csv, from_tree, to_csv, to_tree,
+                           from_offsets=from_offsets, to_offsets=to_offsets)
+        orig_size = sum(b['rows'] for b in from_tree['blocks'])
+        _write_diff(diff, ostream, style=style, orig_size=orig_size)
+
+    except (merkle.InvalidTreeError, records.InvalidKeyError) as e:
+        error.abort(e.args[0])
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+
+def _load_tree(filename):
+    "Load a hash tree, aborting if it's missing or invalid."
+    from . import merkle
+
+    try:
+        with open(filename) as istream:
+            return merkle.load(istream)
+
+    except OSError as e:
+        error.abort('reading tree, {0}'.format(e))
+
+    except merkle.InvalidTreeError as e:
+        error.abort('reading tree, {0}'.format(e.args[0]))
+
+
+def _load_offsets(tree_file):
+    "Load the row offsets kept next to a tree, aborting if they're missing."
+    from . import merkle
+
+    try:
+        with open(merkle.offsets_path(tree_file)) as istream:
+            return merkle.load_offsets(istream)
+
+    except OSError as e:
+        error.abort('reading row offsets, {0}'.format(e))
+
+    except merkle.InvalidTreeError as e:
+        error.abort('reading row offsets, {0}'.format(e.args[0]))
+
+
+@csvdiff_cmd.command('tail')
+@click.argument('index_columns', type=CSVType())
+@click.argument('csv_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--state', type=click.Path(dir_okay=False),
+              help='Keep the state between runs here [default: CSV_FILE.tail.json]')
+@click.option('--follow', '-f', is_flag=True,
+              help='Keep watching the file, writing a line of JSON for each '
+                   'patch until interrupted')
+@click.option('--interval', type=float, default=5.0,
+              help='How often to check the file when following, in seconds '
+                   '[default: 5]')
+@click.option('--style',
+              type=click.Choice(['compact', 'pretty', 'summary']),
+              default='compact',
+              help=('Instead of the default compact output, pretty-print '
+                    'or give a summary instead'))
+@click.option('--output', '-o', type=click.Path(),
+              help='Output to a file instead of stdout')
+@click.option('--quiet', '-q', is_flag=True,
+              help="Don't output anything, just use exit codes")
+@click.option('--sep', default=',',
+              help='Separator to use between fields [default: comma]')
+def csvdiff_tail_cmd(index_columns, csv_file, state=None, follow=False, interval=5.0,
+                     style='compact', output=None, quiet=False, sep=','):
+    """
+    Diff the rows appended to a growing CSV file since the last run, parsing
+    only the new bytes. Rows whose key was seen before show up as changed.
+    The first run only records where the file is up to. If the file has been
+    truncated or rewritten, the whole file is diffed against the digests of
+    the rows last seen, and following starts again from its new end.
+    """
+    import time
+    from . import tail
+
+    state_file = state or tail.state_path(csv_file)
+    ostream = (open(output, 'w') if output
+               else io.StringIO() if quiet
+               else sys.stdout)
+    try:
+        current = _load_tail_state(state_file) if os.path.exists(state_file) else None
+        if current is not None and current['index'] != index_columns:
+            error.abort('The state was recorded with index {0}'.format(
+                ','.join(current['index'])))
+
+        while True:
+            previous = current
+            orig_size = 0 if current is None else len(current['keys'])
+            try:
+                if current is None:
+                    current = tail.start(csv_file, index_columns, sep=sep)
+                    diff = patch.create_indexed({}, {}, index_columns)
+                else:
+                    diff, current = tail.update(csv_file, current)
+
+            except tail.FileRewrittenError:
+                print('The file was rewritten, diffing it again as a whole',
+                      file=sys.stderr)
+                diff, current = tail.restart(csv_file, current)
+
+            # nothing to save if nothing was appended
+            if current is not previous:
+                with open(state_file, 'w') as state_stream:
+                    tail.save(current, state_stream)
+
+            if not follow:
+                _write_diff(diff, ostream, style=style, orig_size=orig_size)
+
+            if not patch.is_empty(diff):
+                patch.save(diff, ostream, compact=True)
+                print(file=ostream)
+                ostream.flush()
+
+            time.sleep(interval)
+
+    except KeyboardInterrupt:
+        sys.exit(EXIT_SAME)
+
+    except records.InvalidKeyError as e:
+        error.abort(e.args[0])
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+
+def _load_tail_state(filename):
+    from . import tail
+
+    try:
+        with open(filename) as istream:
+            return tail.load(istream)
+
+    except tail.InvalidStateError as e:
+        error.abort('reading state, {0}'.format(e.args[0]))
+
+
+@csvdiff_cmd.command('serve')
+@click.option('--host', default='127.0.0.1',
+              help='Listen on this address [default: 127.0.0.1]')
+@click.option('--allow-remote', is_flag=True,
+              help='Allow listening on an address other hosts can reach')
+@click.option('--root', type=click.Path(exists=True, file_okay=False),
+              help=('Only diff files under this directory, which relative paths '
+                    'in requests start from [default: the current directory]'))
+@click.option('--port', type=int, default=8337,
+              help='Listen on this port [default: 8337]')
+@click.option('--socket', 'socket_path', type=click.Path(),
+              help='Listen on this Unix socket instead of a port')
+@click.option('--max-memory', type=int, default=1024,
+              help='Keep up to this many megabytes of baselines in memory '
+                   '[default: 1024]')
+@click.option('--verbose', '-v', is_flag=True,
+              help='Log each request to stderr')
+def csvdiff_serve_cmd(host='127.0.0.1', port=8337, allow_remote=False, root=None,
+                      socket_path=None, max_memory=1024, verbose=False):
+    """
+    Run a diff server which keeps baselines loaded between requests, so that
+    only the target file is read each time. Baselines are reloaded when they
+    change on disk. Send requests with "csvdiff client".
+
+    Anyone who can connect to the server can read the files it can, as the
+    user running it, through the diffs it sends back. So requests may only
+    name files under --root, the server listens on loopback addresses only
+    unless given --allow-remote, and a --socket can be kept private with
+    file permissions.
+    """
+    from . import daemon
+
+    cache = daemon.BaselineCache(max_memory * 2**20)
+    try:
+        server = daemon.make_server(cache, host=host, port=port, socket_path=socket_path,
+                                    root=root, allow_remote=allow_remote, verbose=verbose)
+    except ValueError as e:
+        error.abort('starting server, {0}; use --allow-remote to listen on it '
+                    'anyway'.format(e))
+    except OSError as e:
+        error.abort('starting server, {0}'.format(e))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+@csvdiff_cmd.command('client')
+@click.argument('index_columns', type=CSVType())
+@click.argument('from_csv', type=click.Path(exists=True, dir_okay=False))
+@click.argument('to_csv', type=click.Path(exists=True, dir_okay=False))
+@click.option('--host', default='127.0.0.1',
+              help='Connect to the server at this address [default: 127.0.0.1]')
+@click.option('--port', type=int, default=8337,
+              help='Connect to the server on this port [default: 8337]')
+@click.option('--socket', 'socket_path', type=click.Path(),
+              help='Connect to the server on this Unix socket instead')
+@click.option('--style',
+              type=click.Choice(['compact', 'pretty', 'summary']),
+              default='compact',
+              help=('Instead of the default compact output, pretty-print '
+                    'or give a summary instead'))
+@click.option('--output', '-o', type=click.Path(),
+              help='Output to a file instead of stdout')
+@click.option('--quiet', '-q', is_flag=True,
+              help="Don't output anything, just use exit codes")
+@click.option('--sep', default=',',
+              help='Separator to use between fields [default: comma]')
+@click.option('--ignore-columns', '-i', type=CSVType(),
+              help='a comma seperated list of columns to ignore from the comparison')
+@click.option('--significance', type=int,
+              help='Ignore numeric changes less than this number of significant figures')
+def csvdiff_client_cmd(index_columns, from_csv, to_csv, host='127.0.0.1', port=8337,
+                       socket_path=None, style='compact', output=None, quiet=False,
+                       sep=',', ignore_columns=None, significance=None):
+    """
+    Compare two CSV files using a running "csvdiff serve", which keeps
+    FROM_CSV loaded for next time.
+    """
+    from . import daemon
+
+    entry = {
+        'index': index_columns,
+        'from': os.path.abspath(from_csv),
+        'to': os.path.abspath(to_csv),
+        'style': style,
+        'sep': sep,
+        'ignore_columns': ignore_columns,
+        'significance': significance,
+    }
+    try:
+        code, status, body = daemon.request(entry, host=host, port=port,
+                                            socket_path=socket_path)
+    except OSError as e:
+        error.abort('contacting server, {0}'.format(e))
+
+    if code != 200:
+        error.abort(json.loads(body).get('error', body))
+
+    if not quiet:
+        if output:
+            with open(output, 'w') as ostream:
+                ostream.write(body)
+        else:
+            sys.stdout.write(body)
+
+    sys.exit(EXIT_SAME if status == 'same' else EXIT_DIFFERENT)
+
+
+@click.group(cls=DefaultGroup, default_command='apply',
+             context_settings={'help_option_names': ['-h', '--help']})
+@click.version_option(version=__version__)
+def csvpatch_cmd():
+    """
+    Apply, compose or invert csvdiff patches.
+
+    Without a subcommand, "csvpatch -i PATCH INPUT" is short for "csvpatch
+    apply -i PATCH INPUT"; use "csvpatch apply" for an input file named
+    like a subcommand.
+    """
+
+
+@csvpatch_cmd.command('apply')
+@click.argument('input_csv', type=click.Path(exists=True))
+@click.option('--input', '-i', 'inputs', type=click.Path(exists=True), multiple=True,
+              help=('Read the JSON patch from the given file. Repeat to apply '
+                    'several patches in order.'))
+@click.option('--output', '-o', type=click.Path(),
+              help='Write the transformed CSV to the given file.')
+@click.option('--strict/--no-strict', default=True,
+              help='Whether or not to tolerate a changed source document '
+                   '(default: strict)')
+@click.option('--stats', 'show_stats', is_flag=True,
+              help='Print a per-phase timing and memory breakdown to stderr')
+@click.option('--stats-file', type=click.Path(),
+              help='Write the per-phase breakdown as JSON to the given file')
+@click.option('--progress', 'progress_format', type=click.Choice(['text', 'json']),
+              help='Report progress on stderr, for people or for machines')
+def csvpatch_apply_cmd(input_csv, inputs=(), output=None, strict=True,
+                       show_stats=False, stats_file=None, progress_format=None):
+    """
+    Apply the changes from a csvdiff patch to an existing CSV file. Given
+    several patches, they are applied in order in a single pass over the
+    file.
+
+    See also "csvpatch compose" and "csvpatch invert" for working with
+    patches directly.
+    """
+    with _instrument(show_stats, stats_file, progress_format):
+        _csvpatch(input_csv, inputs=inputs, output=output, strict=strict)
+
+
+def _csvpatch(input_csv, inputs=(), output=None, strict=True):
+    patch_streams = ([open(i) for i in inputs]
+                     if inputs
+                     else [sys.stdin])
+    tocsv_stream = (sys.stdout
+                    if output is None
+                    else open(output, 'w'))
+    fromcsv_stream = open(input_csv)
+
+    try:
+        patch_file_many(patch_streams, fromcsv_stream, tocsv_stream, strict=strict)
+
+    except patch.InvalidPatchError as e:
+        error.abort('reading patch, {0}'.format(e.args[0]))
+
+    finally:
+        for patch_stream in patch_streams:
+            if patch_stream is not sys.stdin:
+                patch_stream.close()
+        fromcsv_stream.close()
+        if tocsv_stream is not sys.stdout:
+            tocsv_stream.close()
+
+
+@csvpatch_cmd.command('compose')
+@click.argument('patches', metavar='PATCH...', type=click.Path(exists=True), nargs=-1,
+                required=True)
+@click.option('--output', '-o', type=click.Path(),
+              help='Write the composed patch to the given file.')
+@click.option('--style', type=click.Choice(['compact', 'pretty']), default='compact',
+              help='Instead of the default compact output, pretty-print')
+@click.option('--strict/--no-strict', default=True,
+              help='Whether or not to tolerate patches which disagree about '
+                   'the rows they change (default: strict)')
+def csvpatch_compose_cmd(patches, output=None, style='compact', strict=True):
+    """
+    Combine several patches into one with the same effect as applying each of
+    them in turn.
+    """
+    diffs = [_load_patch(p) for p in patches]
+
+    try:
+        diff = patch.compose(*diffs, strict=strict)
+
+    except (patch.InvalidPatchError, patch.PatchConflictError) as e:
+        error.abort('composing patches, {0}'.format(e.args[0]))
+
+    _save_patch(diff, output, compact=(style == 'compact'))
+
+
+@csvpatch_cmd.command('invert')
+@click.option('--input', '-i', type=click.Path(exists=True),
+              help='Read the JSON patch from the given file.')
+@click.option('--output', '-o', type=click.Path(),
+              help='Write the inverted patch to the given file.')
+@click.option('--style', type=click.Choice(['compact', 'pretty']), default='compact',
+              help='Instead of the default compact output, pretty-print')
+def csvpatch_invert_cmd(input=None, output=None, style='compact'):
+    """
+    Reverse a patch, giving one which undoes its changes.
+    """
+    diff = _load_patch(input)
+    try:
+        inverted = patch.invert(diff)
+    except patch.InvalidPatchError as e:
+        error.abort('inverting patch, {0}'.format(e.args[0]))
+
+    _save_patch(inverted, output, compact=(style == 'compact'))
+
+
+@csvpatch_cmd.command('lookup')
+@click.argument('patch_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('key', type=CSVType())
+@click.option('--index', 'index_file', type=click.Path(exists=True, dir_okay=False),
+              help="The patch's key index [default: PATCH_FILE.idx]")
+@click.option('--scan', is_flag=True,
+              help='Load the whole patch instead of using its index')
+def csvpatch_lookup_cmd(patch_file, key, index_file=None, scan=False):
+    """
+    Show what a patch does to the row with the given key, a comma-separated
+    list of its index values. The patch's key index, written by "csvdiff
+    --key-index", is used to read just the matching entries. Exits with 0 if
+    the key was found, or 1 if not.
+    """
+    from . import lookup
+
+    if scan:
+        found = lookup.scan(_load_patch(patch_file), key)
+    else:
+        try:
+            found = lookup.lookup(patch_file, key, index_file=index_file)
+        except lookup.IndexMismatchError as e:
+            error.abort('{0}, use --scan to search without it'.format(e.args[0]))
+
+    print(json.dumps(found, sort_keys=True, indent=2))
+    sys.exit(0 if found else 1)
+
+
+def _load_patch(filename=None):
+    "Load a patch from the given file or stdin, aborting if it's invalid."
+    istream = sys.stdin if filename is None else open(filename)
+    try:
+        return patch.load(istream)
+
+    except patch.InvalidPatchError as e:
+        error.abort('reading patch, {0}'.format(e.args[0]))
+
+    finally:
+        if istream is not sys.stdin:
+            istream.close()
+
+
+def _save_patch(diff, filename=None, compact=False):
+    ostream = sys.stdout if filename is None else open(filename, 'w')
+    try:
+        patch.save(diff, ostream, compact=compact)
+
+    finally:
+        if ostream is not sys.stdout:
+            ostream.close()
+
+
+@contextmanager
+def _instrument(show_stats, stats_file, progress_format):
+    "Collect per-phase statistics and report progress while the block runs, if asked to."
+    hooks = []
+    if progress_format:
+        from . import progress
+        hooks.append(progress.ProgressReporter(progress_format))
+
+    collector = None
+    if show_stats or stats_file:
+        collector = stats.PhaseStats()
+        hooks.append(collector)
+
+    for hook in hooks:
+        stats.add_hook(hook)
+
+    try:
+        yield
+
+    finally:
+        for hook in hooks:
+            stats.remove_hook(hook)
+
+        if collector is not None:
+            if show_stats:
+                collector.report(sys.stderr)
+            if stats_file:
+                with open(stats_file, 'w') as ostream:
+                    collector.save(ostream)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#
+#  columnar.py
+#  csvdiff
+#
+
+"""
+A diff engine for large, mostly numeric files, using NumPy.
+
+Each side is loaded into one array per column. Rows are aligned by sorting
+their keys and searching one side's keys in the other's, and changed cells
+are found by comparing whole columns at once, so Python objects are only
+built for the rows which end up in the patch. The resulting patch is the same
+as the one patch.create() gives.
+
+NumPy is an optional dependency: install it with "pip install csvdiff[numpy]".
+"""
+
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+import csv
+
+import numpy as np
+
+from . import patch, records, stats
+
+
+class Table:
+    "The rows of a CSV file, held as one object array per column."
+    def __init__(self, columns: Dict[records.Column, np.ndarray]) -> None:
+        self.columns = columns
+
+    def __len__(self) -> int:
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    @classmethod
+    def from_records(cls, recs: List[records.Record]) -> 'Table':
+        "Build a table from records which all have the same columns."
+        columns = list(recs[0]) if recs else []
+        cells = np.empty((len(recs), len(columns)), dtype=object)
+        for i, r in enumerate(recs):
+            cells[i] = [r[c] for c in columns]
+
+        return cls({c: cells[:, j] for j, c in enumerate(columns)})
+
+
+# rows are read into blocks of this many at a time
+CHUNK_ROWS = 2**16
+
+
+def load(istream: TextIO, sep: str = ',') -> Table:
+    "Read a CSV file with a header row into columns."
+    with stats.phase('load') as p:
+        reader = csv.reader(istream, delimiter=sep)
+        header = next(reader, [])
+        width = len(header)
+
+        # filling preallocated blocks avoids keeping a list object per row
+        chunks = []
+        chunk = np.empty((CHUNK_ROWS, width), dtype=object)
+        n = 0
+        for lineno, row in enumerate(reader, 2):
+            if not row:
+                # blank lines, which csv.DictReader skips
+                continue
+
+            if len(row) > width:
+                raise records.CSVParseError('CSV parse error on line {}'.format(lineno),
+                                            line=lineno)
+
+            if n == CHUNK_ROWS:
+                chunks.append(chunk)
+                chunk = np.empty((CHUNK_ROWS, width), dtype=object)
+                n = 0
+
+            if len(row) == width:
+                chunk[n] = row
+            else:
+                # missing trailing fields, as csv.DictReader reads them
+                chunk[n, :len(row)] = row
+                chunk[n, len(row):] = None
+            n += 1
+
+        chunks.append(chunk[:n])
+        cells = np.concatenate(chunks)
+        p.rows = len(cells)
+
+    return Table({c: cells[:, j] for j, c in enumerate(header)})
+
+
+def diff_files(from_file: str, to_file: str, index_columns: List[str], sep: str = ',',
+               ignored_columns: Optional[List[str]] = None,
+               significance: Optional[int] = None) -> Dict[str, Any]:
+    "Diff two CSV files like csvdiff.diff_files(), with the columnar engine."
+    with records.open_csv(from_file) as istream:
+        from_table = load(istream, sep=sep)
+    with records.open_csv(to_file) as istream:
+        to_table = load(istream, sep=sep)
+
+    return create(from_table, to_table, index_columns, ignored_columns, significance)
+
+
+def create(from_table: Table, to_table: Table, index_columns: List[str],
+           ignore_columns: Optional[List[str]] = None,
+           significance: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Diff two tables. With significance, numeric changes smaller than that
+    many decimal places are ignored, as with patch.filter_significance().
+    """
+    if not index_columns:
+        raise records.InvalidKeyError('must provide on or more columns to index on')
+
+    for table in (from_table, to_table):
+        for c in index_columns:
+            if c not in table.columns:
+                raise records.InvalidKeyError("invalid column name '{0}' as key".format(c))
+
+    ignored = set(ignore_columns or [])
+    from_columns = [c for c in from_table.columns if c not in ignored]
+    to_columns = [c for c in to_table.columns if c not in ignored]
+    alignment = patch.Alignment(from_columns, to_columns)
+
+    with stats.phase('align') as p:
+        from_keys, to_keys = _keys(from_table, to_table, index_columns)
+        from_order = _unique_order(from_keys)
+        to_order = _unique_order(to_keys)
+        from_rows, to_rows, removed, added = _align(from_keys, from_order,
+                                                    to_keys, to_order)
+        p.rows = len(from_keys) + len(to_keys)
+
+    with stats.phase('compare_rows') as p:
+        value_columns = [c for c in alignment.shared if c not in index_columns]
+        changed_cells = {}
+        any_changed = np.zeros(len(from_rows), dtype=bool)
+        for c in value_columns:
+            lhs = from_table.columns[c][from_rows]
+            rhs = to_table.columns[c][to_rows]
+            cells = _changed_cells(lhs, rhs, significance)
+            if cells.any():
+                changed_cells[c] = cells
+                any_changed |= cells
+
+        # new columns start out empty in existing rows
+        for c in alignment.added:
+            cells = np.asarray(to_table.columns[c][to_rows] != patch.NEW_COLUMN_VALUE,
+                               dtype=bool)
+            if cells.any():
+                changed_cells[c] = cells
+                any_changed |= cells
+        p.rows = len(from_rows)
+
+    with stats.phase('assemble') as p:
+        changed = []
+        for i in np.flatnonzero(any_changed):
+            f, t = from_rows[i], to_rows[i]
+            changed.append({
+                'key': [to_table.columns[c][t] for c in index_columns],
+                'fields': {c: {'from': (from_table.columns[c][f]
+                                        if c in from_table.columns
+                                        else patch.NEW_COLUMN_VALUE),
+                               'to': to_table.columns[c][t]}
+                           for c, cells in changed_cells.items() if cells[i]},
+            })
+
+        diff = {
+            '_index': index_columns,
+            'added': records.sort(_rows(to_table, added, to_columns)),
+            'removed': records.sort(_rows(from_table, removed, from_columns)),
+            'changed': sorted(changed, key=patch._change_key),
+        }
+        if not alignment.same:
+            diff['_columns'] = alignment.as_dict()
+        p.rows = len(added) + len(removed) + len(changed)
+
+    return diff
+
+
+def _keys(from_table: Table, to_table: Table,
+          index_columns: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fixed-width key arrays for both sides, with the same dtype so that they
+    can be searched against each other. Composite keys become structured
+    arrays, which sort by each column in turn.
+    """
+    dtype = []
+    for c in index_columns:
+        width = max(_max_width(from_table.columns[c]), _max_width(to_table.columns[c]))
+        dtype.append((c, 'U{0}'.format(max(width, 1))))
+
+    def keys(table: Table) -> np.ndarray:
+        if len(index_columns) == 1:
+            return table.columns[index_columns[0]].astype(dtype[0][1])
+
+        k = np.empty(len(table), dtype=dtype)
+        for c in index_columns:
+            k[c] = table.columns[c]
+        return k
+
+    return keys(from_table), keys(to_table)
+
+
+def _max_width(values: np.ndarray) -> int:
+    return max((len(v) for v in values if v is not None), default=0)
+
+
+def _unique_order(keys: np.ndarray) -> np.ndarray:
+    "Row numbers in key order, keeping the last row for any repeated key."
+    order = np.argsort(keys, kind='stable')
+    s = keys[order]
+    last = np.ones(len(s), dtype=bool)
+    last[:-1] = s[1:] != s[:-1]
+    return order[last]
+
+
+def _align(from_keys: np.ndarray, from_order: np.ndarray,
+           to_keys: np.ndarray, to_order: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    Match up rows with the same key. Returns the row numbers of each matched
+    pair, then those of the rows only in the from side, then only in the to
+    side.
+    """
+    from_sorted = from_keys[from_order]
+    to_sorted = to_keys[to_order]
+
+    found = np.zeros(len(to_sorted), dtype=bool)
+    pos = np.searchsorted(from_sorted, to_sorted)
+    if len(from_sorted):
+        in_range = pos < len(from_sorted)
+        found[in_range] = from_sorted[pos[in_range]] == to_sorted[in_range]
+
+    matched = np.zeros(len(from_sorted), dtype=bool)
+    matched[pos[found]] = True
+
+    return (from_order[pos[found]], to_order[found],
+            from_order[~matched], to_order[~found])
+
+
+def _changed_cells(lhs: np.ndarray, rhs: np.ndarray,
+                   significance: Optional[int]) -> np.ndarray:
+    changed = np.asarray(lhs != rhs, dtype=bool)
+    if significance is None or not changed.any():
+        return changed
+
+    # only changed cells which are numeric on both sides can be insignificant
+    a, a_ok = _as_floats(lhs[changed])
+    b, b_ok = _as_floats(rhs[changed])
+    numeric = a_ok & b_ok
+    with np.errstate(invalid='ignore'):
+        significant = ~numeric | (np.abs(a - b) > 10 ** (-significance))
+
+    changed[changed] = significant
+    return changed
+
+
+def _as_floats(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    "Parse values as floats, along with a mask of which ones could be parsed."
+    try:
+        return values.astype(float), np.ones(len(values), dtype=bool)
+    except (TypeError, ValueError):
+        pass
+
+    floats = np.full(len(values), np.nan)
+    ok = np.zeros(len(values), dtype=bool)
+    for i, v in enumerate(values):
+        try:
+            floats[i] = float(v)
+            ok[i] = True
+        except (TypeError, ValueError):
+            pass
+
+    return floats, ok
+
+
+def _rows(table: Table, rows: np.ndarray, columns: List[str]) -> List[records.Record]:
+    return [{c: table.columns[c][i] for c in columns} for i in rows]
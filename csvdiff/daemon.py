@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+#
+#  daemon.py
+#  csvdiff
+#
+
+"""
+A long-running diff server, keeping indexed baselines in memory between
+requests so that only the target file is read each time.
+
+Requests are made over HTTP, on a localhost port or a Unix socket, by POSTing
+a JSON object to /diff:
+
+    {"index": ["id"], "from": "base.csv", "to": "today.csv"}
+
+Requests may also set "style" (compact, pretty or summary), "sep",
+"ignore_columns" and "significance", as for csvdiff. The response is the
+patch or summary, with the X-Csvdiff-Status header saying whether the files
+were the same or different. GET /stats describes the cached baselines.
+
+Baselines are kept in least-recently-used order up to a memory cap, and are
+reloaded when their file's size or modification time changes.
+
+Anyone who can reach the server can have it read files as the user running
+it, so requests may only name files under the server's root directory, and
+the server only listens on loopback addresses unless told otherwise.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple, cast
+import collections
+import http.client
+import http.server
+import io
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+from . import (EXIT_SAME, EXIT_DIFFERENT, error, patch, records, _index_file, _load_baseline,
+               _summarize_diff)
+
+
+Entry = Dict[str, Any]
+
+STYLES = ('compact', 'pretty', 'summary')
+
+DEFAULT_PORT = 8337
+
+# rows sampled when estimating how much memory a baseline takes
+SAMPLE_ROWS = 1000
+
+
+class InvalidRequestError(Exception):
+    pass
+
+
+class BaselineCache:
+    """
+    Indexed baselines, evicted least-recently-used first once together they
+    take more than max_bytes. A baseline too big to fit is never cached.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, filename: str, index_columns: list, sep: str = ',',
+            ignored_columns: Optional[list] = None) -> records.Index:
+        key = (os.path.abspath(filename), tuple(index_columns), sep,
+               tuple(ignored_columns or ()))
+        st = os.stat(filename)
+        version = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+
+        indexed = _load_baseline(filename, index_columns, sep=sep,
+                                 ignored_columns=ignored_columns)
+        size = estimate_size(indexed)
+
+        with self._lock:
+            self.misses += 1
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+
+            if size <= self.max_bytes:
+                self._entries[key] = (version, indexed, size)
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    _, (_, _, evicted) = self._entries.popitem(last=False)
+                    self.total_bytes -= evicted
+
+        return indexed
+
+    def describe(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'baselines': [{'file': k[0], 'index': list(k[1]), 'rows': len(v[1]),
+                               'bytes': v[2]}
+                              for k, v in self._entries.items()],
+            }
+
+
+def estimate_size(indexed: records.Index) -> int:
+    "Roughly how many bytes an index takes, scaled up from a sample of rows."
+    n = 0
+    size = 0
+    for k, r in indexed.items():
+        size += (sys.getsizeof(k) + sys.getsizeof(r) +
+                 sum(sys.getsizeof(v) for v in r.values()))
+        n += 1
+        if n == SAMPLE_ROWS:
+            break
+
+    if n == 0:
+        return sys.getsizeof(indexed)
+
+    return sys.getsizeof(indexed) + size * len(indexed) // n
+
+
+def handle(cache: BaselineCache, entry: Entry,
+           root: Optional[str] = None) -> Tuple[int, str]:
+    """
+    Run a diff request, giving its exit code and the response body. Given a
+    root directory, the request's files are relative to it and must be in it.
+    """
+    if not isinstance(entry, dict):
+        raise InvalidRequestError('request is not a JSON object')
+
+    for k in ('index', 'from', 'to'):
+        if not entry.get(k):
+            raise InvalidRequestError('missing "{0}"'.format(k))
+
+    for k in ('from', 'to'):
+        if not isinstance(entry[k], str):
+            raise InvalidRequestError('"{0}" should be a filename'.format(k))
+
+    from_file = _resolve(entry['from'], root, 'from')
+    to_file = _resolve(entry['to'], root, 'to')
+
+    index_columns = _columns(entry, 'index')
+    ignore_columns = _columns(entry, 'ignore_columns') or None
+    if ignore_columns and set(ignore_columns).intersection(index_columns):
+        raise InvalidRequestError("can't ignore an index column")
+
+    style = entry.get('style', 'compact')
+    if style not in STYLES:
+        raise InvalidRequestError('unknown style {0}'.format(style))
+
+    sep = entry.get('sep', ',')
+    if not isinstance(sep, str) or len(sep) != 1:
+        raise InvalidRequestError('"sep" should be a single character')
+
+    significance = entry.get('significance')
+    if significance is not None and (not isinstance(significance, int) or
+                                     isinstance(significance, bool)):
+        raise InvalidRequestError('"significance" should be an integer')
+
+    from_indexed = cache.get(from_file, index_columns, sep=sep,
+                             ignored_columns=ignore_columns)
+    to_indexed = _index_file(to_file, index_columns, sep=sep,
+                             ignored_columns=ignore_columns)
+    diff = patch.create_indexed(from_indexed, to_indexed, index_columns)
+
+    if significance is not None:
+        diff = patch.filter_significance(diff, significance)
+
+    ostream = io.StringIO()
+    if style == 'summary':
+        _summarize_diff(diff, len(from_indexed), stream=ostream)
+    else:
+        patch.save(diff, ostream, compact=(style == 'compact'))
+
+    return (EXIT_SAME if patch.is_empty(diff) else EXIT_DIFFERENT), ostream.getvalue()
+
+
+def _resolve(filename: str, root: Optional[str], k: str) -> str:
+    "The file a request names, refusing any outside the root directory."
+    if root is None:
+        return filename
+
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, filename))
+    if os.path.commonpath([root, resolved]) != root:
+        raise InvalidRequestError('"{0}" is outside the served directory'.format(k))
+
+    return resolved
+
+
+def is_loopback(host: str) -> bool:
+    "Whether listening on this address keeps the server to this machine."
+    if host == 'localhost':
+        return True
+
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _columns(entry: Entry, k: str) -> List[str]:
+    "A list of columns, which the request may also give as a comma-separated string."
+    value = entry.get(k)
+    if value is None:
+        return []
+
+    if isinstance(value, list) and all(isinstance(c, str) for c in value):
+        return value
+
+    if isinstance(value, str):
+        return value.split(',')
+
+    raise InvalidRequestError('"{0}" should be a list of columns'.format(k))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    @property
+    def diff_server(self) -> '_DiffServer':
+        return cast(_DiffServer, self.server)
+
+    def do_GET(self) -> None:
+        if self.path != '/stats':
+            self._respond(404, {'error': 'not found'})
+            return
+
+        self._respond(200, self.diff_server.cache.describe())
+
+    def do_POST(self) -> None:
+        if self.path != '/diff':
+            self._respond(404, {'error': 'not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            entry = json.loads(self.rfile.read(length).decode('utf8'))
+
+        except ValueError:
+            self._respond(400, {'error': 'request is not valid JSON'})
+            return
+
+        try:
+            exit_code, body = handle(self.diff_server.cache, entry, root=self.diff_server.root)
+
+        except (InvalidRequestError, records.InvalidKeyError, error.FatalError) as e:
+            self._respond(400, {'error': e.args[0]})
+
+        except (OSError, ValueError, TypeError) as e:
+            # ValueError also covers files which aren't valid UTF-8
+            self._respond(400, {'error': str(e)})
+
+        else:
+            status = 'same' if exit_code == EXIT_SAME else 'different'
+            self._respond(200, body, status=status)
+
+    def _respond(self, code: int, body: Any, status: Optional[str] = None) -> None:
+        if not isinstance(body, str):
+            body = json.dumps(body, sort_keys=True)
+
+        data = body.encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        if status is not None:
+            self.send_header('X-Csvdiff-Status', status)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # clients on a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.diff_server.verbose:
+            super(_Handler, self).log_message(format, *args)
+
+
+class _DiffServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Any, cache: BaselineCache, root: str,
+                 verbose: bool = False) -> None:
+        self.cache = cache
+        self.root = root
+        self.verbose = verbose
+        super(_DiffServer, self).__init__(address, _Handler)
+
+
+class _TCPServer(_DiffServer):
+    pass
+
+
+class _UnixServer(_DiffServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self) -> None:
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(cache: BaselineCache, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                socket_path: Optional[str] = None, root: Optional[str] = None,
+                allow_remote: bool = False, verbose: bool = False) -> Any:
+    """
+    A server for diff requests, listening on the Unix socket if one is given.
+    Requests may only name files under root, by default the current
+    directory. Only loopback hosts are allowed unless allow_remote is set.
+    """
+    root = os.path.abspath(root or os.getcwd())
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = _UnixServer(socket_path, cache, root, verbose=verbose)  # type: _DiffServer
+    else:
+        if not allow_remote and not is_loopback(host):
+            raise ValueError('{0} is not a loopback address'.format(host))
+        server = _TCPServer((host, port), cache, root, verbose=verbose)
+
+    return server
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None) -> None:
+        super(_UnixConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(entry: Entry, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+            socket_path: Optional[str] = None,
+            timeout: Optional[float] = None) -> Tuple[int, Optional[str], str]:
+    """
+    Send a diff request to a running server, giving the HTTP status, the
+    X-Csvdiff-Status header, and the response body.
+    """
+    conn = (_UnixConnection(socket_path, timeout=timeout) if socket_path is not None
+            else http.client.HTTPConnection(host, port, timeout=timeout))
+    try:
+        conn.request('POST', '/diff', body=json.dumps(entry).encode('utf8'),
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        body = response.read().decode('utf8')
+        return response.status, response.getheader('X-Csvdiff-Status'), body
+
+    finally:
+        conn.close()
@@ -12,6 +12,11 @@ DEBUG = False
 
 
 class FatalError(Exception):
+    """
+    An error the command-line reports and exits on. The library raises
+    subclasses of it rather than exiting, so that it can be used from
+    long-running processes.
+    """
     pass
 
 
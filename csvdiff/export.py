@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+#  export.py
+#  csvdiff
+#
+
+"""
+Writing diffs as CSV tables, for loaders which would rather not parse the
+JSON patch format.
+
+Changes are written out one row at a time as they are found, rather than
+assembled into a patch first. A single table has a "_change" column saying
+whether each row was added, removed or changed, then the index columns, then
+"<column>_from" and "<column>_to" for every other column. For changed rows,
+only the fields which changed are filled in.
+"""
+
+from typing import Any, Dict, Iterator, List, TextIO
+import csv
+import os
+
+from . import patch, records
+
+
+Change = patch.Change
+
+SECTIONS = ('added', 'removed', 'changed')
+
+
+def iter_changes(from_indexed: records.Index, to_indexed: records.Index,
+                 index_columns: List[str]) -> Iterator[Change]:
+    "Stream the changes between two indexes, in the order of their rows."
+    return patch.iter_changes(from_indexed, to_indexed, index_columns)
+
+
+def iter_patch_changes(diff: Dict[str, Any]) -> Iterator[Change]:
+    "The changes in an assembled patch."
+    index_columns = diff['_index']
+    for r in diff['removed']:
+        yield Change('removed', [r[c] for c in index_columns], r)
+    for r in diff['added']:
+        yield Change('added', [r[c] for c in index_columns], r)
+    for c in diff['changed']:
+        yield Change('changed', c['key'], c['fields'])
+
+
+def filter_significance(changes: Iterator[Change], significance: int) -> Iterator[Change]:
+    "Drop insignificant numeric changes, as patch.filter_significance() does."
+    for kind, key, payload in changes:
+        if kind == 'changed':
+            payload = {k: v for k, v in payload.items()
+                       if patch._is_significant(v, significance)}
+            if not payload:
+                continue
+
+        yield Change(kind, key, payload)
+
+
+def write_csv(changes: Iterator[Change], index_columns: List[str],
+              columns: List[str], ostream: TextIO) -> int:
+    """
+    Write the changes as a single table, returning how many rows were
+    written. The columns are those of both diffed files, in order.
+    """
+    value_columns = [c for c in columns if c not in index_columns]
+    writer = csv.writer(ostream)
+    writer.writerow(['_change'] + index_columns +
+                    [c + suffix for c in value_columns for suffix in ('_from', '_to')])
+
+    n = 0
+    for kind, key, payload in changes:
+        writer.writerow([kind] + key + _from_to(kind, payload, value_columns))
+        n += 1
+
+    return n
+
+
+def write_sections(changes: Iterator[Change], index_columns: List[str],
+                   columns: List[str], output_dir: str) -> int:
+    """
+    Write each kind of change to its own table in the output directory:
+    added.csv and removed.csv with the rows as they were, and changed.csv
+    with the index columns then "<column>_from" and "<column>_to" columns.
+    Returns how many rows were written in all.
+    """
+    value_columns = [c for c in columns if c not in index_columns]
+    os.makedirs(output_dir, exist_ok=True)
+
+    ostreams = {kind: open(os.path.join(output_dir, kind + '.csv'), 'w', newline='')
+                for kind in SECTIONS}
+    try:
+        writers = {kind: csv.writer(ostream) for kind, ostream in ostreams.items()}
+        writers['added'].writerow(columns)
+        writers['removed'].writerow(columns)
+        writers['changed'].writerow(
+            index_columns + [c + suffix for c in value_columns for suffix in ('_from', '_to')]
+        )
+
+        n = 0
+        for kind, key, payload in changes:
+            if kind == 'changed':
+                writers[kind].writerow(key + _from_to(kind, payload, value_columns))
+            else:
+                writers[kind].writerow([payload.get(c) for c in columns])
+            n += 1
+
+    finally:
+        for ostream in ostreams.values():
+            ostream.close()
+
+    return n
+
+
+def _from_to(kind: str, payload: Dict[str, Any], value_columns: List[str]) -> List[Any]:
+    row = []  # type: List[Any]
+    for c in value_columns:
+        if kind == 'added':
+            row += [None, payload.get(c)]
+        elif kind == 'removed':
+            row += [payload.get(c), None]
+        else:
+            change = payload.get(c)
+            row += [None, None] if change is None else [change['from'], change['to']]
+
+    return row
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+#  lookup.py
+#  csvdiff
+#
+
+"""
+Finding the entries for a key in a large patch without parsing all of it.
+
+When a patch is saved with an index file, the byte range of every entry in
+its added, removed and changed sections is recorded against the entry's key
+in a SQLite database. A lookup then reads and parses just those ranges. The
+patch itself is written exactly as patch.save() would write it without an
+index.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+import json
+import os
+import sqlite3
+
+
+# (section, key, start, end) for each entry in a patch
+Entry = Tuple[str, List[Any], int, int]
+
+SECTIONS = ('added', 'removed', 'changed')
+
+# how many entries to insert into the index at once
+BATCH_SIZE = 10000
+
+
+class IndexMismatchError(Exception):
+    "The index doesn't describe the patch as it is now."
+    pass
+
+
+def index_path(patch_path: str) -> str:
+    "Where the index for a patch is kept by default."
+    return patch_path + '.idx'
+
+
+def save(diff: Dict[str, Any], stream: TextIO, index_file: str,
+         compact: bool = False) -> None:
+    """
+    Write the patch to the stream as patch.save() does, and the byte range of
+    each entry to the index file, counting from where the patch starts.
+    """
+    conn = _create(index_file)
+    try:
+        entries = _Writer(diff, stream, compact)
+        batch = []  # type: List[Tuple[str, str, int, int]]
+        for section, key, start, end in entries:
+            batch.append((_key(key), section, start, end))
+            if len(batch) == BATCH_SIZE:
+                conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?)', batch)
+                batch = []
+        conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?)', batch)
+
+        conn.execute('INSERT INTO meta VALUES (?, ?)', ('size', entries.size))
+        conn.commit()
+
+    finally:
+        conn.close()
+
+
+def lookup(patch_file: str, key: List[Any],
+           index_file: Optional[str] = None) -> Dict[str, List[Any]]:
+    """
+    The entries for a key in each section of the patch, read using its index.
+    Sections without an entry for the key are left out.
+    """
+    index_file = index_file or index_path(patch_file)
+    if not os.path.exists(index_file):
+        raise IndexMismatchError('no index found at {0}'.format(index_file))
+
+    conn = sqlite3.connect(index_file)
+    try:
+        size, = conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()
+        if os.path.getsize(patch_file) != int(size):
+            raise IndexMismatchError('the patch has changed since it was indexed')
+
+        ranges = conn.execute('SELECT section, start, end FROM entries WHERE key = ? '
+                              'ORDER BY start', (_key(key),)).fetchall()
+
+    finally:
+        conn.close()
+
+    found = {}  # type: Dict[str, List[Any]]
+    with open(patch_file, 'rb') as istream:
+        for section, start, end in ranges:
+            istream.seek(start)
+            entry = istream.read(end - start).decode('utf8')
+            found.setdefault(section, []).append(json.loads(entry))
+
+    return found
+
+
+def scan(diff: Dict[str, Any], key: List[Any]) -> Dict[str, List[Any]]:
+    "The entries for a key in a loaded patch, like lookup() without an index."
+    found = {}  # type: Dict[str, List[Any]]
+    index_columns = diff['_index']
+    for section in SECTIONS:
+        for entry in diff.get(section, []):
+            entry_key = (entry['key'] if section == 'changed'
+                         else [entry.get(c) for c in index_columns])
+            if entry_key == key:
+                found.setdefault(section, []).append(entry)
+
+    return found
+
+
+def _create(index_file: str) -> sqlite3.Connection:
+    if os.path.exists(index_file):
+        os.unlink(index_file)
+
+    conn = sqlite3.connect(index_file)
+    conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE entries (key TEXT, section TEXT, start INTEGER, end INTEGER)')
+    conn.execute('CREATE INDEX entries_key ON entries (key)')
+    return conn
+
+
+def _key(key: List[Any]) -> str:
+    return json.dumps(key)
+
+
+class _Writer:
+    """
+    Write the patch piece by piece, yielding each entry's byte range as it
+    goes. The output is what json.dump() gives with sorted keys, and since
+    that escapes anything outside ASCII, characters and bytes line up.
+    """
+    def __init__(self, diff: Dict[str, Any], stream: TextIO, compact: bool) -> None:
+        self.diff = diff
+        self.stream = stream
+        self.compact = compact
+        self.size = 0
+
+    def __iter__(self) -> Iterator[Entry]:
+        indent = None if self.compact else 2
+        index_columns = self.diff['_index']
+
+        self._put('{' if self.compact else '{\n  ')
+        for i, (k, v) in enumerate(sorted(self.diff.items())):
+            if i:
+                self._put(', ' if self.compact else ',\n  ')
+            self._put(json.dumps(k) + ': ')
+
+            if k not in SECTIONS or not v:
+                self._put(_nested(json.dumps(v, sort_keys=True, indent=indent), 1))
+                continue
+
+            self._put('[' if self.compact else '[\n    ')
+            for j, entry in enumerate(v):
+                if j:
+                    self._put(', ' if self.compact else ',\n    ')
+                start = self.size
+                self._put(_nested(json.dumps(entry, sort_keys=True, indent=indent), 2))
+                key = (entry['key'] if k == 'changed'
+                       else [entry.get(c) for c in index_columns])
+                yield k, key, start, self.size
+            self._put(']' if self.compact else '\n  ]')
+
+        self._put('}' if self.compact else '\n}')
+
+    def _put(self, s: str) -> None:
+        self.stream.write(s)
+        self.size += len(s)
+
+
+def _nested(text: str, depth: int) -> str:
+    "Indent all but the first line of pretty-printed JSON to a nesting depth."
+    return text.replace('\n', '\n' + '  ' * depth)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+#
+#  merkle.py
+#  csvdiff
+#
+
+"""
+Hash trees over key-sorted blocks of a CSV file, for diffing large files
+without moving or parsing the parts which haven't changed.
+
+A tree is kept in a small JSON sidecar next to its file. Rows are sorted by
+key and cut into blocks where a key's hash has its low bits clear, so that
+inserting or removing a row only changes the block it falls in, not every
+block after it. The blocks are grouped into nodes the same way by their
+hashes, level by level up to a single root, and comparing two trees descends
+from the root into just the nodes whose hashes differ.
+
+Only hashes and key ranges go in the tree, so that it stays small enough to
+copy between hosts. The byte offsets of each block's rows, which let just
+those rows be read back, are kept in a separate file which stays with the
+CSV file.
+
+To compare files on different hosts, copy one side's tree to the other,
+extract the rows of the blocks that differ, and copy those back to diff.
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+import hashlib
+import json
+import os
+
+from . import patch, records, stats
+
+
+Tree = Dict[str, Any]
+Block = Dict[str, Any]
+Offsets = Dict[str, Any]
+
+# a node of the tree as (hash, first child, end of children), with the
+# children's positions in the level below
+Node = Tuple[str, int, int]
+
+VERSION = 2
+
+# blocks hold 2**BLOCK_BITS rows on average
+BLOCK_BITS = 8
+
+# nodes above the blocks have 2**FANOUT_BITS children on average
+FANOUT_BITS = 4
+
+
+def sidecar_path(filename: str) -> str:
+    "Where the tree for a file is kept by default."
+    return filename + '.tree.json'
+
+
+def offsets_path(tree_path: str) -> str:
+    "Where the row offsets are kept for the tree saved here."
+    base, ext = os.path.splitext(tree_path)
+    return (base if ext == '.json' else tree_path) + '.offsets'
+
+
+def build(filename: str, index_columns: List[str], sep: str = ',',
+          block_bits: int = BLOCK_BITS) -> Tuple[Tree, Offsets]:
+    """
+    Build the hash tree for a CSV file, along with the byte offsets of its
+    rows in the order of the tree's blocks.
+    """
+    if not index_columns:
+        raise records.InvalidKeyError('must provide on or more columns to index on')
+
+    with stats.phase('hash_rows') as p:
+        with open(filename, 'rb') as istream:
+            size = os.fstat(istream.fileno()).st_size
+            rows = records.iter_offsets(istream, sep)
+            _, columns = next(rows, (0, []))
+
+            try:
+                positions = [columns.index(c) for c in index_columns]
+            except ValueError:
+                raise records.InvalidKeyError('invalid column name as key, must be one '
+                                              'of {0}'.format(', '.join(columns)))
+
+            # each key's row digest and byte offset, keeping its last row
+            digest_row = _row_hasher(columns)
+            keyed = {}  # type: Dict[Tuple[str, ...], Tuple[bytes, int]]
+            for lineno, (offset, row) in enumerate(rows, 2):
+                row = records.pad_row(row, columns, 'on line {}'.format(lineno))
+                keyed[tuple(row[i] for i in positions)] = (digest_row(row), offset)
+        p.rows = len(keyed)
+
+    with stats.phase('build_tree') as p:
+        mask = (1 << block_bits) - 1
+        blocks = []  # type: List[Block]
+        offsets = []  # type: List[int]
+        current = []  # type: List[Tuple[Tuple[str, ...], bytes]]
+        for k in sorted(keyed):
+            digest, offset = keyed[k]
+            current.append((k, digest))
+            offsets.append(offset)
+            if _key_hash(k) & mask == 0:
+                blocks.append(_block(current))
+                current = []
+        if current:
+            blocks.append(_block(current))
+
+        levels = _levels([b['hash'] for b in blocks])
+        p.rows = len(blocks)
+
+    tree = {
+        'version': VERSION,
+        'index': index_columns,
+        'columns': columns,
+        'sep': sep,
+        'root': (levels[-1][0][0] if levels
+                 else blocks[0]['hash'] if blocks
+                 else _hash(b'')),
+        'blocks': blocks,
+        'levels': levels,
+    }
+    return tree, {'root': tree['root'], 'size': size, 'offsets': offsets}
+
+
+def save(tree: Tree, ostream: TextIO) -> None:
+    json.dump(tree, ostream, sort_keys=True)
+
+
+def load(istream: TextIO) -> Tree:
+    try:
+        tree = json.load(istream)
+    except ValueError:
+        raise InvalidTreeError('tree is not valid JSON')
+
+    if not isinstance(tree, dict) or tree.get('version') != VERSION:
+        raise InvalidTreeError('unsupported tree format')
+
+    return tree
+
+
+def save_offsets(offsets: Offsets, ostream: TextIO) -> None:
+    json.dump(offsets, ostream)
+
+
+def load_offsets(istream: TextIO) -> Offsets:
+    try:
+        return json.load(istream)
+    except ValueError:
+        raise InvalidTreeError('row offsets are not valid JSON')
+
+
+class InvalidTreeError(Exception):
+    pass
+
+
+def compare(from_tree: Tree, to_tree: Tree) -> Tuple[List[Block], List[Block]]:
+    """
+    Find the blocks of each tree which have no identical block in the other,
+    by descending from the roots into just the nodes without an identical
+    node at the same level of the other tree. Only rows in these blocks can
+    differ between the two files.
+    """
+    if from_tree['index'] != to_tree['index']:
+        raise InvalidTreeError('cannot compare trees with different indexes')
+
+    if from_tree['root'] == to_tree['root']:
+        return [], []
+
+    from_levels = _nodes(from_tree)
+    to_levels = _nodes(to_tree)
+
+    # start both sides at the height of the lower tree
+    from_nodes = _descend(from_levels, len(from_levels) - len(to_levels))
+    to_nodes = _descend(to_levels, len(to_levels) - len(from_levels))
+    depth = min(len(from_levels), len(to_levels))
+
+    for level in range(depth):
+        from_level = from_levels[len(from_levels) - depth + level]
+        to_level = to_levels[len(to_levels) - depth + level]
+        from_hashes = {from_level[i][0] for i in from_nodes}
+        to_hashes = {to_level[i][0] for i in to_nodes}
+        from_nodes = [i for i in from_nodes if from_level[i][0] not in to_hashes]
+        to_nodes = [i for i in to_nodes if to_level[i][0] not in from_hashes]
+
+        if level < depth - 1:
+            from_nodes = _children(from_level, from_nodes)
+            to_nodes = _children(to_level, to_nodes)
+
+    return ([from_tree['blocks'][i] for i in from_nodes],
+            [to_tree['blocks'][i] for i in to_nodes])
+
+
+def extract(filename: str, tree: Tree, offsets: Offsets,
+            other_tree: Tree) -> Iterator[records.Record]:
+    """
+    The rows of the file which may differ from the file the other tree
+    describes: those in blocks the other tree doesn't have.
+    """
+    blocks, _ = compare(tree, other_tree)
+    return read_blocks(filename, tree, offsets, blocks)
+
+
+def read_blocks(filename: str, tree: Tree, offsets: Offsets,
+                blocks: List[Block]) -> Iterator[records.Record]:
+    "Read just the rows of the given blocks, seeking to each in turn."
+    if offsets['root'] != tree['root']:
+        raise InvalidTreeError('the row offsets are for a different tree')
+
+    if os.path.getsize(filename) != offsets['size']:
+        raise InvalidTreeError('the file has changed since its tree was built')
+
+    wanted = {b['hash'] for b in blocks}
+    selected = []  # type: List[int]
+    start = 0
+    for b in tree['blocks']:
+        if b['hash'] in wanted:
+            selected.extend(offsets['offsets'][start:start + b['rows']])
+        start += b['rows']
+
+    return _read_at(filename, tree, sorted(selected))
+
+
+def _read_at(filename: str, tree: Tree, offsets: List[int]) -> Iterator[records.Record]:
+    columns = tree['columns']
+    with open(filename, 'rb') as istream:
+        for offset in offsets:
+            row = records.read_at(istream, offset, sep=tree['sep'])
+            yield dict(zip(columns, records.pad_row(row, columns,
+                                                    'at byte {}'.format(offset))))
+
+
+def diff(from_file: str, from_tree: Tree, to_file: str, to_tree: Tree,
+         from_offsets: Optional[Offsets] = None,
+         to_offsets: Optional[Offsets] = None) -> Dict[str, Any]:
+    """
+    Diff two files using their trees and row offsets, reading only the rows
+    of blocks whose hashes differ. Either file may instead be an extract
+    holding just those rows, as written by extract(), when the full file is
+    elsewhere; its offsets are then left out.
+    """
+    from_blocks, to_blocks = compare(from_tree, to_tree)
+    index_columns = from_tree['index']
+
+    with stats.phase('read_blocks') as p:
+        from_records = list(_candidates(from_file, from_tree, from_offsets, from_blocks))
+        to_records = list(_candidates(to_file, to_tree, to_offsets, to_blocks))
+        p.rows = len(from_records) + len(to_records)
+
+    return patch.create(from_records, to_records, index_columns)
+
+
+def _candidates(filename: str, tree: Tree, offsets: Optional[Offsets],
+                blocks: List[Block]) -> Iterator[records.Record]:
+    if not blocks:
+        return iter([])
+
+    if offsets is None:
+        return iter(records.load(filename, sep=tree['sep']))
+
+    return read_blocks(filename, tree, offsets, blocks)
+
+
+def _row_hasher(columns: List[str]) -> Callable[[List[Any]], bytes]:
+    """
+    A function hashing rows with these columns. The same row hashes the same
+    whatever order the columns are in, but not if they're named differently.
+    """
+    order = sorted(range(len(columns)), key=columns.__getitem__)
+    base = hashlib.sha256(json.dumps(sorted(columns)).encode('utf8'))
+
+    def digest(row: List[Any]) -> bytes:
+        h = base.copy()
+        h.update(json.dumps([row[i] for i in order]).encode('utf8'))
+        return h.digest()[:16]
+
+    return digest
+
+
+def _key_hash(k: Tuple[str, ...]) -> int:
+    # only decides where blocks end, so an occasional collision is harmless
+    content = '\x1f'.join(v or '' for v in k)
+    return int.from_bytes(hashlib.sha256(content.encode('utf8')).digest()[:4], 'big')
+
+
+def _hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def _block(rows: List[Tuple[Tuple[str, ...], bytes]]) -> Block:
+    return {
+        'hash': _hash(b''.join(digest for _, digest in rows)),
+        'first': list(rows[0][0]),
+        'last': list(rows[-1][0]),
+        'rows': len(rows),
+    }
+
+
+def _levels(hashes: List[str]) -> List[List[List[Any]]]:
+    """
+    Group the block hashes into nodes, level by level up to a single root,
+    as [hash, number of children] pairs. Like blocks, nodes end where a
+    child's hash has its low bits clear, so a changed block only changes the
+    nodes above it.
+    """
+    mask = (1 << FANOUT_BITS) - 1
+    levels = []  # type: List[List[List[Any]]]
+    while len(hashes) > 1:
+        groups = []  # type: List[List[str]]
+        current = []  # type: List[str]
+        for h in hashes:
+            current.append(h)
+            if int(h[-8:], 16) & mask == 0:
+                groups.append(current)
+                current = []
+        if current:
+            groups.append(current)
+
+        if len(groups) == len(hashes):
+            # every child ended a node, so put them all under the root instead
+            groups = [hashes]
+
+        level = [[_hash(''.join(g).encode('ascii')), len(g)]
+                 for g in groups]  # type: List[List[Any]]
+        levels.append(level)
+        hashes = [node[0] for node in level]
+
+    return levels
+
+
+def _nodes(tree: Tree) -> List[List[Node]]:
+    "The nodes of the tree level by level from the root down to the blocks."
+    levels = [[(b['hash'], i, i + 1) for i, b in enumerate(tree['blocks'])]]
+    for level in tree['levels']:
+        nodes = []  # type: List[Node]
+        start = 0
+        for h, n in level:
+            nodes.append((h, start, start + n))
+            start += n
+        levels.append(nodes)
+
+    levels.reverse()
+    return levels
+
+
+def _descend(levels: List[List[Node]], steps: int) -> List[int]:
+    "The positions of the nodes this many levels below the root."
+    nodes = list(range(len(levels[0])))
+    for level in levels[:max(steps, 0)]:
+        nodes = _children(level, nodes)
+
+    return nodes
+
+
+def _children(level: List[Node], nodes: List[int]) -> List[int]:
+    return [c for i in nodes for c in range(level[i][1], level[i][2])]
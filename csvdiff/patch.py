@@ -10,13 +10,17 @@ The the patch format.
 
 import sys
 import json
+import collections
 import copy
+import difflib
+import hashlib
 import itertools
-
-import jsonschema
+import operator
+import re
 
 from . import records
 from . import error
+from . import stats
 
 
 SCHEMA = {
@@ -30,6 +34,20 @@ SCHEMA = {
             'minItems': 1,
             'items': {'type': 'string'},
         },
+        '_types': {
+            'type': 'object',
+            'patternProperties': {
+                '^.*$': {'enum': ['int', 'float', 'str']},
+            },
+        },
+        '_columns': {
+            'type': 'object',
+            'properties': {
+                'added': {'type': 'array', 'items': {'type': 'string'}},
+                'removed': {'type': 'array', 'items': {'type': 'string'}},
+            },
+            'required': ['added', 'removed'],
+        },
         'added': {
             'type': 'array',
             'items': {'type': 'object',
@@ -64,8 +82,25 @@ SCHEMA = {
                                          'to': {
                                              'type': ['string', 'number']
                                          },
+                                         'delta': {
+                                             'type': 'array',
+                                             'items': {
+                                                 'type': 'array',
+                                                 'items': [{'type': 'integer'},
+                                                           {'type': 'integer'},
+                                                           {'type': 'string'}],
+                                                 'minItems': 3,
+                                                 'maxItems': 3,
+                                             },
+                                         },
+                                         'from_digest': {'type': 'string'},
+                                         'to_digest': {'type': 'string'},
                                      },
-                                     'required': ['from', 'to']},
+                                     'anyOf': [
+                                         {'required': ['from', 'to']},
+                                         {'required': ['delta', 'from_digest',
+                                                       'to_digest']},
+                                     ]},
                         },
                     },
                 },
@@ -77,9 +112,27 @@ SCHEMA = {
 }
 
 
+# existing rows take this value in a newly added column, until changed
+NEW_COLUMN_VALUE = ''
+
+# a removed row may be given as just its index columns and a digest of the
+# whole row, kept in this field
+DIGEST_FIELD = '_digest'
+
+# a changed text field may be given as the edits turning its old value into
+# its new one, kept in this field, along with digests of both values
+DELTA_FIELD = 'delta'
+
+# changed stretches of text longer than this are compared line by line, or
+# word by word, rather than character by character
+DELTA_MATCH_LIMIT = 2**10
+
+
 def is_empty(diff):
     "Are there any actual differences encoded in the delta?"
-    return not any([diff['added'], diff['changed'], diff['removed']])
+    columns = diff.get('_columns', {})
+    return not any([diff['added'], diff['changed'], diff['removed'],
+                    columns.get('added'), columns.get('removed')])
 
 
 def is_valid(diff):
@@ -87,6 +140,8 @@ def is_valid(diff):
     Validate the diff against the schema, returning True if it matches, False
     otherwise.
     """
+    import jsonschema
+
     try:
         validate(diff)
     except jsonschema.ValidationError:
@@ -100,6 +155,8 @@ def validate(diff):
     Check the diff against the schema, raising an exception if it doesn't
     match.
     """
+    import jsonschema
+
     return jsonschema.validate(diff, SCHEMA)
 
 
@@ -108,20 +165,87 @@ def apply(diff, recs, strict=True):
     Transform the records with the patch. May fail if the records do not
     match those expected in the patch.
     """
-    index_columns = diff['_index']
-    indexed = records.index(copy.deepcopy(list(recs)), index_columns)
-    _add_records(indexed, diff['added'], index_columns, strict=strict)
-    _remove_records(indexed, diff['removed'], index_columns, strict=strict)
-    _update_records(indexed, diff['changed'], strict=strict)
-    return records.sort(indexed.values())
+    return apply_many([diff], recs, strict=strict)
+
+
+def apply_many(diffs, recs, strict=True):
+    """
+    Transform the records with each patch in turn, indexing and sorting them
+    only once. In strict mode, each patch is checked against the records as
+    the patches before it left them.
+    """
+    with stats.phase('copy') as p:
+        recs = copy.deepcopy(list(recs))
+        p.rows = len(recs)
+
+    index_columns = None
+    indexed = None
+    for diff in diffs:
+        if diff['_index'] != index_columns:
+            index_columns = diff['_index']
+            with stats.phase('index') as p:
+                indexed = records.index(recs if indexed is None else indexed.values(),
+                                        index_columns)
+                p.rows = len(indexed)
+
+        # removed rows are checked against the old columns, and added rows
+        # carry the new ones
+        with stats.phase('apply_removed') as p:
+            _remove_records(indexed, diff['removed'], index_columns, strict=strict)
+            p.rows = len(diff['removed'])
+
+        columns = diff.get('_columns', {})
+        if columns.get('added'):
+            _add_columns(indexed, columns['added'], strict=strict)
+
+        with stats.phase('apply_added') as p:
+            _add_records(indexed, diff['added'], index_columns, strict=strict)
+            p.rows = len(diff['added'])
+
+        with stats.phase('apply_changed') as p:
+            _update_records(indexed, diff['changed'], strict=strict)
+            p.rows = len(diff['changed'])
+
+        if columns.get('removed'):
+            _remove_columns(indexed, columns['removed'], strict=strict)
+
+    if indexed is None:
+        raise ValueError('need at least one patch to apply')
+
+    with stats.phase('sort') as p:
+        result = records.sort(indexed.values())
+        p.rows = len(result)
+
+    return result
+
+
+def _add_columns(indexed, columns, strict=True):
+    for r in indexed.values():
+        for c in columns:
+            if strict and c in r:
+                raise PatchApplyError('column {0} already exists in source '
+                                      'document'.format(c), field=c)
+            r.setdefault(c, NEW_COLUMN_VALUE)
+
+
+def _remove_columns(indexed, columns, strict=True):
+    # rows added by the patch never had these columns
+    for c in columns:
+        if strict and indexed and not any(c in r for r in indexed.values()):
+            raise PatchApplyError('column {0} does not exist in source '
+                                  'document'.format(c), field=c)
+
+    for r in indexed.values():
+        for c in columns:
+            r.pop(c, None)
 
 
 def _add_records(indexed, recs_to_add, index_columns, strict=True):
     indexed_to_add = records.index(recs_to_add, index_columns)
     for k, r in indexed_to_add.items():
         if strict and k in indexed:
-            error.abort(
-                'error: key {0} already exists in source document'.format(k)
+            raise PatchApplyError(
+                'key {0} already exists in source document'.format(k), key=k
             )
         indexed[k] = r
 
@@ -132,14 +256,15 @@ def _remove_records(indexed, recs_to_remove, index_columns, strict=True):
         if strict:
             v = indexed.get(k)
             if v is None:
-                error.abort(
-                    'ERROR: key {0} does not exist in source '
-                    'document'.format(k)
+                raise PatchApplyError(
+                    'key {0} does not exist in source '
+                    'document'.format(k), key=k
                 )
-            if v != r:
-                error.abort(
-                    'ERROR: source document version of {0} has '
-                    'changed'.format(k)
+            if (row_digest(v) != r[DIGEST_FIELD] if DIGEST_FIELD in r
+                    else v != r):
+                raise PatchApplyError(
+                    'source document version of {0} has '
+                    'changed'.format(k), key=k
                 )
 
         del indexed[k]
@@ -155,29 +280,56 @@ def _update_records(indexed, deltas, strict=True):
         # what happens when the record is missing?
         if r is None:
             if strict:
-                error.abort(
-                    'ERROR: source document is missing record '
-                    'for {0}'.format(k)
+                raise PatchApplyError(
+                    'source document is missing record '
+                    'for {0}'.format(k), key=k
                 )
             continue
 
         r = indexed[k]
         for field, from_to in field_changes.items():
+            if DELTA_FIELD in from_to:
+                # edits only make sense against the value they were made to
+                r[field] = _apply_delta(k, field, r.get(field), from_to)
+                continue
+
             expected = from_to['from']
             if strict and r.get(field) != expected:
-                error.abort(
-                    'ERROR: source document version of {0} has '
-                    'changed {1} field'.format(k, field)
+                raise PatchApplyError(
+                    'source document version of {0} has '
+                    'changed {1} field'.format(k, field), key=k, field=field
                 )
             r[field] = from_to['to']
 
 
+def _apply_delta(k, field, value, delta):
+    if not isinstance(value, str) or text_digest(value) != delta['from_digest']:
+        raise PatchApplyError(
+            'source document version of {0} has '
+            'changed {1} field'.format(k, field), key=k, field=field
+        )
+
+    value = apply_edits(value, delta[DELTA_FIELD])
+    if text_digest(value) != delta['to_digest']:
+        raise PatchApplyError(
+            'edits to {0} field of {1} give the wrong '
+            'value'.format(field, k), key=k, field=field
+        )
+
+    return value
+
+
 def load(istream, strict=True):
     "Deserialize a patch object."
+    # jsonschema is slow to import, so only pay for it when we need it
+    import jsonschema
+
     try:
-        diff = json.load(istream)
+        with stats.phase('load_patch'):
+            diff = json.load(istream)
         if strict:
-            jsonschema.validate(diff, SCHEMA)
+            with stats.phase('validate_patch'):
+                jsonschema.validate(diff, SCHEMA)
     except ValueError:
         raise InvalidPatchError('patch is not valid JSON')
 
@@ -187,13 +339,24 @@ def load(istream, strict=True):
     return diff
 
 
-def save(diff, stream=sys.stdout, compact=False):
-    "Serialize a patch object."
+def save(diff, stream=sys.stdout, compact=False, index_file=None):
+    """
+    Serialize a patch object. With an index file, also record where each
+    entry is in the output, so that lookup.lookup() can find a key's entries
+    without loading the whole patch.
+    """
+    if index_file is not None:
+        from . import lookup
+        with stats.phase('save'):
+            lookup.save(diff, stream, index_file, compact=compact)
+        return
+
     flags = {'sort_keys': True}
     if not compact:
         flags['indent'] = 2
 
-    json.dump(diff, stream, **flags)
+    with stats.phase('save'):
+        json.dump(diff, stream, **flags)
 
 
 def create(from_records, to_records, index_columns, ignore_columns=None):
@@ -201,62 +364,398 @@ def create(from_records, to_records, index_columns, ignore_columns=None):
     Diff two sets of records, using the index columns as the primary key for
     both datasets.
     """
-    from_indexed = records.index(from_records, index_columns)
-    to_indexed = records.index(to_records, index_columns)
+    from_indexed = index_records(from_records, index_columns, ignore_columns)
+    to_indexed = index_records(to_records, index_columns, ignore_columns)
+    return create_indexed(from_indexed, to_indexed, index_columns)
+
+
+def index_records(recs, index_columns, ignore_columns=None):
+    """
+    Index one side of a diff, dropping any ignored columns. The result can be
+    reused with create_indexed() to diff it against several others.
+    """
+    with stats.phase('index') as p:
+        indexed = records.index(recs, index_columns, packed=True)
+        p.rows = len(indexed)
 
     if ignore_columns is not None:
-        from_indexed = records.filter_ignored(from_indexed, ignore_columns)
-        to_indexed = records.filter_ignored(to_indexed, ignore_columns)
+        with stats.phase('filter_ignored'):
+            indexed = records.filter_ignored(indexed, ignore_columns)
 
-    return create_indexed(from_indexed, to_indexed, index_columns)
+    return indexed
 
 
 def create_indexed(from_indexed, to_indexed, index_columns):
-    # examine keys for overlap
-    removed, added, shared = _compare_keys(from_indexed, to_indexed)
+    "Diff two indexes, by collecting the changes iter_changes() finds."
+    alignment = align(from_indexed, to_indexed)
+    diff = {'_index': index_columns}
+    if not alignment.same:
+        diff['_columns'] = alignment.as_dict()
+
+    removed = []
+    added = []
+    changed = []
+
+    with stats.phase('compare_keys') as p:
+        for _, _, r in _iter_removed(from_indexed, to_indexed, index_columns):
+            removed.append(r)
+        p.rows = len(from_indexed) + len(to_indexed)
+
+    with stats.phase('compare_rows') as p:
+        for kind, key, payload in _iter_added_changed(from_indexed, to_indexed,
+                                                      index_columns, alignment):
+            if kind == 'added':
+                added.append(payload)
+            else:
+                changed.append({'key': key, 'fields': payload})
+        p.rows = len(to_indexed) - len(added)
+
+    with stats.phase('assemble') as p:
+        diff['added'] = records.sort(added)
+        diff['removed'] = records.sort(removed)
+        diff['changed'] = sorted(changed, key=_change_key)
+        p.rows = len(removed) + len(added) + len(changed)
 
-    # check for changed rows
-    changed = _compare_rows(from_indexed, to_indexed, shared)
+    return diff
 
-    diff = _assemble(removed, added, changed, from_indexed, to_indexed,
-                     index_columns)
 
-    return diff
+# a change found while diffing: its kind ('removed', 'added' or 'changed'),
+# the row's key, and either the whole row or, for changed rows, the field
+# changes as in a patch
+Change = collections.namedtuple('Change', 'kind key payload')
+
 
+def iter_changes(from_indexed, to_indexed, index_columns):
+    """
+    Yield the changes between two indexes one at a time as they are found,
+    without assembling a patch: first the removed rows, then the added and
+    changed ones in the order of the new index.
+    """
+    alignment = align(from_indexed, to_indexed)
+    yield from _iter_removed(from_indexed, to_indexed, index_columns)
+    yield from _iter_added_changed(from_indexed, to_indexed, index_columns, alignment)
 
-def _compare_keys(from_recs, to_recs):
-    from_keys = set(from_recs)
-    to_keys = set(to_recs)
-    removed = from_keys.difference(to_keys)
-    shared = from_keys.intersection(to_keys)
-    added = to_keys.difference(from_keys)
-    return removed, added, shared
 
+def _iter_removed(from_indexed, to_indexed, index_columns):
+    for k, r in from_indexed.items():
+        if k not in to_indexed:
+            yield Change('removed', [r[c] for c in index_columns], r)
 
-def _compare_rows(from_recs, to_recs, keys):
-    "Return the set of keys which have changed."
-    return set(
-        k for k in keys
-        if sorted(from_recs[k].items()) != sorted(to_recs[k].items())
-    )
 
+def _iter_added_changed(from_indexed, to_indexed, index_columns, alignment):
+    # keys may be packed, so take the original values from the records
+    differs = alignment.differs
+    get = from_indexed.get
+    for k, r in to_indexed.items():
+        other = get(k)
+        if other is None:
+            yield Change('added', [r[c] for c in index_columns], r)
+        elif differs(other, r):
+            yield Change('changed', [r[c] for c in index_columns], alignment.diff(other, r))
 
-def _assemble(removed, added, changed, from_recs, to_recs, index_columns):
-    diff = {}
-    diff['_index'] = index_columns
-    diff['added'] = records.sort(to_recs[k] for k in added)
-    diff['removed'] = records.sort(from_recs[k] for k in removed)
-    diff['changed'] = sorted(({'key': list(k),
-                               'fields': record_diff(from_recs[k], to_recs[k])}
-                              for k in changed),
-                             key=_change_key)
-    return diff
+
+# how many changes a background diff may run ahead of its consumer
+BUFFER_SIZE = 1024
+
+
+def stream(from_records, to_records, index_columns, ignore_columns=None,
+           buffer_size=BUFFER_SIZE):
+    """
+    Diff two sets of records in a background thread, yielding each change as
+    it is found. At most buffer_size changes are held waiting for the
+    consumer, so a slow consumer holds up the diff rather than letting
+    changes pile up in memory. Errors in the diff are raised to the consumer.
+    """
+    import queue
+    import threading
+
+    buffered = queue.Queue(buffer_size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up if the consumer has gone away
+        while not stopped.is_set():
+            try:
+                buffered.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            from_indexed = index_records(from_records, index_columns, ignore_columns)
+            to_indexed = index_records(to_records, index_columns, ignore_columns)
+            for change in iter_changes(from_indexed, to_indexed, index_columns):
+                if not put(change):
+                    return
+            put((done, None))
+
+        except BaseException as e:
+            put((done, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffered.get()
+            if item[0] is done:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+
+    finally:
+        stopped.set()
+        producer.join()
+
+
+class Alignment:
+    """
+    How the columns of two versions of a file line up, worked out once from
+    their headers so that rows can be compared without any per-row set or
+    sorting work. Columns only in the new version are added, taking
+    NEW_COLUMN_VALUE in existing rows, and columns only in the old version
+    are removed.
+    """
+    def __init__(self, from_columns, to_columns):
+        from_set = set(from_columns)
+        to_set = set(to_columns)
+        self.shared = [c for c in from_columns if c in to_set]
+        self.added = [c for c in to_columns if c not in from_set]
+        self.removed = [c for c in from_columns if c not in to_set]
+        self.same = not self.added and not self.removed
+
+        # every column on either side, in order
+        self.columns = list(from_columns) + self.added
+
+        self._shared_values = _getter(self.shared)
+        self._added_values = _getter(self.added)
+        self._new_values = self._added_values(dict.fromkeys(self.added, NEW_COLUMN_VALUE))
+
+    def differs(self, lhs, rhs):
+        "Has this row changed, other than by dropping removed columns?"
+        if self.same:
+            return lhs != rhs
+
+        return (self._shared_values(lhs) != self._shared_values(rhs) or
+                self._added_values(rhs) != self._new_values)
+
+    def diff(self, lhs, rhs):
+        "The field changes for a row, like record_diff()."
+        delta = {}
+        for c in self.shared:
+            if lhs[c] != rhs[c]:
+                delta[c] = {'from': lhs[c], 'to': rhs[c]}
+
+        for c in self.added:
+            if rhs[c] != NEW_COLUMN_VALUE:
+                delta[c] = {'from': NEW_COLUMN_VALUE, 'to': rhs[c]}
+
+        return delta
+
+    def as_dict(self):
+        return {'added': self.added, 'removed': self.removed}
+
+
+def align(from_indexed, to_indexed):
+    "Align the columns of two indexes, as seen in their first rows."
+    from_columns = _first_columns(from_indexed)
+    to_columns = _first_columns(to_indexed)
+
+    # without any rows on one side, there's nothing to say about its columns
+    if from_columns is None or to_columns is None:
+        columns = from_columns or to_columns or []
+        return Alignment(columns, columns)
+
+    return Alignment(from_columns, to_columns)
+
+
+def _first_columns(indexed):
+    for r in indexed.values():
+        return list(r)
+
+    return None
+
+
+def _getter(columns):
+    "A function giving a row's values for the columns, as a comparable value."
+    if not columns:
+        return lambda r: ()
+
+    return operator.itemgetter(*columns)
 
 
 def _change_key(c):
     return tuple(c['key'])
 
 
+def digest_removed(diff):
+    """
+    Replace each removed row with just its index columns and a digest of the
+    whole row, which is all apply() needs to check and remove it. Patches
+    which remove many rows become much smaller, but can no longer be
+    inverted or composed.
+    """
+    index_columns = diff['_index']
+    digested = dict(diff)
+    digested['removed'] = [_digested(r, index_columns) for r in diff['removed']]
+    return digested
+
+
+def _digested(r, index_columns):
+    if DIGEST_FIELD in r:
+        return r
+
+    digested = {c: r[c] for c in index_columns}
+    digested[DIGEST_FIELD] = row_digest(r)
+    return digested
+
+
+def row_digest(r):
+    """
+    A short hash of a row's contents, whatever order its columns are in, and
+    whether its whole numbers were typed as ints or floats.
+    """
+    return text_digest(json.dumps({c: _digest_value(v) for c, v in r.items()},
+                                  sort_keys=True, ensure_ascii=False))
+
+
+def _digest_value(v):
+    # an inferred int column widened to float holds both 1 and 1.0
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+
+    return v
+
+
+def text_digest(s):
+    return hashlib.sha256(s.encode('utf8')).hexdigest()[:32]
+
+
+def _has_digests(diff):
+    return any(DIGEST_FIELD in r for r in diff['removed'])
+
+
+def encode_deltas(diff, columns):
+    """
+    Replace changes to text in the given columns with the edits turning the
+    old value into the new one, wherever that is smaller. Each edit is a
+    [start, end, text] list, replacing those characters of the old value.
+    Digests of both values let apply() check the edits, but the patch can no
+    longer be inverted or composed.
+    """
+    columns = set(columns)
+    encoded = dict(diff)
+    encoded['changed'] = [{'key': c['key'],
+                           'fields': {f: (_encode_delta(v) if f in columns else v)
+                                      for f, v in c['fields'].items()}}
+                          for c in diff['changed']]
+    return encoded
+
+
+def _encode_delta(from_to):
+    from_ = from_to.get('from')
+    to = from_to.get('to')
+    if not isinstance(from_, str) or not isinstance(to, str):
+        return from_to
+
+    edits = edit_script(from_, to)
+
+    # roughly what the edits and digests add up to in JSON
+    size = sum(len(text) + 16 for _, _, text in edits) + 100
+    if size >= len(from_) + len(to):
+        return from_to
+
+    return {DELTA_FIELD: edits, 'from_digest': text_digest(from_),
+            'to_digest': text_digest(to)}
+
+
+def edit_script(a, b):
+    "The edits turning one string into another, as [start, end, text] lists."
+    prefix = _common_prefix(a, b)
+    suffix = _common_suffix(a[prefix:], b[prefix:])
+    return list(_edits(a, b, prefix, len(a) - suffix, prefix, len(b) - suffix))
+
+
+def _edits(a, b, a_start, a_end, b_start, b_end, by_line=True):
+    if a_end - a_start <= DELTA_MATCH_LIMIT and b_end - b_start <= DELTA_MATCH_LIMIT:
+        matcher = difflib.SequenceMatcher(None, a[a_start:a_end], b[b_start:b_end],
+                                          autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                yield [a_start + i1, a_start + i2, b[b_start + j1:b_start + j2]]
+        return
+
+    a_lines = _lines(a[a_start:a_end])
+    b_lines = _lines(b[b_start:b_end])
+    if not by_line or (len(a_lines) < 2 and len(b_lines) < 2):
+        yield [a_start, a_end, b[b_start:b_end]]
+        return
+
+    a_offsets = list(itertools.accumulate([a_start] + [len(s) for s in a_lines]))
+    b_offsets = list(itertools.accumulate([b_start] + [len(s) for s in b_lines]))
+    matcher = difflib.SequenceMatcher(None, a_lines, b_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            for edit in _edits(a, b, a_offsets[i1], a_offsets[i2], b_offsets[j1],
+                               b_offsets[j2], by_line=False):
+                yield edit
+
+
+def _lines(s):
+    "Split text into lines, or words for text like JSON all on one line."
+    lines = s.splitlines(True)
+    if len(lines) > 1:
+        return lines
+
+    return [w for w in re.findall(r'[^,\s]*[,\s]*', s) if w]
+
+
+def _common_prefix(a, b):
+    "How many characters two strings start with in common."
+    # comparing slices is much faster than stepping through each character
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def _common_suffix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def apply_edits(s, edits):
+    "Apply an edit script from edit_script() to a string."
+    pieces = []
+    end = 0
+    for start, next_end, text in edits:
+        pieces.append(s[end:start])
+        pieces.append(text)
+        end = next_end
+    pieces.append(s[end:])
+
+    return ''.join(pieces)
+
+
+def _has_deltas(diff):
+    return any(DELTA_FIELD in v for c in diff['changed'] for v in c['fields'].values())
+
+
 def record_diff(lhs, rhs):
     "Diff an individual row."
     delta = {}
@@ -287,6 +786,8 @@ def _iter_change_fields(cs):
         for k in c['key']:
             yield k
         for v in c['fields'].values():
+            if DELTA_FIELD in v:
+                continue
             yield v['from']
             yield v['to']
 
@@ -301,6 +802,209 @@ class InvalidPatchError(Exception):
     pass
 
 
+class PatchConflictError(Exception):
+    pass
+
+
+class PatchApplyError(error.FatalError):
+    """
+    The records aren't as the patch expects them to be. Gives the key of the
+    row, and the field, where they're known.
+    """
+    def __init__(self, message, key=None, field=None):
+        super(PatchApplyError, self).__init__(message)
+        self.key = key
+        self.field = field
+
+    def __reduce__(self):
+        return type(self), (self.args[0], self.key, self.field)
+
+
+def invert(diff):
+    """
+    Reverse a patch, giving one which undoes its changes. Patches which
+    remove columns, or give digests of removed rows or edits to changed
+    values, can't be reversed, since they don't keep the values removed.
+    """
+    columns = diff.get('_columns')
+    if columns and columns['removed']:
+        raise InvalidPatchError('cannot invert a patch which removes columns')
+
+    if _has_digests(diff):
+        raise InvalidPatchError('cannot invert a patch with digests of removed rows')
+
+    if _has_deltas(diff):
+        raise InvalidPatchError('cannot invert a patch with edits to changed values')
+
+    inverse = {
+        '_index': diff['_index'],
+        'added': list(diff['removed']),
+        'removed': list(diff['added']),
+        'changed': [{'key': c['key'],
+                     'fields': {k: {'from': v['to'], 'to': v['from']}
+                                for k, v in c['fields'].items()}}
+                    for c in diff['changed']],
+    }
+    if columns:
+        inverse['_columns'] = {'added': [], 'removed': list(columns['added'])}
+    if '_types' in diff:
+        inverse['_types'] = diff['_types']
+
+    return inverse
+
+
+def compose(*diffs, strict=True):
+    """
+    Combine a sequence of patches into a single patch with the same effect as
+    applying each of them in turn. In strict mode, raise PatchConflictError
+    if a later patch expects a row to be different from how the earlier
+    patches left it.
+    """
+    if not diffs:
+        raise ValueError('need at least one patch to compose')
+
+    index_columns = diffs[0]['_index']
+
+    # the net change for each key: ('added', record), ('removed', record) or
+    # ('changed', fields)
+    net = {}
+    types = {}
+    for diff in diffs:
+        if diff['_index'] != index_columns:
+            raise InvalidPatchError('cannot compose patches with different indexes')
+
+        columns = diff.get('_columns', {})
+        if columns.get('added') or columns.get('removed'):
+            raise InvalidPatchError('cannot compose patches which add or remove columns')
+
+        if _has_digests(diff):
+            raise InvalidPatchError('cannot compose patches with digests of removed rows')
+
+        if _has_deltas(diff):
+            raise InvalidPatchError('cannot compose patches with edits to changed values')
+
+        types.update(diff.get('_types', {}))
+
+        # the same order as apply() uses
+        for r in diff['removed']:
+            _compose_removed(net, tuple(r[c] for c in index_columns), r, strict)
+        for r in diff['added']:
+            _compose_added(net, tuple(r[c] for c in index_columns), r, strict)
+        for delta in diff['changed']:
+            _compose_changed(net, tuple(delta['key']), delta['fields'], strict)
+
+    removed = [r for kind, r in net.values() if kind == 'removed']
+    added = [r for kind, r in net.values() if kind == 'added']
+    changed = [{'key': list(k), 'fields': fields}
+               for k, (kind, fields) in net.items() if kind == 'changed']
+    composed = {
+        '_index': index_columns,
+        'added': records.sort(added),
+        'removed': records.sort(removed),
+        'changed': sorted(changed, key=_change_key),
+    }
+    if types:
+        composed['_types'] = types
+
+    return composed
+
+
+def _compose_added(net, k, r, strict):
+    current = net.get(k)
+    if current is None:
+        net[k] = ('added', r)
+        return
+
+    kind, v = current
+    if kind == 'removed':
+        if set(v) != set(r):
+            raise PatchConflictError(
+                'key {0} is removed and re-added with different columns'.format(k)
+            )
+        fields = record_diff(v, r)
+        if fields:
+            net[k] = ('changed', fields)
+        else:
+            del net[k]
+
+    elif not strict:
+        # the later version wins, as it does when applying non-strictly
+        net[k] = ('added', r)
+
+    else:
+        raise PatchConflictError('key {0} is added but already exists'.format(k))
+
+
+def _compose_removed(net, k, r, strict):
+    current = net.get(k)
+    if current is None:
+        net[k] = ('removed', r)
+        return
+
+    kind, v = current
+    if kind == 'added':
+        if strict and v != r:
+            raise PatchConflictError('removed version of {0} has changed'.format(k))
+        del net[k]
+
+    elif kind == 'changed':
+        if strict and any(r.get(field) != from_to['to'] for field, from_to in v.items()):
+            raise PatchConflictError('removed version of {0} has changed'.format(k))
+
+        # remove the row as it was before it was changed
+        original = dict(r)
+        for field, from_to in v.items():
+            original[field] = from_to['from']
+        net[k] = ('removed', original)
+
+    elif strict:
+        raise PatchConflictError('key {0} is removed twice'.format(k))
+
+
+def _compose_changed(net, k, fields, strict):
+    current = net.get(k)
+    if current is None:
+        net[k] = ('changed', fields)
+        return
+
+    kind, v = current
+    if kind == 'added':
+        if strict and any(v.get(field) != from_to['from']
+                          for field, from_to in fields.items()):
+            raise PatchConflictError('added version of {0} has changed'.format(k))
+
+        updated = dict(v)
+        for field, from_to in fields.items():
+            updated[field] = from_to['to']
+        net[k] = ('added', updated)
+
+    elif kind == 'changed':
+        merged = dict(v)
+        for field, from_to in fields.items():
+            earlier = merged.get(field)
+            if earlier is None:
+                merged[field] = from_to
+                continue
+
+            if strict and earlier['to'] != from_to['from']:
+                raise PatchConflictError(
+                    'changed version of {0} has changed {1} field'.format(k, field)
+                )
+
+            if earlier['from'] == from_to['to']:
+                del merged[field]
+            else:
+                merged[field] = {'from': earlier['from'], 'to': from_to['to']}
+
+        if merged:
+            net[k] = ('changed', merged)
+        else:
+            del net[k]
+
+    elif strict:
+        raise PatchConflictError('key {0} is changed after being removed'.format(k))
+
+
 def filter_significance(diff, significance):
     """
     Prune any changes in the patch which are due to numeric changes less than this level of
@@ -308,15 +1012,17 @@ def filter_significance(diff, significance):
     """
     changed = diff['changed']
 
-    # remove individual field changes that are significant
-    reduced = [{'key': delta['key'],
-                'fields': {k: v
-                           for k, v in delta['fields'].items()
-                           if _is_significant(v, significance)}}
-               for delta in changed]
+    with stats.phase('filter_significance') as p:
+        # remove individual field changes that are significant
+        reduced = [{'key': delta['key'],
+                    'fields': {k: v
+                               for k, v in delta['fields'].items()
+                               if _is_significant(v, significance)}}
+                   for delta in changed]
 
-    # call a key changed only if it still has significant changes
-    filtered = [delta for delta in reduced if delta['fields']]
+        # call a key changed only if it still has significant changes
+        filtered = [delta for delta in reduced if delta['fields']]
+        p.rows = len(changed)
 
     diff = diff.copy()
     diff['changed'] = filtered
@@ -327,11 +1033,20 @@ def _is_significant(change, significance):
     """
     Return True if a change is genuinely significant given our tolerance.
     """
-    try:
-        a = float(change['from'])
-        b = float(change['to'])
-
-    except ValueError:
+    if DELTA_FIELD in change:
+        # only text is given as edits
         return True
 
+    a = change['from']
+    b = change['to']
+
+    # typed values were parsed once already, as they were loaded
+    if type(a) is str or type(b) is str:
+        try:
+            a = float(a)
+            b = float(b)
+
+        except ValueError:
+            return True
+
     return abs(a - b) > 10 ** (-significance)
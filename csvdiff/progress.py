@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+#  progress.py
+#  csvdiff
+#
+
+"""
+Progress reporting for long-running diffs and patches.
+"""
+
+from typing import Dict, Optional, TextIO, Tuple
+import json
+import sys
+import threading
+import time
+
+from . import stats
+
+
+class ProgressReporter(stats.Hook):
+    """
+    Reports phase transitions and parsing throughput as they happen. The text
+    format is meant for people watching a terminal; the json format writes one
+    object per line for schedulers and log collectors.
+
+    Both sides of a diff are parsed at once on their own threads, so timings
+    and rate limiting are kept per thread, and each file is reported on its
+    own.
+    """
+    def __init__(self, format: str = 'text', ostream: TextIO = sys.stderr,
+                 interval: float = 1.0) -> None:
+        if format not in ('text', 'json'):
+            raise ValueError('unknown progress format {0}'.format(format))
+
+        self.format = format
+        self.ostream = ostream
+        self.interval = interval
+        self._started = {}  # type: Dict[Tuple[int, str], float]
+        self._last_report = {}  # type: Dict[Tuple[int, str], float]
+
+    def on_start(self, phase: str) -> None:
+        k = (threading.get_ident(), phase)
+        self._started[k] = time.monotonic()
+        self._last_report.pop(k, None)
+        self._emit({'event': 'start', 'phase': phase},
+                   '{0}: started'.format(phase))
+
+    def on_end(self, phase: str, seconds: float, rows: Optional[int]) -> None:
+        k = (threading.get_ident(), phase)
+        self._started.pop(k, None)
+        self._last_report.pop(k, None)
+        self._emit({'event': 'end', 'phase': phase, 'seconds': seconds, 'rows': rows},
+                   '{0}: done in {1:.2f}s{2}'.format(
+                       phase, seconds, '' if rows is None else ' ({0} rows)'.format(rows)
+                   ))
+
+    def on_progress(self, phase: str, done: int, total: Optional[int]) -> None:
+        k = (threading.get_ident(), phase)
+        now = time.monotonic()
+        if now - self._last_report.get(k, -self.interval) < self.interval:
+            return
+        self._last_report[k] = now
+
+        elapsed = now - self._started.get(k, now)
+        rate = done / elapsed if elapsed > 0 else None
+        eta = ((total - done) / rate
+               if rate and total is not None and total >= done
+               else None)
+
+        self._emit(
+            {'event': 'progress', 'phase': phase, 'bytes': done, 'total_bytes': total,
+             'bytes_per_second': rate, 'eta_seconds': eta},
+            '{0}: {1}{2}{3}'.format(
+                phase,
+                _format_bytes(done) if total is None else '{0:.1%}'.format(done / total),
+                '' if rate is None else ' at {0}/s'.format(_format_bytes(rate)),
+                '' if eta is None else ', ETA {0}'.format(_format_seconds(eta)),
+            ),
+        )
+
+    def _emit(self, event: Dict, message: str) -> None:
+        if self.format == 'json':
+            event['time'] = time.time()
+            print(json.dumps(event, sort_keys=True), file=self.ostream)
+        else:
+            print(message, file=self.ostream)
+
+        self.ostream.flush()
+
+
+def _format_bytes(n: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            return '{0:.1f} {1}'.format(n, unit)
+        n /= 1024
+
+    return '{0:.1f} TB'.format(n)
+
+
+def _format_seconds(s: float) -> str:
+    minutes, seconds = divmod(int(s), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
@@ -4,69 +4,603 @@
 #  csvdiff
 #
 
-from typing.io import TextIO
-from typing import Any, Dict, Tuple, Iterator, List, Sequence
+from typing import (Any, BinaryIO, Callable, Dict, Set, Tuple, Iterable, Iterator, List,
+                    Optional, Sequence, TextIO, Union)
 import csv
+import io
+import itertools
+import math
+import os
+import queue
 import sys
+import threading
+import time
 
-from . import error
+from . import error, stats
 
 
 Column = str
 PrimaryKey = Tuple[str, ...]
+PackedKey = Union[int, PrimaryKey]
 Record = Dict[Column, Any]
-Index = Dict[PrimaryKey, Record]
+Index = Dict[PackedKey, Record]
 
 
 class InvalidKeyError(Exception):
     pass
 
 
+class CSVParseError(error.FatalError):
+    "A row couldn't be parsed. Gives the line it was on, where that's known."
+    def __init__(self, message: str, line: Optional[int] = None) -> None:
+        super(CSVParseError, self).__init__(message)
+        self.line = line
+
+    def __reduce__(self) -> Any:
+        return type(self), (self.args[0], self.line)
+
+
+class TypeGuessError(CSVParseError):
+    """
+    A value didn't fit the type inferred for its column, which its typer now
+    leaves as text. Rows read before then hold numbers in that column, so
+    the files need reading again.
+    """
+    def __init__(self, message: str, line: Optional[int] = None,
+                 column: Optional[Column] = None) -> None:
+        super(TypeGuessError, self).__init__(message, line=line)
+        self.column = column
+
+    def __reduce__(self) -> Any:
+        return type(self), (self.args[0], self.line, self.column)
+
+
+# how many rows to read between progress updates
+PROGRESS_INTERVAL = 8192
+
+
+class Interner:
+    """
+    Makes equal values in the chosen columns share a single string object,
+    which saves a lot of memory on wide files full of low-cardinality values
+    like country codes or statuses. One interner can be shared by several
+    readers, so that both sides of a diff share their values too.
+
+    Without a list of columns, every column is interned for the first rows
+    read, then only those with few distinct values are kept.
+    """
+    # how many rows to sample before choosing columns automatically
+    AUTO_SAMPLE = 1000
+
+    # the most distinct values, as a fraction of sampled rows, for a column to
+    # be interned automatically
+    AUTO_MAX_RATIO = 0.1
+
+    # stop growing a column's cache beyond this many distinct values
+    MAX_CACHE = 2**16
+
+    def __init__(self, columns: Optional[List[Column]] = None) -> None:
+        self.auto = columns is None
+        self.sampled = 0
+        self.caches = {c: {} for c in columns or []}  # type: Dict[Column, Dict[str, str]]
+        self._lock = threading.Lock()
+
+    def intern(self, r: Record) -> Record:
+        if self.auto and self.sampled < self.AUTO_SAMPLE:
+            with self._lock:
+                # another reader may have finished sampling while we waited
+                if self.sampled < self.AUTO_SAMPLE:
+                    self._sample(r)
+                    return r
+
+        for c, cache in self.caches.items():
+            v = r.get(c)
+            if v is None:
+                continue
+
+            shared = cache.get(v)
+            if shared is not None:
+                r[c] = shared
+            elif len(cache) < self.MAX_CACHE:
+                cache[v] = v
+
+        return r
+
+    def _sample(self, r: Record) -> None:
+        for c, v in r.items():
+            r[c] = self.caches.setdefault(c, {}).setdefault(v, v)
+
+        if self.sampled + 1 == self.AUTO_SAMPLE:
+            limit = self.AUTO_MAX_RATIO * self.AUTO_SAMPLE
+            self.caches = {c: cache for c, cache in self.caches.items()
+                           if len(cache) <= limit}
+
+        # counted last, since readers check it without holding the lock
+        self.sampled += 1
+
+
+def make_interner(intern: Any) -> Optional[Interner]:
+    "An interner for the given columns, or chosen automatically for \"auto\"."
+    if not intern:
+        return None
+
+    if intern == 'auto':
+        return Interner()
+
+    return Interner(list(intern))
+
+
+# the types a column's values can be parsed into
+TYPES = ('int', 'float', 'str')
+
+
+class Typer:
+    """
+    Parses the values of chosen columns into ints or floats as they're read,
+    so that they're compared as numbers, and 1.0 and 1.00 are the same. Empty
+    values are left as they are. One typer can be shared by several readers,
+    so that both sides of a diff are typed alike.
+
+    Without types, they're inferred from the first rows read: a column is
+    typed as int if its values there are all integers written the usual way,
+    or as float if they're all finite numbers. Excluded columns stay as text.
+    An inferred int column is widened to float if a later value needs it,
+    since the rows sampled may all happen to be whole numbers. An inferred
+    column with a later value which isn't a number at all is left as text
+    from then on, raising TypeGuessError so that the files can be read again.
+    Only columns given types explicitly fail to parse.
+    """
+    # how many rows to sample when inferring types
+    AUTO_SAMPLE = 1000
+
+    def __init__(self, types: Optional[Dict[Column, str]] = None,
+                 exclude: Sequence[Column] = ()) -> None:
+        for c, t in (types or {}).items():
+            if t not in TYPES:
+                raise ValueError('unknown type {0} for column {1}'.format(t, c))
+
+        # only the columns which aren't text, once they're known
+        self.types = (None if types is None
+                      else {c: t for c, t in types.items() if t != 'str'})
+        self.exclude = set(exclude)
+        self._inferred = set()  # type: Set[Column]
+        self._lock = threading.Lock()
+
+    def type_rows(self, rows: Iterator[Tuple[int, Record]]) -> Iterator[Tuple[int, Record]]:
+        "Parse the typed values of each (line number, record) pair."
+        if self.types is None:
+            sample = list(itertools.islice(rows, self.AUTO_SAMPLE))
+            with self._lock:
+                # the first reader to get here decides for all of them
+                if self.types is None:
+                    self.types = self._infer([r for _, r in sample])
+                    self._inferred = set(self.types)
+            rows = itertools.chain(sample, rows)
+
+        parsers = self._parsers()
+        for lineno, r in rows:
+            for c, t, parse in parsers:
+                v = r.get(c)
+                if v:
+                    try:
+                        r[c] = parse(v)
+                    except ValueError:
+                        if self._widen(c, v):
+                            r[c] = _parse_float(v)
+                            parsers = self._parsers()
+                            continue
+
+                        message = 'CSV parse error on line {0}, {1} is not {2} in column {3}'
+                        if c in self._inferred:
+                            self._demote(c)
+                            raise TypeGuessError(message.format(lineno, v, t, c), line=lineno,
+                                                 column=c)
+                        raise CSVParseError(message.format(lineno, v, t, c), line=lineno)
+            yield lineno, r
+
+    def copy(self, without: Sequence[Column] = ()) -> 'Typer':
+        """
+        A typer starting from the types known so far, less the given columns,
+        which can go on widening or demoting inferred ones separately.
+        """
+        with self._lock:
+            types = (None if self.types is None
+                     else {c: t for c, t in self.types.items() if c not in without})
+            inferred = set(self._inferred)
+
+        typer = Typer(types, exclude=list(self.exclude))
+        typer._inferred = inferred
+        return typer
+
+    def _parsers(self) -> List[Tuple[Column, str, Callable[[str], Any]]]:
+        with self._lock:
+            return [(c, t, _PARSERS[t]) for c, t in (self.types or {}).items()]
+
+    def _widen(self, c: Column, v: str) -> bool:
+        "Widen an inferred int column to float, if the value is a float."
+        if c not in self._inferred or not _is_float(v):
+            return False
+
+        with self._lock:
+            # another reader may have found it isn't a number at all
+            if self.types is None or c not in self.types:
+                return False
+
+            self.types[c] = 'float'
+
+        # values already read stay ints, but compare equal to the same floats
+        return True
+
+    def _demote(self, c: Column) -> None:
+        "Leave an inferred column as text from now on."
+        with self._lock:
+            if self.types is not None:
+                self.types.pop(c, None)
+
+    def _infer(self, sample: List[Record]) -> Dict[Column, str]:
+        types = {}
+        columns = list(sample[0]) if sample else []
+        for c in columns:
+            if c in self.exclude:
+                continue
+
+            values = [r[c] for r in sample if r.get(c)]
+            if not values:
+                continue
+
+            if all(_is_int(v) for v in values):
+                types[c] = 'int'
+            elif all(_is_float(v) for v in values):
+                types[c] = 'float'
+
+        return types
+
+
+def _parse_float(v: str) -> float:
+    f = float(v)
+    if not math.isfinite(f):
+        # there's no way to write these in JSON
+        raise ValueError(v)
+
+    return f
+
+
+_PARSERS = {'int': int, 'float': _parse_float}  # type: Dict[str, Callable[[str], Any]]
+
+
+def _is_int(v: str) -> bool:
+    # only canonical integers, so that typing them loses nothing
+    return v.lstrip('-').isdigit() and str(int(v)) == v
+
+
+def _is_float(v: str) -> bool:
+    try:
+        _parse_float(v)
+    except ValueError:
+        return False
+
+    return True
+
+
+def make_typer(types: Any, exclude: Sequence[Column] = ()) -> Optional[Typer]:
+    """
+    A typer for the given types, either a dict of column types or a list of
+    "column:type" strings, or inferring them for "auto" except in the
+    excluded columns. Given a typer, it starts from the types it has so far.
+    """
+    if not types:
+        return None
+
+    if types == 'auto':
+        return Typer(exclude=exclude)
+
+    if isinstance(types, Typer):
+        # each user of a shared typer widens or demotes its columns alone
+        return types.copy()
+
+    if not isinstance(types, dict):
+        types = parse_types(types)
+
+    return Typer(types)
+
+
+def parse_types(spec: Sequence[str]) -> Dict[Column, str]:
+    "Read column types given as \"column:type\" strings."
+    types = {}
+    for s in spec:
+        c, _, t = s.rpartition(':')
+        if not c or t not in TYPES:
+            raise ValueError('invalid column type {0}, expected column:{1}'.format(
+                s, '|'.join(TYPES)))
+        types[c] = t
+
+    return types
+
+
 class SafeDictReader:
     """
     A CSV reader that streams records but gives nice errors if lines fail to parse.
     """
-    def __init__(self, istream: TextIO, sep: str = ',') -> None:
+    def __init__(self, istream: TextIO, sep: str = ',',
+                 interner: Optional[Interner] = None,
+                 typer: Optional[Typer] = None) -> None:
         # bump the built-in limits on field sizes
         csv.field_size_limit(2**24)
 
+        self.istream = istream
         self.reader = csv.DictReader(istream, delimiter=sep)
+        self.interner = interner
+        self.typer = typer
 
     def __iter__(self) -> Iterator[Record]:
+        if stats.enabled():
+            return self._iter_timed()
+
+        return self._iter()
+
+    def _iter(self) -> Iterator[Record]:
+        if self.typer is not None:
+            return self._iter_typed(self.typer)
+
+        return self._iter_untyped()
+
+    def _iter_untyped(self) -> Iterator[Record]:
+        interner = self.interner
         for lineno, r in enumerate(self.reader, 2):
             if any(k is None for k in r):
-                error.abort('CSV parse error on line {}'.format(lineno))
+                raise CSVParseError('CSV parse error on line {}'.format(lineno), line=lineno)
+
+            if interner is not None:
+                yield interner.intern(dict(r))
+            else:
+                yield dict(r)
+
+    def _iter_typed(self, typer: Typer) -> Iterator[Record]:
+        interner = self.interner
+        for _, r in typer.type_rows(self._rows()):
+            if interner is not None:
+                yield interner.intern(r)
+            else:
+                yield r
+
+    def _rows(self) -> Iterator[Tuple[int, Record]]:
+        for lineno, r in enumerate(self.reader, 2):
+            if any(k is None for k in r):
+                raise CSVParseError('CSV parse error on line {}'.format(lineno), line=lineno)
+
+            yield lineno, dict(r)
+
+    def _iter_timed(self) -> Iterator[Record]:
+        "Iterate as normal, but count time spent parsing towards its own phase."
+        seconds = 0.0
+        rows = 0
+        it = self._iter()
+        stats.start('parse')
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    r = next(it)
+                except StopIteration:
+                    break
+                seconds += time.perf_counter() - t0
+                rows += 1
+                if rows % PROGRESS_INTERVAL == 0:
+                    stats.progress('parse', self.bytes_read(), self.total_bytes())
+                yield r
+        finally:
+            stats.end('parse', seconds, rows)
+
+    def bytes_read(self) -> int:
+        "Roughly how far through the underlying file we are, in bytes."
+        try:
+            return self.istream.buffer.tell()  # type: ignore
+        except (AttributeError, OSError, ValueError):
+            return 0
+
+    def total_bytes(self) -> Optional[int]:
+        "The size of the underlying file, if it has one."
+        try:
+            size = os.fstat(self.istream.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            return None
 
-            yield dict(r)
+        # pipes and other special files report a size of zero
+        return size or None
 
     @property
     def fieldnames(self):
         return self.reader._fieldnames
 
 
-def load(file_or_stream: Any, sep: str = ',') -> SafeDictReader:
+class ReadAheadReader(io.RawIOBase):
+    """
+    Reads a binary stream in a background thread, keeping a few chunks ahead
+    of the consumer so that slow reads overlap with decoding and parsing.
+    """
+    def __init__(self, raw: Any, chunk_size: int = 2**20, depth: int = 4) -> None:
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self._chunks = queue.Queue(depth)  # type: queue.Queue
+        self._chunk = memoryview(b'')
+        self._offset = 0
+        self._eof = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                chunk = self.raw.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item: Any) -> None:
+        # give up if the reader is closed before it finishes reading
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        if not self._chunk:
+            if self._eof:
+                return 0
+
+            item = self._chunks.get()
+            if isinstance(item, Exception):
+                raise item
+
+            if not item:
+                self._eof = True
+                return 0
+
+            self._chunk = memoryview(item)
+
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        self._offset += n
+        return n
+
+    def tell(self) -> int:
+        return self._offset
+
+    def fileno(self) -> int:
+        return self.raw.fileno()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stopped.set()
+
+            # a read from stdin might block indefinitely, but leaving it to
+            # the daemon thread is harmless
+            if self.raw is not sys.stdin.buffer:
+                self._thread.join()
+                self.raw.close()
+
+        super(ReadAheadReader, self).close()
+
+
+def open_csv(filename: str, read_ahead: bool = True) -> TextIO:
+    """
+    Open a CSV file for reading, or stdin if the filename is "-". With
+    read-ahead, the file is read in a background thread while it's parsed.
+    """
+    if not read_ahead:
+        return sys.stdin if filename == '-' else open(filename)
+
+    raw = sys.stdin.buffer if filename == '-' else open(filename, 'rb', buffering=0)
+    return io.TextIOWrapper(io.BufferedReader(ReadAheadReader(raw)))
+
+
+def load(file_or_stream: Any, sep: str = ',', interner: Optional[Interner] = None,
+         typer: Optional[Typer] = None) -> SafeDictReader:
     istream = (open(file_or_stream)
                if not hasattr(file_or_stream, 'read')
                else file_or_stream)
-    return SafeDictReader(istream, sep=sep)
+    return SafeDictReader(istream, sep=sep, interner=interner, typer=typer)
+
+
+def iter_offsets(istream: BinaryIO, sep: str = ',',
+                 start: int = 0) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Read rows from a binary stream as lists of fields, along with the byte
+    offset each one starts at, counting from start. Blank lines are skipped.
+    """
+    csv.field_size_limit(2**24)
+
+    lines = _TrackedLines(istream, start)
+    reader = csv.reader(lines, delimiter=sep)
+    offset = start
+    for row in reader:
+        if row:
+            yield offset, row
+        offset = lines.offset
+
+
+def read_at(istream: BinaryIO, offset: int, sep: str = ',') -> List[str]:
+    "Read the single row starting at this byte offset."
+    istream.seek(offset)
+    return next(csv.reader(_TrackedLines(istream, offset), delimiter=sep), [])
+
 
+def pad_row(row: List[str], columns: List[Column], where: str) -> List[Any]:
+    "Fill in missing trailing fields as None, as csv.DictReader does."
+    if len(row) > len(columns):
+        raise CSVParseError('CSV parse error {}'.format(where))
 
-def index(record_seq: Iterator[Record], index_columns: List[str]) -> Index:
+    return row + [None] * (len(columns) - len(row))
+
+
+class _TrackedLines:
+    """
+    Lines of a binary stream as text, keeping track of the offset reached.
+    The csv module reads no further than the end of each row, so between rows
+    this is the offset of the next one.
+    """
+    def __init__(self, istream: BinaryIO, offset: int = 0) -> None:
+        self.istream = istream
+        self.offset = offset
+
+    def __iter__(self) -> Iterator[str]:
+        # readline() rather than iteration, so that the stream isn't read
+        # ahead of the rows
+        for line in iter(self.istream.readline, b''):
+            self.offset += len(line)
+            yield line.decode('utf8')
+
+
+def index(record_seq: Iterator[Record], index_columns: List[str],
+          packed: bool = False) -> Index:
+    """
+    Index records by their key columns. With packed, single-column integer
+    keys are stored as ints by pack_key(), so the original key must be read
+    back from the record itself.
+    """
     if not index_columns:
         raise InvalidKeyError('must provide on or more columns to index on')
 
     try:
-        obj = {
+        if packed and len(index_columns) == 1:
+            c, = index_columns
+            return {pack_key(r[c]): r for r in record_seq}
+
+        return {
             tuple(r[i] for i in index_columns): r
             for r in record_seq
         }
 
-        return obj
-
     except KeyError as k:
         raise InvalidKeyError('invalid column name {k} as key'.format(k=k))
 
 
+def pack_key(v: Any) -> PackedKey:
+    """
+    A compact equivalent of a single-column key: a native int if the value is
+    an integer, or else the usual one-element tuple. Two keys pack equal
+    exactly when they are equal.
+    """
+    try:
+        n = int(v)
+    except (TypeError, ValueError):
+        return (v,)
+
+    # only canonical integers from text, so that "007" and "7" remain
+    # distinct keys, and a typed 7 doesn't collide with "7"
+    return n if str(n) == v else (v,)
+
+
 def filter_ignored(index: Index, ignore_columns: List[Column]) -> Index:
     for record in index.values():
         # edit the record in-place
@@ -77,17 +611,30 @@ def filter_ignored(index: Index, ignore_columns: List[Column]) -> Index:
 
 
 def save(records: Sequence[Record], fieldnames: List[Column], ostream: TextIO):
-    writer = csv.DictWriter(ostream, fieldnames)
-    writer.writeheader()
-    for r in records:
-        writer.writerow(r)
+    with stats.phase('write') as p:
+        writer = csv.DictWriter(ostream, fieldnames)
+        writer.writeheader()
+        for r in records:
+            writer.writerow(r)
+        p.rows = len(records)
 
 
-def sort(records: Sequence[Record]) -> List[Record]:
+def sort(records: Iterable[Record]) -> List[Record]:
     "Sort records into a canonical order, suitable for comparison."
-    return sorted(records, key=_record_key)
+    records = list(records)
+    try:
+        return sorted(records, key=_record_key)
+
+    except TypeError:
+        # typed columns may mix numbers with empty strings
+        return sorted(records, key=_mixed_record_key)
 
 
 def _record_key(record: Record) -> List[Tuple[Column, str]]:
     "An orderable representation of this record."
     return sorted(record.items())
+
+
+def _mixed_record_key(record: Record) -> List[Tuple[Column, str, Any]]:
+    "Like _record_key(), for when a column mixes types."
+    return sorted((c, type(v).__name__, v) for c, v in record.items())
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+#  shard.py
+#  csvdiff
+#
+
+"""
+Splitting a pair of large files into shards which can be diffed separately,
+on different machines, and merging their patches back into one.
+
+Rows are given to shards by their key, either by a hash of it or by ranges
+of keys sampled from the first file, so that the old and new versions of a
+row always land in the same shard. The shards are described by a manifest in
+the format "csvdiff batch" takes, and merging the patches of all the shards
+gives exactly the patch which diffing the whole files would.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import bisect
+import csv
+import functools
+import itertools
+import json
+import os
+import random
+import zlib
+
+from . import patch, records, stats
+
+
+Entry = Dict[str, Any]
+Key = Tuple[str, ...]
+
+METHODS = ('hash', 'range')
+
+MANIFEST = 'manifest.jsonl'
+
+# how many keys to sample when choosing the boundaries of key ranges
+SAMPLE_KEYS = 100000
+
+
+def plan(from_file: str, to_file: str, index_columns: List[str], shards: int,
+         output_dir: str, method: str = 'hash', sep: str = ',') -> List[Entry]:
+    """
+    Split both files into shards in output_dir, writing a manifest with an
+    entry to diff each shard, and returning the entries. Shard boundaries are
+    by a hash of each row's key, or with method='range', by ranges of keys in
+    text order.
+    """
+    if method not in METHODS:
+        raise ValueError('unknown sharding method {0}'.format(method))
+
+    if shards < 1:
+        raise ValueError('need at least one shard')
+
+    if not index_columns:
+        raise records.InvalidKeyError('must provide on or more columns to index on')
+
+    if method == 'range':
+        shard_of = functools.partial(bisect.bisect_right,
+                                     _boundaries(from_file, index_columns, shards, sep))
+    else:
+        shard_of = functools.partial(_hash_shard, shards=shards)
+
+    from_columns, from_rows = _split(from_file, 'from', index_columns, shard_of, shards,
+                                     output_dir, sep)
+    to_columns, to_rows = _split(to_file, 'to', index_columns, shard_of, shards,
+                                 output_dir, sep)
+
+    # a shard without rows on one side can't tell how the columns changed
+    alignment = patch.Alignment(from_columns, to_columns)
+    columns = (alignment.as_dict() if from_rows and to_rows and not alignment.same
+               else None)
+
+    entries = []
+    for i in range(shards):
+        entry = {
+            'index': index_columns,
+            'from': _shard_name(i, 'from.csv'),
+            'to': _shard_name(i, 'to.csv'),
+            'output': _shard_name(i, 'json'),
+        }
+        if sep != ',':
+            entry['sep'] = sep
+        if columns is not None:
+            entry['columns'] = columns
+        entries.append(entry)
+
+    with open(os.path.join(output_dir, MANIFEST), 'w') as ostream:
+        for entry in entries:
+            print(json.dumps(entry, sort_keys=True), file=ostream)
+
+    return entries
+
+
+def merge(diffs: Sequence[Dict[str, Any]],
+          columns: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+    """
+    Combine the patches for each shard into the one which diffing the whole
+    files would give. Without the column changes from the manifest, those
+    the shards found are used.
+    """
+    if not diffs:
+        raise ValueError('need at least one patch to merge')
+
+    index_columns = diffs[0]['_index']
+    for diff in diffs:
+        if diff['_index'] != index_columns:
+            raise patch.InvalidPatchError('cannot merge patches with different indexes')
+
+        if diff.get('_columns') is not None:
+            if columns is not None and diff['_columns'] != columns:
+                raise patch.InvalidPatchError('cannot merge patches with different columns')
+            columns = diff['_columns']
+
+    merged = {'_index': index_columns}  # type: Dict[str, Any]
+    if columns is not None:
+        merged['_columns'] = columns
+
+    types = {}  # type: Dict[str, str]
+    for diff in diffs:
+        types.update(diff.get('_types', {}))
+    if types:
+        merged['_types'] = types
+
+    with stats.phase('merge') as p:
+        merged['added'] = records.sort(itertools.chain.from_iterable(
+            d['added'] for d in diffs))
+        merged['removed'] = records.sort(itertools.chain.from_iterable(
+            d['removed'] for d in diffs))
+        merged['changed'] = sorted(itertools.chain.from_iterable(d['changed'] for d in diffs),
+                                   key=patch._change_key)
+        p.rows = len(merged['added']) + len(merged['removed']) + len(merged['changed'])
+
+    return merged
+
+
+def _split(filename: str, side: str, index_columns: List[str],
+           shard_of: Callable[[Key], int], shards: int, output_dir: str,
+           sep: str) -> Tuple[List[str], int]:
+    "Write each row of the file to its shard, returning the columns and row count."
+    ostreams = [open(os.path.join(output_dir, _shard_name(i, side + '.csv')), 'w', newline='')
+                for i in range(shards)]
+    try:
+        writers = [csv.writer(o, delimiter=sep) for o in ostreams]
+        with stats.phase('shard') as p, records.open_csv(filename) as istream:
+            reader = csv.reader(istream, delimiter=sep)
+            columns = next(reader, [])
+            if not columns:
+                return columns, 0
+
+            positions = _positions(columns, index_columns)
+            for w in writers:
+                w.writerow(columns)
+
+            n = 0
+            for row in reader:
+                if row:
+                    writers[shard_of(_key(row, positions))].writerow(row)
+                    n += 1
+            p.rows = n
+
+    finally:
+        for o in ostreams:
+            o.close()
+
+    return columns, n
+
+
+def _boundaries(filename: str, index_columns: List[str], shards: int, sep: str) -> List[Key]:
+    "The keys splitting a sample of the file's keys into equal ranges."
+    # a fixed seed keeps the shards the same from one run to the next
+    rand = random.Random(0)
+    sample = []  # type: List[Key]
+    with stats.phase('sample_keys') as p, records.open_csv(filename) as istream:
+        reader = csv.reader(istream, delimiter=sep)
+        columns = next(reader, [])
+        if not columns:
+            return []
+
+        positions = _positions(columns, index_columns)
+        n = 0
+        for row in reader:
+            if not row:
+                continue
+            n += 1
+            if len(sample) < SAMPLE_KEYS:
+                sample.append(_key(row, positions))
+            else:
+                i = rand.randrange(n)
+                if i < SAMPLE_KEYS:
+                    sample[i] = _key(row, positions)
+        p.rows = n
+
+    sample.sort()
+    return [sample[len(sample) * i // shards] for i in range(1, shards) if sample]
+
+
+def _positions(columns: List[str], index_columns: List[str]) -> List[int]:
+    try:
+        return [columns.index(c) for c in index_columns]
+    except ValueError:
+        missing = [c for c in index_columns if c not in columns]
+        raise records.InvalidKeyError('invalid column name {0!r} as key'.format(missing[0]))
+
+
+def _key(row: List[str], positions: List[int]) -> Key:
+    return tuple(row[i] if i < len(row) else '' for i in positions)
+
+
+def _hash_shard(key: Key, shards: int) -> int:
+    # unlike hash(), the same in every process
+    return zlib.crc32('\x1f'.join(key).encode('utf8')) % shards
+
+
+def _shard_name(i: int, suffix: str) -> str:
+    return 'shard-{0:03d}.{1}'.format(i, suffix)
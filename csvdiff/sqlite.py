@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+#  sqlite.py
+#  csvdiff
+#
+
+"""
+Reading records from a SQLite table or query, for diffing against a CSV file.
+
+Values are converted to the text they would have in a CSV dump, with NULL as
+the empty string, so that they compare equal to the matching CSV fields.
+"""
+
+from typing import Any, Dict, Iterator, Iterable, List, Optional, Tuple
+import itertools
+import sqlite3
+
+from . import patch, records, stats
+
+
+DEFAULT_BATCH_SIZE = 500
+
+# older builds of SQLite allow at most this many bound parameters
+MAX_VARIABLES = 999
+
+
+def load(db_path: str, table: Optional[str] = None,
+         query: Optional[str] = None) -> Iterator[records.Record]:
+    """
+    Stream the rows of a table, or of the results of a query, as records.
+    Suitable for passing to patch.create() in place of a CSV reader.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute(_select(table, query))
+        columns = [d[0] for d in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, map(_as_text, row)))
+
+    finally:
+        conn.close()
+
+
+def count(db_path: str, table: Optional[str] = None, query: Optional[str] = None) -> int:
+    "How many rows are in the table or query results?"
+    conn = sqlite3.connect(db_path)
+    try:
+        sql = 'SELECT COUNT(*) FROM ({0})'.format(_select(table, query))
+        return conn.execute(sql).fetchone()[0]
+
+    finally:
+        conn.close()
+
+
+def diff_table(recs: Iterable[records.Record], db_path: str, index_columns: List[str],
+               table: Optional[str] = None, query: Optional[str] = None,
+               table_side: str = 'to', ignore_columns: Optional[List[str]] = None,
+               batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Diff a stream of records against a SQLite table without indexing the
+    table in memory. Records are looked up in the table in batches by key,
+    so the table should have an index on the key columns; only the keys of
+    the streamed records are held in memory.
+
+    By default the table is the "to" side of the diff; use table_side='from'
+    to reverse this.
+    """
+    if table_side not in ('from', 'to'):
+        raise ValueError('table_side must be "from" or "to"')
+
+    if not index_columns:
+        raise records.InvalidKeyError('must provide on or more columns to index on')
+
+    batch_size = max(1, min(batch_size, MAX_VARIABLES // len(index_columns)))
+
+    only_streamed = []
+    only_table = []
+    changed = []
+    seen = set()
+
+    alignment = None  # type: Optional[patch.Alignment]
+
+    conn = sqlite3.connect(db_path)
+    try:
+        # the table's columns, if it has any rows to compare them by
+        cursor = conn.execute('SELECT * FROM ({0}) LIMIT 1'.format(_select(table, query)))
+        table_columns = ([c for c in (d[0] for d in cursor.description)
+                          if c not in (ignore_columns or [])]
+                         if cursor.fetchone() is not None else None)
+
+        with stats.phase('lookup') as p:
+            p.rows = 0
+            for batch in _batches(iter(recs), batch_size):
+                if alignment is None:
+                    alignment = _align(list(_without(batch[0], ignore_columns)),
+                                       table_columns, table_side)
+
+                keyed = {_key(r, index_columns): r for r in batch}
+
+                found = _lookup(conn, table, query, index_columns, list(keyed))
+                for k, r in keyed.items():
+                    seen.add(k)
+                    t = found.get(k)
+                    if t is None:
+                        only_streamed.append(_without(r, ignore_columns))
+                        continue
+
+                    lhs, rhs = _without(r, ignore_columns), _without(t, ignore_columns)
+                    if table_side == 'from':
+                        lhs, rhs = rhs, lhs
+                    if alignment.differs(lhs, rhs):
+                        changed.append({'key': list(k), 'fields': alignment.diff(lhs, rhs)})
+
+                p.rows += len(batch)
+
+        # anything in the table we didn't look up is only on the table's side
+        with stats.phase('scan') as p:
+            cursor = conn.execute(_select(table, query))
+            columns = [d[0] for d in cursor.description]
+            try:
+                positions = [columns.index(c) for c in index_columns]
+            except ValueError:
+                raise records.InvalidKeyError('invalid key columns for table')
+
+            for row in cursor:
+                if tuple(_as_text(row[i]) for i in positions) not in seen:
+                    t = dict(zip(columns, map(_as_text, row)))
+                    only_table.append(_without(t, ignore_columns))
+            p.rows = len(only_table)
+
+    finally:
+        conn.close()
+
+    if table_side == 'from':
+        removed, added = only_table, only_streamed
+    else:
+        removed, added = only_streamed, only_table
+
+    with stats.phase('assemble'):
+        diff = {'_index': index_columns}  # type: Dict[str, Any]
+        if alignment is not None and not alignment.same:
+            diff['_columns'] = alignment.as_dict()
+        diff['added'] = records.sort(added)
+        diff['removed'] = records.sort(removed)
+        diff['changed'] = sorted(changed, key=patch._change_key)
+        return diff
+
+
+def _align(streamed_columns: List[str], table_columns: Optional[List[str]],
+           table_side: str) -> patch.Alignment:
+    "Align the columns as patch.create() would, ignoring them if the table is empty."
+    if table_columns is None:
+        return patch.Alignment(streamed_columns, streamed_columns)
+
+    if table_side == 'from':
+        return patch.Alignment(table_columns, streamed_columns)
+
+    return patch.Alignment(streamed_columns, table_columns)
+
+
+def _lookup(conn: sqlite3.Connection, table: Optional[str], query: Optional[str],
+            index_columns: List[str],
+            keys: List[Tuple[str, ...]]) -> Dict[Tuple[str, ...], records.Record]:
+    "Fetch the rows matching a batch of keys, indexed by key."
+    if len(index_columns) == 1:
+        condition = '{0} IN ({1})'.format(
+            _quote(index_columns[0]), ', '.join('?' * len(keys))
+        )
+    else:
+        # row values with IN (VALUES ...) would be tidier, but SQLite only uses
+        # an index to look up a disjunction of equalities
+        row = '({0})'.format(' AND '.join('{0} = ?'.format(_quote(c))
+                                          for c in index_columns))
+        condition = ' OR '.join([row] * len(keys))
+
+    sql = 'SELECT * FROM ({0}) WHERE {1}'.format(_select(table, query), condition)
+    cursor = conn.execute(sql, list(itertools.chain.from_iterable(keys)))
+    columns = [d[0] for d in cursor.description]
+
+    found = {}
+    for row in cursor:
+        r = dict(zip(columns, map(_as_text, row)))
+        found[_key(r, index_columns)] = r
+
+    return found
+
+
+def _select(table: Optional[str], query: Optional[str]) -> str:
+    if table is not None and query is None:
+        return 'SELECT * FROM {0}'.format(_quote(table))
+
+    if query is not None and table is None:
+        return query
+
+    raise ValueError('need exactly one of a table or a query')
+
+
+def _quote(identifier: str) -> str:
+    return '"{0}"'.format(identifier.replace('"', '""'))
+
+
+def _as_text(value: Any) -> str:
+    if value is None:
+        return ''
+
+    if isinstance(value, bytes):
+        return value.decode('utf8')
+
+    return str(value)
+
+
+def _key(r: records.Record, index_columns: List[str]) -> Tuple[str, ...]:
+    try:
+        return tuple(r[c] for c in index_columns)
+    except KeyError as k:
+        raise records.InvalidKeyError('invalid column name {k} as key'.format(k=k))
+
+
+def _without(r: records.Record, ignore_columns: Optional[List[str]]) -> records.Record:
+    if not ignore_columns:
+        return r
+
+    return {k: v for k, v in r.items() if k not in ignore_columns}
+
+
+def _batches(it: Iterator[records.Record],
+             batch_size: int) -> Iterator[List[records.Record]]:
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+#  stats.py
+#  csvdiff
+#
+
+"""
+Hooks for instrumenting the phases of a diff or patch.
+
+Library users can attach their own timers or metrics exporters by subclassing
+Hook and registering it with add_hook(). The PhaseStats hook collects the
+per-phase breakdown shown by the --stats option, and the progress module
+provides the reporter behind --progress.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+from contextlib import contextmanager
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+
+class Hook:
+    "Base class for observers of the diff and patch phases."
+    def on_start(self, phase: str) -> None:
+        pass
+
+    def on_end(self, phase: str, seconds: float, rows: Optional[int]) -> None:
+        pass
+
+    def on_progress(self, phase: str, done: int, total: Optional[int]) -> None:
+        "Periodic updates from long phases, counting bytes consumed so far."
+        pass
+
+
+_hooks = []  # type: List[Hook]
+
+
+def add_hook(hook: Hook) -> None:
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    _hooks.remove(hook)
+
+
+def enabled() -> bool:
+    "Is anybody listening? Instrumented code can skip its bookkeeping if not."
+    return bool(_hooks)
+
+
+def start(name: str) -> None:
+    for hook in _hooks:
+        hook.on_start(name)
+
+
+def end(name: str, seconds: float, rows: Optional[int] = None) -> None:
+    for hook in _hooks:
+        hook.on_end(name, seconds, rows)
+
+
+def progress(name: str, done: int, total: Optional[int] = None) -> None:
+    for hook in _hooks:
+        hook.on_progress(name, done, total)
+
+
+class PhaseCounter:
+    "Lets the code inside a phase report how many rows it processed."
+    rows = None  # type: Optional[int]
+
+
+@contextmanager
+def phase(name: str) -> Iterator[PhaseCounter]:
+    "Time the enclosed block as the given phase."
+    counter = PhaseCounter()
+    if not _hooks:
+        yield counter
+        return
+
+    start(name)
+    t0 = time.perf_counter()
+    try:
+        yield counter
+    finally:
+        end(name, time.perf_counter() - t0, counter.rows)
+
+
+class PhaseStats(Hook):
+    """
+    Collects wall time, rows processed, peak RSS and net allocated objects for
+    each phase. Repeated phases, such as indexing each side of a diff, are
+    summed together.
+    """
+    def __init__(self) -> None:
+        self.phases = {}  # type: Dict[str, Dict[str, Any]]
+        self._started = {}  # type: Dict[Any, List[int]]
+
+    def on_start(self, phase: str) -> None:
+        k = (threading.get_ident(), phase)
+        self._started.setdefault(k, []).append(sys.getallocatedblocks())
+
+    def on_end(self, phase: str, seconds: float, rows: Optional[int]) -> None:
+        k = (threading.get_ident(), phase)
+        blocks = sys.getallocatedblocks() - self._started[k].pop()
+
+        s = self.phases.setdefault(phase, {'calls': 0, 'seconds': 0.0, 'rows': None,
+                                           'allocated_objects': 0})
+        s['calls'] += 1
+        s['seconds'] += seconds
+        s['allocated_objects'] += blocks
+        s['peak_rss_bytes'] = peak_rss()
+        if rows is not None:
+            s['rows'] = (s['rows'] or 0) + rows
+
+        s['rows_per_second'] = (s['rows'] / s['seconds']
+                                if s['rows'] is not None and s['seconds']
+                                else None)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'phases': [dict(s, phase=name) for name, s in self.phases.items()],
+            'peak_rss_bytes': peak_rss(),
+        }
+
+    def save(self, ostream: TextIO) -> None:
+        json.dump(self.as_dict(), ostream, indent=2, sort_keys=True)
+
+    def report(self, ostream: TextIO = sys.stderr) -> None:
+        "Print a human-readable table of the phases."
+        print('{0:<20} {1:>10} {2:>10} {3:>12} {4:>10} {5:>12}'.format(
+            'phase', 'seconds', 'rows', 'rows/s', 'peak MB', 'objects'
+        ), file=ostream)
+        for name, s in self.phases.items():
+            print('{0:<20} {1:>10.4f} {2:>10} {3:>12} {4:>10} {5:>12}'.format(
+                name,
+                s['seconds'],
+                '-' if s['rows'] is None else s['rows'],
+                '-' if s['rows_per_second'] is None else '{0:.0f}'.format(s['rows_per_second']),
+                '-' if s['peak_rss_bytes'] is None else '{0:.1f}'.format(
+                    s['peak_rss_bytes'] / 2**20
+                ),
+                s['allocated_objects'],
+            ), file=ostream)
+
+
+def peak_rss() -> Optional[int]:
+    "The peak resident set size of this process in bytes, if we can tell."
+    if resource is None:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
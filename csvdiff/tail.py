@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+#  tail.py
+#  csvdiff
+#
+
+"""
+Following an append-only CSV file as it grows, diffing only what was
+appended since the last look.
+
+The state kept between runs holds how far into the file has been read, a
+fingerprint of the bytes read so far, and the byte offset and digest of the
+latest row for each key. Each update parses only the newly appended bytes,
+giving a patch of the new rows, and of changes to rows whose key appears
+again, whose old versions are read back from their offsets. A half-written
+row at the end of the file is left for the next update. If the file has been
+truncated or rewritten, the rows the state points at are gone, so the update
+fails, and restart() diffs the whole file against the digests instead.
+"""
+
+from typing import Any, BinaryIO, Dict, List, Optional, TextIO, Tuple
+import hashlib
+import io
+import json
+import os
+
+from . import patch, records, stats
+
+
+State = Dict[str, Any]
+
+# a row's byte offset in the file, and the row
+Row = Tuple[int, records.Record]
+
+# the latest row for each key, as its byte offset and digest
+Entries = Dict[Tuple[Any, ...], Tuple[int, str]]
+
+VERSION = 3
+
+# how many bytes at each end of what's been read make up its fingerprint
+FINGERPRINT_BYTES = 2**16
+
+
+def state_path(filename: str) -> str:
+    "Where the state for a file is kept by default."
+    return filename + '.tail.json'
+
+
+def start(filename: str, index_columns: List[str], sep: str = ',') -> State:
+    "Read the whole file, giving the state to follow it from."
+    return _start(filename, index_columns, sep)[0]
+
+
+def _start(filename: str, index_columns: List[str],
+           sep: str) -> Tuple[State, Dict[Tuple[Any, ...], Row]]:
+    if not index_columns:
+        raise records.InvalidKeyError('must provide on or more columns to index on')
+
+    columns, rows, offset = _read(filename, 0, None, sep)
+    latest = _latest(rows, index_columns)
+    return _state(filename, index_columns, sep, columns, _entries(latest), offset), latest
+
+
+def update(filename: str, state: State) -> Tuple[Dict[str, Any], State]:
+    """
+    Diff what has been appended to the file since the state was taken,
+    returning the patch and the new state. Raises FileRewrittenError if the
+    file has been truncated or rewritten instead.
+    """
+    if is_rewritten(filename, state):
+        raise FileRewrittenError('the file was truncated or rewritten')
+
+    index_columns = state['index']
+    # without a header yet, the file has been empty so far
+    columns, rows, offset = _read(filename, state['offset'], state['columns'] or None,
+                                  state['sep'])
+    if offset == state['offset']:
+        return patch.create_indexed({}, {}, index_columns), state
+
+    appended = _latest(rows, index_columns)
+    keys = _load_entries(state)
+
+    # only rows with a key seen before can have changed, and none are removed
+    with stats.phase('read_changed') as p:
+        with open(filename, 'rb') as istream:
+            previous = [_read_at(istream, keys[k][0], columns, state['sep'])
+                        for k in appended if k in keys]
+        p.rows = len(previous)
+
+    diff = patch.create_indexed(
+        patch.index_records(previous, index_columns),
+        patch.index_records((r for _, r in rows), index_columns),
+        index_columns,
+    )
+
+    keys.update(_entries(appended))
+    return diff, _state(filename, index_columns, state['sep'], columns, keys, offset)
+
+
+def restart(filename: str, state: State) -> Tuple[Dict[str, Any], State]:
+    """
+    Diff a truncated or rewritten file as a whole against the rows the state
+    last saw, returning the patch and the state to follow it from. Only the
+    digests of the old rows are left, so rows which are gone or differ are
+    removed by digest, as digest_removed() gives them, and the current
+    versions of those which differ are added again.
+    """
+    index_columns = state['index']
+    new_state, latest = _start(filename, index_columns, state['sep'])
+    old = {k: d for k, (_, d) in _load_entries(state).items()}
+    new = {k: d for k, (_, d) in _entries(latest).items()}
+
+    removed = []
+    for k, d in sorted(old.items()):
+        if new.get(k) != d:
+            r = dict(zip(index_columns, k))
+            r[patch.DIGEST_FIELD] = d
+            removed.append(r)
+
+    diff = patch.create_indexed(
+        {},
+        {k: r for k, (_, r) in latest.items() if old.get(k) != new[k]},
+        index_columns,
+    )
+    diff['removed'] = removed
+    return diff, new_state
+
+
+def is_rewritten(filename: str, state: State) -> bool:
+    "Has the file been truncated or rewritten, rather than appended to?"
+    if os.path.getsize(filename) < state['offset']:
+        return True
+
+    return _fingerprint(filename, state['offset']) != state['fingerprint']
+
+
+def save(state: State, ostream: TextIO) -> None:
+    json.dump(state, ostream, sort_keys=True)
+
+
+def load(istream: TextIO) -> State:
+    try:
+        state = json.load(istream)
+    except ValueError:
+        raise InvalidStateError('state is not valid JSON')
+
+    if not isinstance(state, dict) or state.get('version') != VERSION:
+        raise InvalidStateError('unsupported state format')
+
+    return state
+
+
+class InvalidStateError(Exception):
+    pass
+
+
+class FileRewrittenError(Exception):
+    "The file no longer starts with what the state has read of it."
+    pass
+
+
+def _read(filename: str, offset: int, columns: Optional[List[str]],
+          sep: str) -> Tuple[List[str], List[Row], int]:
+    """
+    Parse the complete rows from the offset onwards, reading the header
+    first if no columns are given. Returns the columns, the rows with their
+    offsets, and the offset to carry on from next time.
+    """
+    with stats.phase('parse') as p:
+        with open(filename, 'rb') as istream:
+            istream.seek(offset)
+            data = istream.read()
+
+        # a row still being written has no newline yet, or an open quote
+        data = data[:data.rfind(b'\n') + 1]
+        rows = list(records.iter_offsets(io.BytesIO(data), sep, start=offset))
+        end = offset + len(data)
+        if rows and data[rows[-1][0] - offset:].count(b'"') % 2:
+            end = rows.pop()[0]
+
+        if columns is None:
+            if not rows:
+                return [], [], offset
+            columns = rows.pop(0)[1]
+
+        recs = [(o, _record(row, columns, o)) for o, row in rows]
+        p.rows = len(recs)
+
+    return columns, recs, end
+
+
+def _read_at(istream: BinaryIO, offset: int, columns: List[str], sep: str) -> records.Record:
+    return _record(records.read_at(istream, offset, sep=sep), columns, offset)
+
+
+def _record(row: List[str], columns: List[str], offset: int) -> records.Record:
+    return dict(zip(columns, records.pad_row(row, columns, 'at byte {}'.format(offset))))
+
+
+def _latest(rows: List[Row], index_columns: List[str]) -> Dict[Tuple[Any, ...], Row]:
+    "The last row for each key."
+    try:
+        return {tuple(r[c] for c in index_columns): (o, r) for o, r in rows}
+    except KeyError as k:
+        raise records.InvalidKeyError('invalid column name {k} as key'.format(k=k))
+
+
+def _entries(latest: Dict[Tuple[Any, ...], Row]) -> Entries:
+    return {k: (o, patch.row_digest(r)) for k, (o, r) in latest.items()}
+
+
+def _load_entries(state: State) -> Entries:
+    return {tuple(k): (o, d) for k, o, d in state['keys']}
+
+
+def _state(filename: str, index_columns: List[str], sep: str, columns: List[str],
+           keys: Entries, offset: int) -> State:
+    return {
+        'version': VERSION,
+        'index': index_columns,
+        'sep': sep,
+        'columns': columns,
+        'offset': offset,
+        'fingerprint': _fingerprint(filename, offset),
+        'keys': [[list(k), o, d] for k, (o, d) in keys.items()],
+    }
+
+
+def _fingerprint(filename: str, offset: int) -> str:
+    "A hash of the first and last bytes read so far."
+    h = hashlib.sha256()
+    with open(filename, 'rb') as istream:
+        h.update(istream.read(min(offset, FINGERPRINT_BYTES)))
+        istream.seek(max(0, offset - FINGERPRINT_BYTES))
+        h.update(istream.read(min(offset, FINGERPRINT_BYTES)))
+
+    return h.hexdigest()[:32]
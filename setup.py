@@ -31,8 +31,8 @@ setup(
     package_dir={'csvdiff': 'csvdiff'},
     entry_points={
         'console_scripts': [
-            'csvdiff = csvdiff:csvdiff_cmd',
-            'csvpatch = csvdiff:csvpatch_cmd',
+            'csvdiff = csvdiff.cli:csvdiff_cmd',
+            'csvpatch = csvdiff.cli:csvpatch_cmd',
         ],
     },
     include_package_data=True,
@@ -41,6 +41,9 @@ setup(
         'jsonschema>=2.4.0',
         'six>=1.10.0',
     ],
+    extras_require={
+        'numpy': ['numpy>=1.13'],
+    },
     license="BSD",
     zip_safe=False,
     keywords='csvdiff',
@@ -10,14 +10,26 @@ from os import path
 import csv
 import json
 import os
+import pickle
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import csvdiff
-from csvdiff import patch, records
+from csvdiff import (batch, cli, daemon, lookup, merkle, patch, records, stats, progress,
+                     shard, sqlite, tail)
 
 from click.testing import CliRunner
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TestCsvdiff(unittest.TestCase):
     def setUp(self):
@@ -81,6 +93,17 @@ class TestCsvdiff(unittest.TestCase):
 
         return RunResult(result.exit_code, recs, result.output)
 
+    def test_import_is_lazy(self):
+        # keep startup fast for library users and for repeated command-line runs
+        code = ('import sys, csvdiff; '
+                'print(" ".join(m for m in ["click", "jsonschema", "multiprocessing", '
+                '"concurrent.futures", "sqlite3"] if m in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=path.dirname(path.dirname(__file__)))
+        self.assertEqual(output.strip(), b'')
+
+        assert csvdiff.csvdiff_cmd is cli.csvdiff_cmd
+
     def test_summarize(self):
         lhs = [
             {'name': 'a', 'sheep': '7'},
@@ -117,8 +140,8 @@ class TestCsvdiff(unittest.TestCase):
         ]
         with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
             result = self.csvdiff_summary_cmd('name', lhs_file, rhs_file)
-            self.assertEquals(result.exit_code, 1)
-            self.assertEquals(
+            self.assertEqual(result.exit_code, 1)
+            self.assertEqual(
                 result.summary,
                 "1 rows removed (33.3%)\n"
                 "1 rows added (33.3%)\n"
@@ -143,10 +166,10 @@ class TestCsvdiff(unittest.TestCase):
 
     def test_csvdiff_fails_without_enough_arguments(self):
         result = self.csvdiff_cmd()
-        self.assertEquals(result.exit_code, 2)
+        self.assertEqual(result.exit_code, 2)
 
         result = self.csvdiff_cmd(self.a_file, self.b_file)
-        self.assertEquals(result.exit_code, 2)
+        self.assertEqual(result.exit_code, 2)
 
     def test_csvdiff_fails_without_valid_key(self):
         result = self.csvdiff_cmd('abcd', self.a_file, self.b_file)
@@ -195,6 +218,779 @@ class TestCsvdiff(unittest.TestCase):
 
         self.assertPatchesEqual(diff, expected)
 
+    def test_diff_files_from_stdin(self):
+        with open(self.b_file) as istream:
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('id', self.a_file, '-'),
+                                        input=istream.read())
+        self.assertEqual(result.exit_code, 1)
+        self.assertPatchesEqual(json.loads(result.output),
+                                csvdiff.diff_files(self.a_file, self.b_file, ['id']))
+
+    def test_read_ahead_matches_plain_read(self):
+        with records.open_csv(self.a_file) as istream:
+            read_ahead = istream.read()
+        with open(self.a_file) as istream:
+            self.assertEqual(read_ahead, istream.read())
+
+    def test_interned_values_are_shared(self):
+        interner = records.make_interner(['status'])
+        recs = list(records.load(StringIO('id,status\n1,open\n2,open\n'),
+                                 interner=interner))
+        self.assertIs(recs[0]['status'], recs[1]['status'])
+
+    def test_interner_auto_skips_unique_columns(self):
+        interner = records.Interner()
+        interner.AUTO_SAMPLE = 20
+        istream = StringIO('id,status\n' + ''.join('{0},{1}\n'.format(i, 'ab'[i % 2])
+                                                   for i in range(40)))
+        recs = list(records.load(istream, interner=interner))
+        self.assertEqual(list(interner.caches), ['status'])
+        self.assertIs(recs[-1]['status'], recs[-3]['status'])
+
+    def test_interner_auto_is_shared_by_threads(self):
+        class SlowInterner(records.Interner):
+            AUTO_SAMPLE = 20
+
+            def _sample(self, r):
+                if self.sampled == self.AUTO_SAMPLE - 1:
+                    # give the other reader a chance to reach the last sample too
+                    time.sleep(0.05)
+                super(SlowInterner, self)._sample(r)
+
+        interner = SlowInterner()
+        text = 'id,status\n' + ''.join('{0},{1}\n'.format(i, 'ab'[i % 2])
+                                       for i in range(40))
+
+        def load():
+            for _ in records.load(StringIO(text), interner=interner):
+                pass
+
+        threads = [threading.Thread(target=load) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # no reader brings back a column once sampling has dropped it
+        self.assertEqual(interner.sampled, interner.AUTO_SAMPLE)
+        self.assertEqual(list(interner.caches), ['status'])
+
+    def test_diff_files_interned(self):
+        for intern in ['auto', ['name']]:
+            self.assertPatchesEqual(
+                csvdiff.diff_files(self.a_file, self.b_file, ['id'], intern=intern),
+                csvdiff.diff_files(self.a_file, self.b_file, ['id']),
+            )
+
+    def test_pack_key(self):
+        self.assertEqual(records.pack_key('42'), 42)
+        self.assertEqual(records.pack_key('-7'), -7)
+        for v in ['007', '+7', ' 7', '1_000', '7.0', 'abc', 7]:
+            self.assertEqual(records.pack_key(v), (v,))
+
+    def test_packed_keys_keep_original_strings(self):
+        from_recs = [{'id': '1', 'v': 'a'}, {'id': '01', 'v': 'b'}, {'id': 'x', 'v': 'c'}]
+        to_recs = [{'id': '1', 'v': 'z'}, {'id': '01', 'v': 'b'}, {'id': 'x', 'v': 'y'}]
+        diff = patch.create(from_recs, to_recs, ['id'])
+        self.assertEqual([c['key'] for c in diff['changed']], [['1'], ['x']])
+        self.assertEqual(diff['added'], [])
+        self.assertEqual(diff['removed'], [])
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_columnar_matches_python_engine(self):
+        self.assertPatchesEqual(
+            csvdiff.diff_files(self.a_file, self.b_file, ['id'], engine='numpy'),
+            csvdiff.diff_files(self.a_file, self.b_file, ['id']),
+        )
+
+        # short rows are padded and blank lines skipped, as csv.DictReader does
+        with tempfile.TemporaryDirectory() as tmpdir:
+            short, full = path.join(tmpdir, 'short.csv'), path.join(tmpdir, 'full.csv')
+            with open(short, 'w') as ostream:
+                ostream.write('id,a,b\n1,x\n\n2,y,z\n')
+            with open(full, 'w') as ostream:
+                ostream.write('id,a,b\n1,x,\n2,y,z\n')
+            self.assertPatchesEqual(csvdiff.diff_files(short, full, ['id'], engine='numpy'),
+                                    csvdiff.diff_files(short, full, ['id']))
+
+        from csvdiff import columnar
+        from_recs = [{'k1': 'a', 'k2': '1', 'x': '1.00', 'y': 'p'},
+                     {'k1': 'a', 'k2': '2', 'x': '2.5', 'y': 'q'},
+                     {'k1': 'b', 'k2': '1', 'x': 'n/a', 'y': 'r'},
+                     {'k1': 'c', 'k2': '1', 'x': '7', 'y': 's'}]
+        to_recs = [{'k1': 'a', 'k2': '1', 'x': '1.001', 'y': 'p'},
+                   {'k1': 'a', 'k2': '2', 'x': '2.5', 'y': 'Q'},
+                   {'k1': 'b', 'k2': '1', 'x': '3', 'y': 'r'},
+                   {'k1': 'd', 'k2': '1', 'x': '7', 'y': 's'}]
+
+        for significance in [None, 1, 3]:
+            expected = patch.create(from_recs, to_recs, ['k1', 'k2'])
+            if significance is not None:
+                expected = patch.filter_significance(expected, significance)
+            diff = columnar.create(columnar.Table.from_records(from_recs),
+                                   columnar.Table.from_records(to_recs), ['k1', 'k2'],
+                                   significance=significance)
+            self.assertPatchesEqual(diff, expected)
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_columnar_command(self):
+        result = self.csvdiff_cmd('--engine', 'numpy', 'id', self.a_file, self.b_file)
+        self.assertEqual(result.exit_code, 1)
+        self.assertPatchesEqual(result.diff,
+                                csvdiff.diff_files(self.a_file, self.b_file, ['id']))
+
+    def test_diff_command_csv_format(self):
+        result = self.runner.invoke(csvdiff.csvdiff_cmd, ('--format', 'csv', 'id',
+                                                          self.a_file, self.b_file))
+        self.assertEqual(result.exit_code, 1)
+        rows = sorted(csv.DictReader(StringIO(result.output)), key=lambda r: r['id'])
+        self.assertEqual([(r['_change'], r['id']) for r in rows],
+                         [('changed', '1'), ('removed', '2'), ('added', '5'),
+                          ('changed', '6')])
+        self.assertEqual((rows[0]['amount_from'], rows[0]['amount_to'], rows[0]['name_to']),
+                         ('20', '23', ''))
+        self.assertEqual((rows[2]['name_from'], rows[2]['name_to']), ('', 'mira'))
+
+        result = self.runner.invoke(csvdiff.csvdiff_cmd, ('--format', 'csv', 'id',
+                                                          self.a_file, self.a_file))
+        self.assertEqual(result.exit_code, 0)
+
+    def test_diff_command_csv_sections(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                '--format', 'csv-sections', '--output-dir', output_dir, 'id',
+                self.a_file, self.b_file,
+            ))
+            self.assertEqual(result.exit_code, 1)
+            self.assertEqual(sorted(os.listdir(output_dir)),
+                             ['added.csv', 'changed.csv', 'removed.csv'])
+
+            diff = csvdiff.diff_files(self.a_file, self.b_file, ['id'])
+            with open(path.join(output_dir, 'added.csv')) as istream:
+                self.assertEqual(list(csv.DictReader(istream)), diff['added'])
+            with open(path.join(output_dir, 'removed.csv')) as istream:
+                self.assertEqual(list(csv.DictReader(istream)), diff['removed'])
+            with open(path.join(output_dir, 'changed.csv')) as istream:
+                self.assertEqual([r['id'] for r in csv.DictReader(istream)], ['1', '6'])
+
+    def test_diff_files_many_matches_diff_files(self):
+        c_file = path.join(self.examples, 'c.csv')
+        targets = [self.b_file, c_file, self.a_file]
+        expected = [(t, csvdiff.diff_files(self.a_file, t, ['id'])) for t in targets]
+
+        for jobs in [1, 2]:
+            results = list(csvdiff.diff_files_many(self.a_file, targets, ['id'],
+                                                   jobs=jobs))
+            self.assertEqual([t for t, _ in results], targets)
+            for (_, diff), (_, expected_diff) in zip(results, expected):
+                self.assertPatchesEqual(diff, expected_diff)
+
+    def test_diff_command_many_targets(self):
+        c_file = path.join(self.examples, 'c.csv')
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                '--output-dir', output_dir, '--jobs', '2', 'id', self.a_file,
+                self.b_file, c_file,
+            ))
+            self.assertEqual(result.exit_code, 1)
+            self.assertEqual(sorted(os.listdir(output_dir)), ['b.json', 'c.json'])
+            with open(path.join(output_dir, 'b.json')) as istream:
+                self.assertPatchesEqual(
+                    json.load(istream),
+                    csvdiff.diff_files(self.a_file, self.b_file, ['id']),
+                )
+
+        result = self.runner.invoke(csvdiff.csvdiff_cmd, ('id', self.a_file,
+                                                          self.b_file, c_file))
+        self.assertEqual(result.exit_code, 2)
+
+    def test_diff_against_sqlite_table(self):
+        expected = csvdiff.diff_files(self.a_file, self.b_file, ['id'])
+        with tmp_sqlite_table(list(records.load(self.b_file))) as db:
+            with open(self.a_file) as istream:
+                diff = patch.create(records.load(istream), sqlite.load(db, table='t'),
+                                    ['id'])
+            self.assertPatchesEqual(diff, expected)
+
+            for batch_size in [1, 2, 500]:
+                with open(self.a_file) as istream:
+                    diff = sqlite.diff_table(records.load(istream), db, ['id'], table='t',
+                                             batch_size=batch_size)
+                self.assertEqual(diff, expected)
+
+            with open(self.a_file) as istream:
+                diff = sqlite.diff_table(records.load(istream), db, ['id'],
+                                         query='SELECT * FROM t', table_side='from')
+            self.assertPatchesEqual(
+                diff, csvdiff.diff_files(self.b_file, self.a_file, ['id'])
+            )
+
+    def test_diff_against_sqlite_table_composite_key(self):
+        lhs = [
+            {'name': 'a', 'type': '1', 'sheep': '7'},
+            {'name': 'a', 'type': '2', 'sheep': '12'},
+            {'name': 'c', 'type': '1', 'sheep': '0'},
+        ]
+        rhs = [
+            {'name': 'a', 'type': '1', 'sheep': '7'},
+            {'name': 'a', 'type': '2', 'sheep': '2'},
+            {'name': 'd', 'type': '1', 'sheep': '8'},
+        ]
+        with tmp_sqlite_table(rhs) as db:
+            diff = sqlite.diff_table(lhs, db, ['name', 'type'], table='t', batch_size=2)
+        self.assertEqual(diff, csvdiff.diff_records(lhs, rhs, ['name', 'type']))
+
+    def test_diff_against_sqlite_table_with_other_columns(self):
+        lhs = [{'id': '1', 'name': 'a', 'fax': '1234'},
+               {'id': '2', 'name': 'b', 'fax': ''},
+               {'id': '3', 'name': 'c', 'fax': ''}]
+        rhs = [{'id': '1', 'name': 'a', 'extra': ''},
+               {'id': '2', 'name': 'B', 'extra': 'x'},
+               {'id': '4', 'name': 'd', 'extra': ''}]
+        with tmp_sqlite_table(rhs) as db:
+            for table_side in ['from', 'to']:
+                expected = (patch.create(lhs, sqlite.load(db, table='t'), ['id'])
+                            if table_side == 'to'
+                            else patch.create(sqlite.load(db, table='t'), lhs, ['id']))
+                self.assertEqual(expected['_columns'], (
+                    {'added': ['extra'], 'removed': ['fax']} if table_side == 'to'
+                    else {'added': ['fax'], 'removed': ['extra']}
+                ))
+
+                # looking keys up in batches agrees with loading the whole table
+                diff = sqlite.diff_table(lhs, db, ['id'], table='t', table_side=table_side,
+                                         batch_size=2)
+                self.assertEqual(diff, expected)
+
+    def test_diff_sqlite_cmd(self):
+        expected = csvdiff.diff_files(self.a_file, self.b_file, ['id'])
+        with tmp_sqlite_table(list(records.load(self.b_file))) as db:
+            for mode in [(), ('--batched',)]:
+                with tempfile.NamedTemporaryFile() as t:
+                    result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                        'sqlite', '--output', t.name, '--table', 't', 'id', self.a_file, db,
+                    ) + mode)
+                    self.assertEqual(result.exit_code, 1)
+                    with open(t.name) as istream:
+                        self.assertPatchesEqual(json.load(istream), expected)
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('sqlite', 'id', self.a_file, db))
+            self.assertEqual(result.exit_code, 2)
+
+    def test_shard_and_merge(self):
+        lhs = [{'id': str(i), 'name': 'n{0}'.format(i), 'fax': ''} for i in range(300)]
+        rhs = [{'id': str(i), 'name': 'n{0}'.format(i if i % 7 else -i), 'email': ''}
+               for i in range(20, 320)]
+        rhs[5]['email'] = 'x@example.com'
+        expected = csvdiff.diff_records(lhs, rhs, ['id'])
+
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            for method in ['hash', 'range']:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                        'shard', '--shards', '4', '--by', method, '-o', tmpdir, 'id',
+                        lhs_file, rhs_file,
+                    ))
+                    self.assertEqual(result.exit_code, 0)
+
+                    manifest = path.join(tmpdir, shard.MANIFEST)
+                    with open(manifest) as istream:
+                        entries = batch.load_manifest(istream, tmpdir)
+                    self.assertEqual(len(entries), 4)
+
+                    # every shard has some of the rows
+                    for entry in entries:
+                        assert 0 < len(list(records.load(entry['from']))) < len(lhs)
+
+                    result = self.runner.invoke(csvdiff.csvdiff_cmd, ('merge', manifest))
+                    self.assertEqual(result.exit_code, 2)
+
+                    # diff the shards in separate processes
+                    results = list(batch.run(entries, jobs=2))
+                    self.assertEqual({r['status'] for r in results}, {'different'})
+
+                    merged_file = path.join(tmpdir, 'merged.json')
+                    result = self.runner.invoke(csvdiff.csvdiff_cmd,
+                                                ('merge', '-o', merged_file, manifest))
+                    self.assertEqual(result.exit_code, 1)
+                    with open(merged_file) as istream:
+                        self.assertEqual(json.load(istream), expected)
+
+    def test_merge_keeps_column_changes(self):
+        lhs = [{'id': '1', 'a': 'x'}]
+        rhs = [{'id': '2', 'b': 'y'}]
+        parts = [csvdiff.diff_records(lhs, [], ['id']), csvdiff.diff_records([], rhs, ['id'])]
+        merged = shard.merge(parts, columns={'added': ['b'], 'removed': ['a']})
+        self.assertEqual(merged, csvdiff.diff_records(lhs, rhs, ['id']))
+
+        with self.assertRaises(patch.InvalidPatchError):
+            shard.merge([parts[0], {'_index': ['a'], 'added': [], 'removed': [],
+                                    'changed': []}])
+
+    def test_typed_columns(self):
+        lhs = [{'id': '1', 'amount': '1.0', 'name': 'x'},
+               {'id': '2', 'amount': '5', 'name': 'y'},
+               {'id': '3', 'amount': '', 'name': 'z'}]
+        rhs = [{'id': '1', 'amount': '1.00', 'name': 'x'},
+               {'id': '2', 'amount': '6', 'name': 'y'},
+               {'id': '3', 'amount': '7', 'name': 'z'},
+               {'id': '4', 'amount': '', 'name': 'w'},
+               {'id': '5', 'amount': '3', 'name': 'v'}]
+        expected = {
+            '_index': ['id'],
+            '_types': {'amount': 'float'},
+            'added': [{'id': '4', 'amount': '', 'name': 'w'},
+                      {'id': '5', 'amount': 3.0, 'name': 'v'}],
+            'removed': [],
+            'changed': [{'key': ['2'], 'fields': {'amount': {'from': 5.0, 'to': 6.0}}},
+                        {'key': ['3'], 'fields': {'amount': {'from': '', 'to': 7.0}}}],
+        }
+
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            untyped = csvdiff.diff_files(lhs_file, rhs_file, ['id'])
+            self.assertEqual(len(untyped['changed']), 3)
+
+            for types in [{'amount': 'float'}, ['amount:float', 'name:str'], 'auto']:
+                diff = csvdiff.diff_files(lhs_file, rhs_file, ['id'], types=types)
+                self.assertPatchesEqual(diff, expected)
+                assert patch.is_valid(diff)
+                assert patch.is_typed(diff)
+
+            # typed patches round-trip through csvpatch
+            with tempfile.TemporaryDirectory() as tmpdir:
+                patch_file = path.join(tmpdir, 'diff.json')
+                result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                    '--types=amount:float', '-o', patch_file, 'id', lhs_file, rhs_file,
+                ))
+                self.assertEqual(result.exit_code, 1)
+
+                out_file = path.join(tmpdir, 'out.csv')
+                result = self.runner.invoke(csvdiff.csvpatch_cmd,
+                                            ('-i', patch_file, '-o', out_file, lhs_file))
+                self.assertEqual(result.exit_code, 0)
+                self.assertEqual(csvdiff.diff_files(out_file, rhs_file, ['id'], types='auto'),
+                                 {'_index': ['id'], '_types': {'amount': 'float'},
+                                  'added': [], 'removed': [], 'changed': []})
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd,
+                                        ('--types=amount:decimal', 'id', lhs_file, rhs_file))
+            self.assertEqual(result.exit_code, 2)
+
+            with self.assertRaises(records.CSVParseError) as cm:
+                csvdiff.diff_files(lhs_file, rhs_file, ['id'], types={'name': 'int'})
+            self.assertEqual(cm.exception.line, 2)
+
+        with self.assertRaises(ValueError):
+            csvdiff.diff_files(self.a_file, self.b_file, ['id'], engine='numpy', types='auto')
+
+        # numbers parsed as they're loaded aren't parsed again
+        change = {'from': 1.04, 'to': 1.01}
+        assert not patch._is_significant(change, 1)
+        assert patch._is_significant(change, 2)
+
+    def test_inferred_ints_are_widened_to_floats(self):
+        lhs = [{'id': '1', 'amount': '4'}, {'id': '2', 'amount': '5'}]
+        rhs = [{'id': '1', 'amount': '4.5'}, {'id': '2', 'amount': '5.0'}]
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            # whichever side is read first, the other can still widen the type
+            for first, second in [(lhs_file, rhs_file), (rhs_file, lhs_file)]:
+                typer = records.Typer(exclude=['id'])
+                list(records.load(first, typer=typer))
+                list(records.load(second, typer=typer))
+                self.assertEqual(typer.types, {'amount': 'float'})
+
+            self.assertPatchesEqual(
+                csvdiff.diff_files(lhs_file, rhs_file, ['id'], types='auto'),
+                {'_index': ['id'], '_types': {'amount': 'float'}, 'added': [], 'removed': [],
+                 'changed': [{'key': ['1'], 'fields': {'amount': {'from': 4, 'to': 4.5}}}]},
+            )
+
+            # targets of a many-file diff can widen the baseline's types too
+            diffs = dict(csvdiff.diff_files_many(rhs_file, [lhs_file, rhs_file], ['id'],
+                                                 types='auto'))
+            self.assertEqual(diffs[lhs_file]['_types'], {'amount': 'float'})
+            diffs = dict(csvdiff.diff_files_many(lhs_file, [rhs_file, lhs_file], ['id'],
+                                                 types='auto'))
+            self.assertEqual(diffs[rhs_file]['_types'], {'amount': 'float'})
+            self.assertEqual(diffs[lhs_file]['_types'], {'amount': 'int'})
+
+            # digests of removed rows don't depend on which way they were typed
+            self.assertEqual(patch.row_digest({'id': '1', 'amount': 4}),
+                             patch.row_digest({'id': '1', 'amount': 4.0}))
+            with tempfile.TemporaryDirectory() as tmpdir:
+                patch_file = path.join(tmpdir, 'diff.json')
+                to_file = path.join(tmpdir, 'to.csv')
+                save_as_csv([{'id': '2', 'amount': '5.5'}], to_file)
+                result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                    '--types=auto', '--digest-removed', '-o', patch_file, 'id', lhs_file,
+                    to_file,
+                ))
+                self.assertEqual(result.exit_code, 1)
+                result = self.runner.invoke(csvdiff.csvpatch_cmd, ('-i', patch_file, lhs_file))
+                self.assertEqual(result.exit_code, 0)
+
+        # explicit types are never widened
+        typer = records.Typer({'amount': 'int'})
+        with self.assertRaises(records.CSVParseError):
+            list(typer.type_rows(iter([(2, {'amount': '4.5'})])))
+
+    def test_inferred_types_fall_back_to_text(self):
+        sample = records.Typer.AUTO_SAMPLE
+        lhs = [{'id': str(i), 'amount': str(i)} for i in range(sample + 100)]
+        rhs = [dict(r) for r in lhs]
+        rhs[sample + 50]['amount'] = 'n/a'
+        rhs[sample + 60]['amount'] = '7.5'
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            typer = records.Typer(exclude=['id'])
+            with self.assertRaises(records.TypeGuessError) as cm:
+                list(records.load(rhs_file, typer=typer))
+            self.assertEqual((cm.exception.line, cm.exception.column), (sample + 52, 'amount'))
+            self.assertEqual(typer.types, {})
+
+            # an inferred type is only a guess, so both files are read again
+            # with the column as text
+            expected = {
+                '_index': ['id'], 'added': [], 'removed': [],
+                'changed': [
+                    {'key': [str(sample + 50)],
+                     'fields': {'amount': {'from': str(sample + 50), 'to': 'n/a'}}},
+                    {'key': [str(sample + 60)],
+                     'fields': {'amount': {'from': str(sample + 60), 'to': '7.5'}}},
+                ],
+            }
+            self.assertPatchesEqual(csvdiff.diff_files(lhs_file, rhs_file, ['id'],
+                                                       types='auto'), expected)
+            self.assertPatchesEqual(dict(csvdiff.diff_files_many(lhs_file, [rhs_file], ['id'],
+                                                                 types='auto'))[rhs_file],
+                                    expected)
+
+            with self.assertRaises(records.CSVParseError):
+                csvdiff.diff_files(lhs_file, rhs_file, ['id'], types={'amount': 'int'})
+
+    def test_patching_typed_columns_keeps_untouched_text(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lhs_file = path.join(tmpdir, 'lhs.csv')
+            rhs_file = path.join(tmpdir, 'rhs.csv')
+            with open(lhs_file, 'w') as ostream:
+                ostream.write('id,amount\n1,1.50\n2,7.0\n')
+            with open(rhs_file, 'w') as ostream:
+                ostream.write('id,amount\n1,1.50\n2,8.0\n')
+
+            diff = csvdiff.diff_files(lhs_file, rhs_file, ['id'], types='auto')
+            self.assertEqual(diff['_types'], {'amount': 'float'})
+
+            ostream = StringIO()
+            with open(lhs_file) as istream:
+                csvdiff.patch_file(StringIO(json.dumps(diff)), istream, ostream)
+            self.assertEqual(ostream.getvalue(), 'id,amount\r\n1,1.50\r\n2,8.0\r\n')
+
+    def test_errors_are_raised_not_exited(self):
+        lhs = [{'id': '1', 'name': 'bob'}, {'id': '2', 'name': 'eva'}]
+        rhs = [{'id': '1', 'name': 'robert'}, {'id': '2', 'name': 'eva'}]
+        diff = csvdiff.diff_records(lhs, rhs, ['id'])
+
+        # each failure is raised in the thread which hit it, and the rest carry on
+        failures = []
+
+        def apply_to(recs):
+            try:
+                self.assertRecordsEqual(patch.apply(diff, recs), rhs)
+            except patch.PatchApplyError as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=apply_to, args=(recs,))
+                   for recs in [lhs, [{'id': '1', 'name': 'jo'}], lhs]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        e, = failures
+        self.assertEqual((e.key, e.field), (('1',), 'name'))
+        e = pickle.loads(pickle.dumps(e))
+        self.assertEqual((e.args[0], e.key, e.field),
+                         ("source document version of ('1',) has changed name field",
+                          ('1',), 'name'))
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as t:
+            t.write('id,name\n1,bob\n2,eva,extra\n')
+            t.flush()
+            with self.assertRaises(records.CSVParseError) as cm:
+                csvdiff.diff_files(self.a_file, t.name, ['id'])
+            self.assertEqual(cm.exception.line, 3)
+
+            # only the command line turns them into exit codes
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('id', self.a_file, t.name))
+            self.assertEqual(result.exit_code, 2)
+
+    def test_batch_cmd(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = path.join(tmpdir, 'manifest.jsonl')
+            latin1 = path.join(tmpdir, 'latin1.csv')
+            with open(manifest, 'w') as ostream:
+                for entry in [
+                    {'index': ['id'], 'from': self.a_file, 'to': self.b_file,
+                     'output': 'ab.json'},
+                    {'index': 'id', 'from': self.a_file, 'to': self.a_file,
+                     'output': 'aa.txt', 'style': 'summary'},
+                    {'index': ['nonexistent'], 'from': self.a_file, 'to': self.b_file,
+                     'output': 'bad.json'},
+                    {'index': ['id'], 'from': self.a_file, 'to': self.b_file,
+                     'output': 'sig.json', 'significance': '3'},
+                    {'index': ['id'], 'from': self.a_file, 'to': latin1,
+                     'output': 'latin1.json'},
+                ]:
+                    print(json.dumps(entry), file=ostream)
+
+            with open(latin1, 'wb') as ostream:
+                ostream.write('id,name\n1,caf\u00e9\n'.encode('latin1'))
+
+            for jobs in ['1', '2']:
+                result = self.runner.invoke(csvdiff.csvdiff_cmd,
+                                            ('batch', '--jobs', jobs, manifest))
+                self.assertEqual(result.exit_code, 2)
+
+                # a bad entry only fails itself
+                results = [json.loads(line) for line in result.output.splitlines()]
+                self.assertEqual([r['status'] for r in results],
+                                 ['different', 'same', 'error', 'error', 'error'])
+                self.assertEqual([r['exit_code'] for r in results], [1, 0, 2, 2, 2])
+                self.assertEqual(results[3]['error'], '"significance" should be an integer')
+                assert all(r['seconds'] >= 0 for r in results)
+
+                with open(path.join(tmpdir, 'ab.json')) as istream:
+                    self.assertPatchesEqual(
+                        json.load(istream),
+                        csvdiff.diff_files(self.a_file, self.b_file, ['id']),
+                    )
+                with open(path.join(tmpdir, 'aa.txt')) as istream:
+                    self.assertEqual(istream.read(), 'files are identical\n')
+
+    def test_tree_diff_reads_only_changed_blocks(self):
+        lhs = [{'id': str(i), 'name': 'row {0}'.format(i), 'note': ''} for i in range(2000)]
+        rhs = [dict(r) for r in reversed(lhs)]
+        rhs[10]['name'] = 'changed'
+        del rhs[500]
+        rhs.append({'id': 'new', 'name': 'added', 'note': 'x\ny'})
+
+        with tmp_csv_files(lhs, rhs) as (from_file, to_file):
+            from_tree, from_offsets = merkle.build(from_file, ['id'], block_bits=4)
+            to_tree, to_offsets = merkle.build(to_file, ['id'], block_bits=4)
+            self.assertEqual(merkle.compare(from_tree, from_tree), ([], []))
+
+            # the tree to copy between hosts holds no per-row data
+            assert len(from_tree['levels']) > 1
+            assert all('offsets' not in b for b in from_tree['blocks'])
+            self.assertEqual(len(from_offsets['offsets']), 2000)
+
+            from_blocks, to_blocks = merkle.compare(from_tree, to_tree)
+            assert 0 < len(to_blocks) <= 3 < len(to_tree['blocks'])
+            extracted = list(merkle.extract(to_file, to_tree, to_offsets, from_tree))
+            self.assertEqual(len(extracted), sum(b['rows'] for b in to_blocks))
+
+            self.assertPatchesEqual(
+                merkle.diff(from_file, from_tree, to_file, to_tree,
+                            from_offsets=from_offsets, to_offsets=to_offsets),
+                csvdiff.diff_files(from_file, to_file, ['id']),
+            )
+
+            # a tree of very different height still finds the same blocks
+            tall_tree, _ = merkle.build(to_file, ['id'], block_bits=1)
+            short_tree, _ = merkle.build(to_file, ['id'], block_bits=8)
+            assert len(tall_tree['levels']) > len(short_tree['levels'])
+            self.assertEqual(
+                merkle.compare(tall_tree, short_tree),
+                ([b for b in tall_tree['blocks'] if b not in short_tree['blocks']],
+                 [b for b in short_tree['blocks'] if b not in tall_tree['blocks']]),
+            )
+
+            with self.assertRaises(merkle.InvalidTreeError):
+                list(merkle.read_blocks(to_file, to_tree, from_offsets, to_blocks))
+
+    def test_tree_cmds(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            a_tree = path.join(tmpdir, 'a.json')
+            b_tree = path.join(tmpdir, 'b.json')
+            extract = path.join(tmpdir, 'extract.csv')
+            for args in [('build', '-o', a_tree, 'id', self.a_file),
+                         ('build', '-o', b_tree, 'id', self.b_file),
+                         ('extract', '--tree', b_tree, '-o', extract, self.b_file, a_tree)]:
+                result = self.runner.invoke(csvdiff.csvdiff_cmd, ('tree',) + args)
+                self.assertEqual(result.exit_code, 0)
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                'tree', 'diff', '--from-tree', a_tree, '--to-tree', b_tree,
+                '--to-extract', self.a_file, extract,
+            ))
+            self.assertEqual(result.exit_code, 1)
+            self.assertPatchesEqual(json.loads(result.output),
+                                    csvdiff.diff_files(self.a_file, self.b_file, ['id']))
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                'tree', 'diff', '--from-tree', a_tree, '--to-tree', a_tree,
+                self.a_file, self.a_file,
+            ))
+            self.assertEqual(result.exit_code, 0)
+
+    def test_tail_parses_only_appended_rows(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = path.join(tmpdir, 'log.csv')
+            with open(log, 'w') as ostream:
+                ostream.write('id,v\n1,a\n2,b\n')
+            state = tail.start(log, ['id'])
+
+            # a half-written row is left for next time
+            with open(log, 'a') as ostream:
+                ostream.write('3,c\n1,z\n4,"x')
+            diff, state = tail.update(log, state)
+            self.assertEqual(diff['added'], [{'id': '3', 'v': 'c'}])
+            self.assertEqual(diff['changed'], [{'key': ['1'],
+                                                'fields': {'v': {'from': 'a', 'to': 'z'}}}])
+            self.assertEqual(diff['removed'], [])
+
+            with open(log, 'a') as ostream:
+                ostream.write('\ny"\n')
+            diff, state = tail.update(log, state)
+            self.assertEqual(diff['added'], [{'id': '4', 'v': 'x\ny'}])
+            assert patch.is_empty(tail.update(log, state)[0])
+
+            # the state keeps offsets and digests, not rows, and saves nothing
+            # new when nothing was appended
+            self.assertEqual([e[:2] for e in state['keys']],
+                             [[['1'], 17], [['2'], 9], [['3'], 13], [['4'], 21]])
+            self.assertIs(tail.update(log, state)[1], state)
+
+            # the rows the state points at are gone once the file is rewritten,
+            # but the digests still give a patch from the rows last seen
+            with open(log, 'w') as ostream:
+                ostream.write('id,v\n1,z\n2,c\n5,e\n')
+            assert tail.is_rewritten(log, state)
+            with self.assertRaises(tail.FileRewrittenError):
+                tail.update(log, state)
+
+            diff, state = tail.restart(log, state)
+            self.assertEqual(diff['added'], [{'id': '2', 'v': 'c'}, {'id': '5', 'v': 'e'}])
+            self.assertEqual([r['id'] for r in diff['removed']], ['2', '3', '4'])
+            seen = [{'id': '1', 'v': 'z'}, {'id': '2', 'v': 'b'}, {'id': '3', 'v': 'c'},
+                    {'id': '4', 'v': 'x\ny'}]
+            self.assertRecordsEqual(patch.apply(diff, seen),
+                                    [{'id': '1', 'v': 'z'}, {'id': '2', 'v': 'c'},
+                                     {'id': '5', 'v': 'e'}])
+            assert patch.is_empty(tail.update(log, state)[0])
+
+    def test_tail_cmd(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = path.join(tmpdir, 'log.csv')
+            with open(log, 'w') as ostream:
+                ostream.write('id,v\n1,a\n')
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('tail', 'id', log))
+            self.assertEqual(result.exit_code, 0)
+            assert path.exists(tail.state_path(log))
+
+            with open(log, 'a') as ostream:
+                ostream.write('2,b\n')
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('tail', 'id', log))
+            self.assertEqual(result.exit_code, 1)
+            self.assertEqual(json.loads(result.output)['added'], [{'id': '2', 'v': 'b'}])
+
+            # a rewritten file is diffed as a whole, not skipped
+            with open(log, 'w') as ostream:
+                ostream.write('id,v\n9,z\n')
+            out = path.join(tmpdir, 'diff.json')
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('tail', '-o', out, 'id', log))
+            self.assertEqual(result.exit_code, 1)
+            with open(out) as istream:
+                diff = json.load(istream)
+            self.assertEqual(diff['added'], [{'id': '9', 'v': 'z'}])
+            self.assertEqual([r['id'] for r in diff['removed']], ['1', '2'])
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('tail', 'id', log))
+            self.assertEqual(result.exit_code, 0)
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, ('tail', 'v', log))
+            self.assertEqual(result.exit_code, 2)
+
+    def test_daemon_keeps_baselines_loaded(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['a.csv', 'b.csv']:
+                with open(path.join(self.examples, name)) as istream, \
+                        open(path.join(tmpdir, name), 'w') as ostream:
+                    ostream.write(istream.read())
+
+            socket_path = path.join(tmpdir, 'csvdiff.sock')
+            cache = daemon.BaselineCache(2**20)
+            server = daemon.make_server(cache, socket_path=socket_path, root=tmpdir)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                # relative paths are from the served directory
+                entry = {'index': ['id'], 'from': 'a.csv', 'to': 'b.csv'}
+                for _ in range(2):
+                    code, status, body = daemon.request(entry, socket_path=socket_path)
+                    self.assertEqual((code, status), (200, 'different'))
+                    self.assertPatchesEqual(
+                        json.loads(body),
+                        csvdiff.diff_files(self.a_file, self.b_file, ['id']),
+                    )
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+                # a changed baseline is reloaded
+                base = path.join(tmpdir, 'base.csv')
+                with open(self.b_file) as istream, open(base, 'w') as ostream:
+                    ostream.write(istream.read())
+                entry = {'index': 'id', 'from': base, 'to': 'b.csv', 'style': 'summary'}
+                self.assertEqual(daemon.request(entry, socket_path=socket_path),
+                                 (200, 'same', 'files are identical\n'))
+                with open(base, 'a') as ostream:
+                    ostream.write('7,zed,1\n')
+                self.assertEqual(daemon.request(entry, socket_path=socket_path)[1],
+                                 'different')
+                self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+                code, _, body = daemon.request({'index': ['id'], 'from': self.a_file},
+                                               socket_path=socket_path)
+                self.assertEqual((code, json.loads(body)), (400, {'error': 'missing "to"'}))
+
+                code, _, body = daemon.request(dict(entry, significance='2'),
+                                               socket_path=socket_path)
+                self.assertEqual((code, json.loads(body)),
+                                 (400, {'error': '"significance" should be an integer'}))
+
+                latin1 = path.join(tmpdir, 'latin1.csv')
+                with open(latin1, 'wb') as ostream:
+                    ostream.write(u'id,name,v\n1,caf\xe9,1\n'.encode('latin1'))
+                code, _, body = daemon.request(dict(entry, to=latin1),
+                                               socket_path=socket_path)
+                self.assertEqual(code, 400)
+                self.assertIn('error', json.loads(body))
+
+                # files outside the served directory are refused
+                for outside in [self.a_file, path.join('..', path.basename(tmpdir), '..',
+                                                       'etc.csv')]:
+                    code, _, body = daemon.request(dict(entry, to=outside),
+                                                   socket_path=socket_path)
+                    self.assertEqual((code, json.loads(body)),
+                                     (400, {'error': '"to" is outside the served directory'}))
+
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        with self.assertRaises(ValueError):
+            daemon.make_server(daemon.BaselineCache(2**20), host='0.0.0.0', port=0)
+        assert daemon.is_loopback('::1')
+
+    def test_baseline_cache_evicts_least_recently_used(self):
+        c_file = path.join(self.examples, 'c.csv')
+        size = daemon.estimate_size(csvdiff._load_baseline(self.a_file, ['id']))
+        cache = daemon.BaselineCache(size * 2)
+        for filename in [self.a_file, self.b_file, self.a_file, c_file]:
+            cache.get(filename, ['id'])
+
+        self.assertEqual([b['file'] for b in cache.describe()['baselines']],
+                         [path.abspath(self.a_file), path.abspath(c_file)])
+        assert cache.total_bytes <= cache.max_bytes
+
     def test_diff_records_str_values(self):
         lhs = [
             {'name': 'a', 'sheep': '7'},
@@ -289,6 +1085,27 @@ class TestCsvdiff(unittest.TestCase):
         patched = csvdiff.patch_records(diff, lhs)
         self.assertRecordsEqual(rhs, patched)
 
+    def test_iter_diff_records_matches_diff_records(self):
+        lhs = [{'id': str(i), 'v': 'x'} for i in range(100)]
+        rhs = [{'id': str(i), 'v': 'y' if i % 10 == 0 else 'x'} for i in range(5, 110)]
+        diff = csvdiff.diff_records(lhs, rhs, ['id'])
+
+        # a buffer much smaller than the diff keeps the producer waiting
+        changes = list(csvdiff.iter_diff_records(lhs, rhs, ['id'], buffer_size=2))
+        self.assertEqual(sorted(c.payload['id'] for c in changes if c.kind == 'added'),
+                         sorted(r['id'] for r in diff['added']))
+        self.assertEqual(sorted(c.payload['id'] for c in changes if c.kind == 'removed'),
+                         sorted(r['id'] for r in diff['removed']))
+        self.assertEqual(sorted((c.key, c.payload) for c in changes if c.kind == 'changed'),
+                         [(c['key'], c['fields']) for c in diff['changed']])
+
+        # stopping early, or a failing diff, doesn't leave the producer behind
+        changes = csvdiff.iter_diff_records(lhs, rhs, ['id'], buffer_size=1)
+        next(changes)
+        changes.close()
+        with self.assertRaises(records.InvalidKeyError):
+            list(csvdiff.iter_diff_records(lhs, rhs, ['nonexistent']))
+
     def test_diff_with_valid_ignore(self):
         """
         If you pass the diff command a list of valid columns (ones that exist in the files) to
@@ -311,7 +1128,7 @@ class TestCsvdiff(unittest.TestCase):
 
         with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
             result = self.csvdiff_summary_cmd('name', lhs_file, rhs_file, ignore_columns='cows')
-            self.assertEquals(result.exit_code, 0)
+            self.assertEqual(result.exit_code, 0)
 
     def test_diff_with_index_as_ignore_field(self):
         """
@@ -332,6 +1149,20 @@ class TestCsvdiff(unittest.TestCase):
 
         self.assertRecordsEqual(result.records, expected)
 
+    def test_patch_cmd_many_inputs(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as t:
+            json.dump(patch.invert(csvdiff.diff_files(self.a_file, self.b_file, ['id'])), t)
+            t.flush()
+
+            result = self.patch_cmd('-i', self.diff_file, '-i', t.name, self.a_file)
+            self.assertEqual(result.exit_code, 0)
+            self.assertRecordsEqual(result.records, list(records.load(self.a_file)))
+
+            # the second patch no longer applies after the first
+            result = self.patch_cmd('-i', self.diff_file, '-i', self.diff_file, self.a_file)
+            self.assertEqual(result.exit_code, 2)
+            assert 'ERROR' in result.output
+
     def test_patch_cmd_fails_when_json_is_invalid(self):
         result = self.patch_cmd('-i', self.a_file, self.a_file)
         self.assertEqual(result.exit_code, 2)
@@ -387,6 +1218,300 @@ class TestCsvdiff(unittest.TestCase):
         ]
         self.assertRecordsEqual(patch.apply(diff, orig), expected)
 
+    def test_invert_undoes_patch(self):
+        lhs = [
+            {'name': 'a', 'sheep': '7'},
+            {'name': 'b', 'sheep': '12'},
+            {'name': 'c', 'sheep': '0'},
+        ]
+        rhs = [
+            {'name': 'a', 'sheep': '7'},
+            {'name': 'c', 'sheep': '2'},
+            {'name': 'd', 'sheep': '8'},
+        ]
+        diff = csvdiff.diff_records(lhs, rhs, ['name'])
+        inverse = patch.invert(diff)
+        assert patch.is_valid(inverse)
+        self.assertPatchesEqual(inverse, csvdiff.diff_records(rhs, lhs, ['name']))
+        self.assertRecordsEqual(patch.apply(inverse, rhs), lhs)
+
+    def test_compose_matches_sequential_apply(self):
+        v1 = [
+            {'name': 'a', 'sheep': '7', 'cows': '1'},
+            {'name': 'b', 'sheep': '12', 'cows': '1'},
+            {'name': 'c', 'sheep': '0', 'cows': '1'},
+            {'name': 'e', 'sheep': '3', 'cows': '1'},
+        ]
+        v2 = [
+            {'name': 'a', 'sheep': '8', 'cows': '1'},
+            {'name': 'c', 'sheep': '2', 'cows': '1'},
+            {'name': 'd', 'sheep': '8', 'cows': '1'},
+            {'name': 'e', 'sheep': '3', 'cows': '2'},
+        ]
+        v3 = [
+            {'name': 'a', 'sheep': '7', 'cows': '1'},
+            {'name': 'b', 'sheep': '12', 'cows': '5'},
+            {'name': 'd', 'sheep': '9', 'cows': '1'},
+            {'name': 'e', 'sheep': '4', 'cows': '2'},
+        ]
+        d1 = csvdiff.diff_records(v1, v2, ['name'])
+        d2 = csvdiff.diff_records(v2, v3, ['name'])
+
+        composed = patch.compose(d1, d2)
+        assert patch.is_valid(composed)
+        self.assertRecordsEqual(patch.apply(composed, v1), v3)
+        self.assertPatchesEqual(composed, csvdiff.diff_records(v1, v3, ['name']))
+
+    def test_apply_many_matches_sequential_apply(self):
+        v1 = [{'name': 'a', 'sheep': '7'}, {'name': 'b', 'sheep': '12'}]
+        v2 = [{'name': 'a', 'sheep': '8'}, {'name': 'c', 'sheep': '2'}]
+        v3 = [{'name': 'a', 'sheep': '8'}, {'name': 'b', 'sheep': '1'},
+              {'name': 'c', 'sheep': '3'}]
+        d1 = csvdiff.diff_records(v1, v2, ['name'])
+        d2 = csvdiff.diff_records(v2, v3, ['name'])
+        self.assertRecordsEqual(patch.apply_many([d1, d2], v1), v3)
+        self.assertRecordsEqual(v1, [{'name': 'a', 'sheep': '7'}, {'name': 'b', 'sheep': '12'}])
+
+    def test_diff_with_column_changes(self):
+        v1 = [{'id': '1', 'a': 'x', 'old': 'o1'},
+              {'id': '2', 'a': 'y', 'old': 'o2'},
+              {'id': '3', 'a': 'z', 'old': 'o3'}]
+        v2 = [{'id': '1', 'a': 'x', 'new': ''},
+              {'id': '2', 'a': 'Y', 'new': 'n2'},
+              {'id': '4', 'a': 'w', 'new': 'n4'}]
+        diff = csvdiff.diff_records(v1, v2, ['id'])
+        assert patch.is_valid(diff)
+        self.assertEqual(diff['_columns'], {'added': ['new'], 'removed': ['old']})
+        self.assertEqual(diff['changed'], [
+            {'key': ['2'], 'fields': {'a': {'from': 'y', 'to': 'Y'},
+                                      'new': {'from': '', 'to': 'n2'}}},
+        ])
+        self.assertRecordsEqual(patch.apply(diff, v1), v2)
+
+        with self.assertRaises(patch.InvalidPatchError):
+            patch.invert(diff)
+
+        # only adding a column can be undone
+        v3 = [dict(r, new='q' if r['id'] == '2' else '') for r in v1]
+        diff = csvdiff.diff_records(v1, v3, ['id'])
+        self.assertEqual(diff['_columns'], {'added': ['new'], 'removed': []})
+        self.assertRecordsEqual(patch.apply(patch.invert(diff), v3), v1)
+
+        unchanged = csvdiff.diff_records(v1, v1, ['id'])
+        assert '_columns' not in unchanged
+        assert patch.is_empty(unchanged)
+        assert not patch.is_empty({'_index': ['id'], 'added': [], 'removed': [],
+                                   'changed': [], '_columns': {'added': [],
+                                                               'removed': ['old']}})
+
+        if numpy is not None:
+            from csvdiff import columnar
+            self.assertPatchesEqual(
+                columnar.create(columnar.Table.from_records(v1),
+                                columnar.Table.from_records(v2), ['id']),
+                csvdiff.diff_records(v1, v2, ['id']),
+            )
+
+    def test_digest_removed_rows(self):
+        lhs = [{'id': str(i), 'note': 'a long note about row {0} '.format(i) * 10}
+               for i in range(50)]
+        rhs = lhs[40:]
+        diff = csvdiff.diff_records(lhs, rhs, ['id'])
+        digested = patch.digest_removed(diff)
+        self.assertEqual(digested['removed'][0],
+                         {'id': '0', '_digest': patch.row_digest(lhs[0])})
+        assert patch.is_valid(digested)
+        assert len(json.dumps(digested)) < len(json.dumps(diff)) / 2
+
+        self.assertRecordsEqual(patch.apply(digested, lhs), rhs)
+
+        # strict mode still notices a removed row which has since changed
+        changed = [dict(r) for r in lhs]
+        changed[3]['note'] = 'edited'
+        with self.assertRaises(patch.PatchApplyError):
+            patch.apply(digested, changed)
+        self.assertRecordsEqual(patch.apply(digested, changed, strict=False), rhs)
+
+        with self.assertRaises(patch.InvalidPatchError):
+            patch.invert(digested)
+        with self.assertRaises(patch.InvalidPatchError):
+            patch.compose(diff, digested)
+
+        result = self.csvdiff_cmd('--digest-removed', 'id', self.a_file, self.b_file)
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(list(result.diff['removed'][0]), ['_digest', 'id'])
+
+    def test_delta_encoded_changes(self):
+        blob = json.dumps({'n{0}'.format(i): 'value {0}'.format(i) for i in range(500)},
+                          indent=1)
+        edited = blob.replace('value 10"', 'value ten"').replace('value 400"', '"')
+        lhs = [{'id': '1', 'blob': blob, 'n': '1'}, {'id': '2', 'blob': 'a', 'n': '2'}]
+        rhs = [{'id': '1', 'blob': edited, 'n': '2'}, {'id': '2', 'blob': 'b', 'n': '2'}]
+        diff = csvdiff.diff_records(lhs, rhs, ['id'])
+        encoded = patch.encode_deltas(diff, ['blob'])
+        assert patch.is_valid(encoded)
+        assert len(json.dumps(encoded)) < len(blob) / 10
+
+        fields = encoded['changed'][0]['fields']
+        self.assertEqual(fields['n'], {'from': '1', 'to': '2'})
+        self.assertEqual(patch.apply_edits(blob, fields['blob']['delta']), edited)
+
+        # too short to be worth encoding
+        self.assertEqual(encoded['changed'][1], diff['changed'][1])
+
+        self.assertRecordsEqual(patch.apply(encoded, lhs), rhs)
+
+        # the edits can only be applied to the value they were made to
+        changed = [dict(r) for r in lhs]
+        changed[0]['blob'] = blob.replace('value 3"', 'value three"')
+        for strict in (True, False):
+            with self.assertRaises(patch.PatchApplyError):
+                patch.apply(encoded, changed, strict=strict)
+
+        with self.assertRaises(patch.InvalidPatchError):
+            patch.invert(encoded)
+        with self.assertRaises(patch.InvalidPatchError):
+            patch.compose(diff, encoded)
+
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            result = self.csvdiff_cmd('--delta-columns=blob', 'id', lhs_file, rhs_file)
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(result.diff['changed'][0]['fields']['blob'], fields['blob'])
+
+    def test_edit_script(self):
+        cases = [('', 'abc'), ('abc', ''), ('abcdef', 'abXdef'), ('aaaa', 'aaaaaa'),
+                 ('line\n' * 3000, 'line\n' * 1000 + 'edit\n' + 'line\n' * 1999),
+                 ('x' * 5000, 'x' * 2000 + 'y' + 'x' * 3000)]
+        for a, b in cases:
+            self.assertEqual(patch.apply_edits(a, patch.edit_script(a, b)), b)
+
+        self.assertEqual(patch.edit_script('abcdef', 'abXdef'), [[2, 3, 'X']])
+
+    def test_compose_detects_conflicts(self):
+        d1 = {
+            '_index': ['name'],
+            'added': [],
+            'removed': [],
+            'changed': [{'key': ['a'], 'fields': {'sheep': {'from': '7', 'to': '8'}}}],
+        }
+        d2 = {
+            '_index': ['name'],
+            'added': [],
+            'removed': [],
+            'changed': [{'key': ['a'], 'fields': {'sheep': {'from': '9', 'to': '10'}}}],
+        }
+        with self.assertRaises(patch.PatchConflictError):
+            patch.compose(d1, d2)
+
+        composed = patch.compose(d1, d2, strict=False)
+        self.assertEqual(composed['changed'], [
+            {'key': ['a'], 'fields': {'sheep': {'from': '7', 'to': '10'}}},
+        ])
+
+        d3 = {
+            '_index': ['name'],
+            'added': [{'name': 'a', 'sheep': '12'}],
+            'removed': [],
+            'changed': [],
+        }
+        with self.assertRaises(patch.PatchConflictError):
+            patch.compose(d1, d3)
+
+        composed = patch.compose(d1, d3, strict=False)
+        self.assertEqual(composed['added'], [{'name': 'a', 'sheep': '12'}])
+        self.assertEqual(composed['changed'], [])
+
+        lhs = [{'name': 'a', 'sheep': '7'}]
+        self.assertEqual(patch.apply(composed, lhs, strict=False),
+                         patch.apply(d3, patch.apply(d1, lhs), strict=False))
+
+    def test_patch_compose_and_invert_cmds(self):
+        with tempfile.NamedTemporaryFile() as t:
+            result = self.runner.invoke(csvdiff.csvpatch_cmd, (
+                'compose', '-o', t.name, self.diff_file, self.diff_file,
+            ))
+            self.assertEqual(result.exit_code, 2)
+            assert 'ERROR' in result.output
+
+            result = self.runner.invoke(csvdiff.csvpatch_cmd, (
+                'invert', '-i', self.diff_file, '-o', t.name,
+            ))
+            self.assertEqual(result.exit_code, 0)
+
+            result = self.runner.invoke(csvdiff.csvpatch_cmd, (
+                'compose', '-o', t.name, self.diff_file, t.name,
+            ))
+            self.assertEqual(result.exit_code, 0)
+            with open(t.name) as istream:
+                assert patch.is_empty(json.load(istream))
+
+            # digested rows can't be put back
+            with open(t.name, 'w') as ostream:
+                patch.save(patch.digest_removed(csvdiff.diff_files(self.a_file, self.b_file,
+                                                                   ['id'])), ostream)
+            result = self.runner.invoke(csvdiff.csvpatch_cmd, ('invert', '-i', t.name))
+            self.assertEqual(result.exit_code, 2)
+            assert 'ERROR' in result.output
+            assert result.exception is None or isinstance(result.exception, SystemExit)
+
+    def test_default_subcommand(self):
+        result = self.runner.invoke(csvdiff.csvdiff_cmd, ('--help',))
+        self.assertEqual(result.exit_code, 0)
+        for name in ['diff', 'sqlite', 'batch', 'tree', 'tail', 'serve', 'shard', 'merge']:
+            assert name in result.output
+
+        result = self.runner.invoke(csvdiff.csvpatch_cmd, ('-h',))
+        self.assertEqual(result.exit_code, 0)
+        assert 'compose' in result.output
+
+        result = self.runner.invoke(csvdiff.csvdiff_cmd, ('--version',))
+        self.assertEqual((result.exit_code, result.output.split()[-1]),
+                         (0, csvdiff.__version__))
+
+        # an index column named like a subcommand still diffs
+        lhs = [{'tail': '1', 'v': 'a'}, {'tail': '2', 'v': 'b'}]
+        rhs = [{'tail': '1', 'v': 'a'}, {'tail': '2', 'v': 'c'}]
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            for args in [('tail', lhs_file, rhs_file), ('diff', 'tail', lhs_file, rhs_file)]:
+                result = self.runner.invoke(csvdiff.csvdiff_cmd, args)
+                self.assertEqual(result.exit_code, 1)
+                self.assertEqual(json.loads(result.output)['changed'],
+                                 [{'key': ['2'], 'fields': {'v': {'from': 'b', 'to': 'c'}}}])
+
+    def test_key_index_lookup(self):
+        diff = csvdiff.diff_files(self.a_file, self.b_file, ['id'])
+        diff['_columns'] = {'added': ['email'], 'removed': []}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            patch_file = path.join(tmpdir, 'diff.json')
+            for compact in [True, False]:
+                plain = StringIO()
+                patch.save(diff, plain, compact=compact)
+                with open(patch_file, 'w') as ostream:
+                    patch.save(diff, ostream, compact=compact,
+                               index_file=lookup.index_path(patch_file))
+                with open(patch_file) as istream:
+                    self.assertEqual(istream.read(), plain.getvalue())
+
+                for key in [['1'], ['2'], ['5'], ['9']]:
+                    self.assertEqual(lookup.lookup(patch_file, key), lookup.scan(diff, key))
+                self.assertEqual(list(lookup.lookup(patch_file, ['5'])), ['added'])
+
+            with open(patch_file, 'a') as ostream:
+                ostream.write('\n')
+            with self.assertRaises(lookup.IndexMismatchError):
+                lookup.lookup(patch_file, ['1'])
+
+            result = self.runner.invoke(csvdiff.csvdiff_cmd, (
+                '--key-index', '--output', patch_file, 'id', self.a_file, self.b_file,
+            ))
+            self.assertEqual(result.exit_code, 1)
+            result = self.runner.invoke(csvdiff.csvpatch_cmd, ('lookup', patch_file, '2'))
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(json.loads(result.output),
+                             {'removed': [{'id': '2', 'name': 'eva', 'amount': '63'}]})
+            result = self.runner.invoke(csvdiff.csvpatch_cmd, ('lookup', patch_file, '3'))
+            self.assertEqual(result.exit_code, 1)
+
     def test_significance(self):
         diff = {'changed': [
             {'key': ['a'], 'fields': {'pi': {'from': '3', 'to': '3.1'}}},
@@ -395,19 +1520,104 @@ class TestCsvdiff(unittest.TestCase):
         ]}
 
         d1 = patch.filter_significance(diff, 0)
-        self.assertEquals(d1['changed'], [])
+        self.assertEqual(d1['changed'], [])
 
         d2 = patch.filter_significance(diff, 1)
-        self.assertEquals(len(d2['changed']), 1)
+        self.assertEqual(len(d2['changed']), 1)
 
         d3 = patch.filter_significance(diff, 2)
-        self.assertEquals(len(d3['changed']), 2)
+        self.assertEqual(len(d3['changed']), 2)
 
         d4 = patch.filter_significance(diff, 3)
-        self.assertEquals(len(d4['changed']), 3)
+        self.assertEqual(len(d4['changed']), 3)
+
+    def test_stats_hooks_see_each_phase(self):
+        class Recorder(stats.Hook):
+            def __init__(self):
+                self.ended = []
+
+            def on_end(self, phase, seconds, rows):
+                self.ended.append((phase, rows))
+
+        lhs = [{'name': 'a', 'sheep': '7'}, {'name': 'b', 'sheep': '12'}]
+        rhs = [{'name': 'a', 'sheep': '8'}]
+
+        recorder = Recorder()
+        stats.add_hook(recorder)
+        try:
+            csvdiff.diff_records(lhs, rhs, ['name'])
+        finally:
+            stats.remove_hook(recorder)
+
+        self.assertEqual(recorder.ended, [
+            ('index', 2),
+            ('index', 1),
+            ('compare_keys', 3),
+            ('compare_rows', 1),
+            ('assemble', 2),
+        ])
+        assert not stats.enabled()
+
+    def test_diff_command_stats_file(self):
+        with tempfile.NamedTemporaryFile() as t:
+            result = self.csvdiff_cmd('--stats-file', t.name, 'id',
+                                      self.a_file, self.b_file)
+            self.assertEqual(result.exit_code, 1)
+            with open(t.name) as istream:
+                s = json.load(istream)
+
+        phases = {p['phase']: p for p in s['phases']}
+        self.assertEqual(phases['parse']['rows'], 10)
+        self.assertEqual(phases['index']['calls'], 2)
+        for name in ['compare_keys', 'compare_rows', 'assemble', 'save']:
+            assert name in phases
+
+    def test_progress_reports_json_events(self):
+        n = records.PROGRESS_INTERVAL + 1
+        lhs = [{'id': str(i), 'v': 'x'} for i in range(n)]
+        rhs = [{'id': str(i), 'v': 'y'} for i in range(n)]
+        o = StringIO()
+        reporter = progress.ProgressReporter('json', o, interval=0)
+
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            stats.add_hook(reporter)
+            try:
+                csvdiff.diff_files(lhs_file, rhs_file, ['id'])
+            finally:
+                stats.remove_hook(reporter)
+
+        events = [json.loads(line) for line in o.getvalue().splitlines()]
+        progressed = [e for e in events if e['event'] == 'progress']
+        self.assertEqual(len(progressed), 2)
+        assert all(0 < e['bytes'] <= e['total_bytes'] for e in progressed)
+
+        # both files are indexed at once, so those phases may interleave
+        ends = [e['phase'] for e in events if e['event'] == 'end']
+        self.assertEqual(sorted(ends[:4]), ['index', 'index', 'parse', 'parse'])
+        self.assertEqual(ends[4:], ['compare_keys', 'compare_rows', 'assemble'])
+
+    def test_progress_is_rate_limited_per_file(self):
+        n = records.PROGRESS_INTERVAL + 1
+        lhs = [{'id': str(i), 'v': 'x'} for i in range(n)]
+        rhs = [{'id': str(i), 'v': 'y'} for i in range(n)]
+        o = StringIO()
+        reporter = progress.ProgressReporter('json', o, interval=3600)
+
+        with tmp_csv_files(lhs, rhs) as (lhs_file, rhs_file):
+            stats.add_hook(reporter)
+            try:
+                csvdiff.diff_files(lhs_file, rhs_file, ['id'])
+            finally:
+                stats.remove_hook(reporter)
+
+        # one file's report doesn't hold back the other's
+        events = [json.loads(line) for line in o.getvalue().splitlines()]
+        progressed = [e for e in events if e['event'] == 'progress']
+        self.assertEqual(len(progressed), 2)
 
     def assertPatchesEqual(self, lhs, rhs):
         self.assertEqual(lhs['_index'], rhs['_index'])
+        self.assertEqual(lhs.get('_columns'), rhs.get('_columns'))
         self.assertRecordsEqual(lhs['added'], rhs['added'])
         self.assertRecordsEqual(lhs['removed'], rhs['removed'])
         self.assertChangesEqual(lhs['changed'], rhs['changed'])
@@ -434,6 +1644,26 @@ def tmp_csv_files(*args):
     yield [f.name for f in files]
 
 
+@contextmanager
+def tmp_sqlite_table(recs):
+    "A SQLite database holding the records in table t, with integer ids."
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = path.join(tmpdir, 'test.db')
+        columns = sorted(recs[0])
+        conn = sqlite3.connect(db)
+        conn.execute('CREATE TABLE t ({0})'.format(', '.join(
+            '{0} {1}'.format(c, 'INTEGER' if c == 'id' else 'TEXT') for c in columns
+        )))
+        conn.executemany(
+            'INSERT INTO t VALUES ({0})'.format(', '.join('?' * len(columns))),
+            [[r[c] for c in columns] for r in recs],
+        )
+        conn.commit()
+        conn.close()
+
+        yield db
+
+
 def save_as_csv(records, filename):
     with open(filename, 'w') as ostream:
         header = sorted(records[0].keys())